@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+'''
+Times the stages of py34_install.py and of kerl's download, extract and
+build path against local fixtures, so that provisioning regressions show
+up before a fleet rollout does.
+
+The fixtures are built in a temporary directory: a fake CPython tarball
+holding a trivial configure/make project, a fake Erlang/OTP tarball with an
+otp_build script that only stages files, a dpkg status file with a few
+thousand packages, and a local HTTP server standing in for python.org and
+erlang.org. Nothing touches the network or the real system.
+
+    bench_install.py run [--output FILE] [--repeat N] [--files N]
+    bench_install.py compare BASELINE CURRENT [--threshold 0.2]
+                             [--statistic min|median]
+'''
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import statistics
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import contextlib
+import http.server
+import socketserver
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+import build_utils  # noqa: E402
+import distro_info  # noqa: E402
+import py34_install  # noqa: E402
+import stream_extract  # noqa: E402
+
+KERL = os.path.join(ROOT, 'utils', 'kerl')
+
+PYTHON_VERSION = '3.4.3'
+ERLANG_RELEASE = 'R15B02'
+
+BENCH_REPEAT = 3
+BENCH_FILES = 500
+BENCH_PACKAGES = 3000
+
+# A stage is a regression when its fastest run (the least noisy of the
+# statistics) grows by more than the threshold and by more than the noise
+# floor, in seconds
+REGRESSION_THRESHOLD = 0.2
+NOISE_FLOOR = 0.02
+
+CONFIGURE_SCRIPT = '''#!/bin/sh
+srcdir=`dirname "$0"`
+prefix=/usr/local
+for arg in "$@"; do
+    case $arg in --prefix=*) prefix=${arg#--prefix=};; esac
+done
+objects=
+for source in "$srcdir"/src/*.c; do
+    objects="$objects `basename "$source" .c`.o"
+done
+cat > Makefile <<EOF
+VPATH = $srcdir/src
+prefix = $prefix
+python:$objects
+\t\\$(CC) -o \\$@ $objects
+%.o: %.c
+\t\\$(CC) -O0 -c -o \\$@ \\$<
+install: python
+\tmkdir -p \\$(prefix)/bin \\$(prefix)/lib/python3.4
+\tcp python \\$(prefix)/bin/python3
+\tcp -R $srcdir/Lib/. \\$(prefix)/lib/python3.4
+EOF
+'''
+
+OTP_BUILD_SCRIPT = '''#!/bin/sh
+case "$1" in
+    autoconf|configure|boot)
+        find lib -type f | xargs cat > /dev/null
+        ;;
+    release)
+        mkdir -p "$3/bin" "$3/lib"
+        cp -R lib/. "$3/lib"
+        cp Install "$3/Install"
+        ;;
+esac
+'''
+
+INSTALL_SCRIPT = '''#!/bin/sh
+root="$2"
+mkdir -p "$root/bin"
+printf '#!/bin/sh\\nROOTDIR="%s"\\nexec true\\n' "$root" > "$root/bin/erl"
+chmod 755 "$root/bin/erl"
+'''
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    root = None
+
+    def translate_path(self, path):
+        path = path.split('?', 1)[0].split('#', 1)[0]
+        return os.path.join(self.root, *[bit for bit in path.split('/')
+                                         if bit not in ('', '.', '..')])
+
+    def log_message(self, *args):
+        pass
+
+
+class FixtureServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def serve(directory):
+    handler = type('Handler', (QuietHandler,), {'root': directory})
+    server = FixtureServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+def write_file(filepath, content, mode=0o644):
+    directory = os.path.dirname(filepath)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(filepath, 'w') as output:
+        output.write(content)
+    os.chmod(filepath, mode)
+
+
+def source_text(rng, index):
+    # Compresses about as well as real sources do
+    words = ['def', 'return', 'self', 'import', 'value', 'for', 'in',
+             'if', 'else', 'None', 'True', 'list', 'dict', 'name']
+    lines = ['# module {}'.format(index)]
+    for _ in range(200):
+        lines.append('    '.join(rng.choice(words) for _ in range(6)))
+    return '\n'.join(lines) + '\n'
+
+
+def make_python_tarball(directory, files, seed=34):
+    rng = random.Random(seed)
+    name = 'Python-{}'.format(PYTHON_VERSION)
+    tree = os.path.join(directory, 'trees', name)
+    write_file(os.path.join(tree, 'configure'), CONFIGURE_SCRIPT, 0o755)
+    for index in range(8):
+        write_file(os.path.join(tree, 'src', 'part{}.c'.format(index)),
+                   'int part{0}(void) {{ return {0}; }}\n'.format(index))
+    write_file(os.path.join(tree, 'src', 'main.c'),
+               'int main(void) { return 0; }\n')
+    for index in range(files):
+        write_file(os.path.join(tree, 'Lib', 'pkg{}'.format(index % 20),
+                                'mod{}.py'.format(index)),
+                   source_text(rng, index))
+    tarball = os.path.join(directory, 'www', name + '.tar.xz')
+    os.makedirs(os.path.dirname(tarball))
+    subprocess.check_call(['tar', 'cJf', tarball, '-C',
+                           os.path.dirname(tree), name])
+    return tarball
+
+
+def make_erlang_tarball(directory, files, seed=15):
+    rng = random.Random(seed)
+    name = 'otp_src_{}'.format(ERLANG_RELEASE)
+    tree = os.path.join(directory, 'trees', name)
+    write_file(os.path.join(tree, 'otp_build'), OTP_BUILD_SCRIPT, 0o755)
+    write_file(os.path.join(tree, 'Install'), INSTALL_SCRIPT, 0o755)
+    for index in range(files):
+        write_file(os.path.join(tree, 'lib', 'app{}'.format(index % 20),
+                                'src', 'mod{}.erl'.format(index)),
+                   source_text(rng, index))
+    filename = name + '.tar.gz'
+    tarball = os.path.join(directory, 'www', 'erlang', filename)
+    os.makedirs(os.path.dirname(tarball))
+    subprocess.check_call(['tar', 'czf', tarball, '-C',
+                           os.path.dirname(tree), name])
+    with open(os.path.join(os.path.dirname(tarball), 'MD5'), 'w') as md5:
+        md5.write('MD5({})= {}\n'.format(filename, file_md5(tarball)))
+    return tarball
+
+
+def make_dpkg_status(filepath, packages, wanted):
+    names = ['fixture-package-{}'.format(index) for index in range(packages)]
+    with open(filepath, 'w') as status:
+        for name in names + list(wanted):
+            status.write('Package: {}\nStatus: install ok installed\n'
+                         'Version: 1.0\nDescription: fixture\n\n'.format(name))
+
+
+def file_md5(filepath):
+    md5 = hashlib.md5()
+    with open(filepath, 'rb') as data:
+        for block in iter(lambda: data.read(2**16), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+@contextlib.contextmanager
+def quiet():
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        try:
+            yield output
+        except SystemExit:
+            raise RuntimeError('stage failed:\n' + output.getvalue())
+
+
+def timed(function):
+    start = time.monotonic()
+    function()
+    return time.monotonic() - start
+
+
+def python_stages(fixtures, url, tarball):
+    # Seconds of every py34_install stage for one cold run
+    home = os.path.join(fixtures, 'python-home')
+    if os.path.exists(home):
+        shutil.rmtree(home)
+    os.makedirs(home)
+    install_directory = os.path.join(home, 'install')
+    md5 = file_md5(tarball)
+    release = {'version': PYTHON_VERSION,
+               'url': url + '/' + os.path.basename(tarball),
+               'md5': md5, 'configure_options': [],
+               'deps': {}, 'home': install_directory}
+
+    os.environ['HOME'] = home
+    os.environ['PY34_DPKG_STATUS'] = os.path.join(fixtures, 'status')
+    os.environ['PY34_REPLACE_INSTALL'] = install_directory
+    py34_install.set_release(release)
+    py34_install.set_build_root(os.path.join(home, 'build'))
+    stages = {}
+
+    def detect():
+        distro_info._distro_information = None
+        distro_info.get_distro_information()
+    stages['py34 distro detection'] = timed(detect)
+
+    wanted = ['build-essential', 'libssl-dev', 'libsqlite3-dev']
+    stages['py34 dependency check'] = timed(
+        lambda: py34_install.missing_packages(wanted, read_status=True))
+
+    sfile = py34_install.get_source_filepath()
+    os.makedirs(os.path.dirname(sfile))
+    with quiet():
+        stages['py34 download'] = timed(lambda: py34_install.download_file(
+            release['url'], sfile, ('md5', md5)))
+    stages['py34 checksum'] = timed(
+        lambda: py34_install.file_checksum(sfile))
+
+    def build(force_phases):
+        del py34_install.PHASE_REPORT[:]
+        with quiet():
+            py34_install.ensure_python34_built(install_directory, 2,
+                                               force_phases)
+        for record in py34_install.PHASE_REPORT:
+            stages['py34 ' + record['phase']] = record['seconds']
+
+    build(['extract'])
+    # Without a tarball the download is extracted as it arrives
+    os.unlink(sfile)
+    build(['extract'])
+    stages['py34 no-op rerun'] = timed(lambda: build([]))
+    return stages
+
+
+def kerl_stages(fixtures, url):
+    home = os.path.join(fixtures, 'kerl-home')
+    if os.path.exists(home):
+        shutil.rmtree(home)
+    os.makedirs(os.path.join(home, '.kerl'))
+    with open(os.path.join(home, '.kerlrc'), 'w') as kerlrc:
+        kerlrc.write('ERLANG_DOWNLOAD_URL={}/erlang\n'.format(url))
+    with open(os.path.join(home, '.kerl', 'otp_releases'), 'w') as releases:
+        releases.write(ERLANG_RELEASE + '\n')
+    env = dict(os.environ, HOME=home)
+    for var in ('KERL_BUILD_CACHE_DIR', 'KERL_COMPILER_CACHE_DIR',
+                'KERL_CONFIG_CACHE_DIR', 'KERL_PACK_INSTALLS',
+                'BUILD_REGISTRY'):
+        env.pop(var, None)
+
+    def kerl(*args):
+        subprocess.check_call([KERL] + list(args), env=env,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+
+    stages = {}
+    stages['kerl build'] = timed(lambda: kerl('build', ERLANG_RELEASE,
+                                              'bench'))
+    stages['kerl install'] = timed(lambda: kerl(
+        'install', 'bench', os.path.join(home, 'erlang')))
+    archive = os.path.join(home, '.kerl', 'archives',
+                           'otp_src_{}.tar.gz'.format(ERLANG_RELEASE))
+    stages['kerl extract'] = timed(lambda: stream_extract.extract(
+        archive, os.path.join(home, 'extract'), 1))
+    return stages
+
+
+def summarize(runs):
+    summary = {}
+    for stage in runs[0]:
+        samples = sorted(run[stage] for run in runs if stage in run)
+        summary[stage] = {'min': round(samples[0], 4),
+                          'median': round(statistics.median(samples), 4),
+                          'max': round(samples[-1], 4),
+                          'runs': [round(sample, 4) for sample in samples]}
+    return summary
+
+
+def run(args):
+    fixtures = tempfile.mkdtemp(prefix='bench-install-')
+    saved_env = dict(os.environ)
+    try:
+        tarball = make_python_tarball(fixtures, args.files)
+        make_erlang_tarball(fixtures, args.files)
+        make_dpkg_status(os.path.join(fixtures, 'status'), args.packages,
+                         ['build-essential', 'libssl-dev'])
+        server, url = serve(os.path.join(fixtures, 'www'))
+        try:
+            runs = []
+            for _ in range(args.repeat):
+                stages = python_stages(fixtures, url, tarball)
+                if not args.skip_kerl:
+                    stages.update(kerl_stages(fixtures, url))
+                runs.append(stages)
+        finally:
+            server.shutdown()
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_env)
+        shutil.rmtree(fixtures, ignore_errors=True)
+
+    results = {'created': time.time(),
+               'host': platform.node(),
+               'python': platform.python_version(),
+               'cpus': build_utils.usable_cpu_count(),
+               'repeat': args.repeat,
+               'files': args.files,
+               'stages': summarize(runs)}
+
+    width = max(len(stage) for stage in results['stages'])
+    for stage, summary in sorted(results['stages'].items()):
+        print('{}  {:8.3f}s median  {:8.3f}s min'.format(
+            stage.ljust(width), summary['median'], summary['min']))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    exit(0)
+
+
+def compare(args):
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)['stages']
+    with open(args.current) as current_file:
+        current = json.load(current_file)['stages']
+
+    regressions = []
+    width = max(len(stage) for stage in current)
+    for stage in sorted(current):
+        after = current[stage][args.statistic]
+        if stage not in baseline:
+            print('{}  {:8.3f}s  (new)'.format(stage.ljust(width), after))
+            continue
+        before = baseline[stage][args.statistic]
+        change = (after - before) / before if before else 0.0
+        regressed = change > args.threshold and \
+            after - before > args.noise_floor
+        if regressed:
+            regressions.append(stage)
+        print('{}  {:8.3f}s -> {:8.3f}s  {:+7.1%}{}'.format(
+            stage.ljust(width), before, after, change,
+            '  REGRESSION' if regressed else ''))
+
+    if regressions:
+        print('{} stage(s) slower than {:.0%} over the baseline: {}'.format(
+            len(regressions), args.threshold, ', '.join(regressions)))
+        exit(1)
+    exit(0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='bench-install',
+                                     description='Benchmark the installers '
+                                                 'against local fixtures')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    run_parser = commands.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('--output', type=str, default=None,
+                            help='write the results as JSON here')
+    run_parser.add_argument('--repeat', type=int, default=BENCH_REPEAT,
+                            help='(default: {})'.format(BENCH_REPEAT))
+    run_parser.add_argument('--files', type=int, default=BENCH_FILES,
+                            help='source files in each fake tarball '
+                                 '(default: {})'.format(BENCH_FILES))
+    run_parser.add_argument('--packages', type=int, default=BENCH_PACKAGES,
+                            help='packages in the fake dpkg status file '
+                                 '(default: {})'.format(BENCH_PACKAGES))
+    run_parser.add_argument('--skip-kerl', action='store_true',
+                            help='only benchmark py34_install.py')
+
+    compare_parser = commands.add_parser('compare', help='flag regressions '
+                                                         'between two runs')
+    compare_parser.add_argument('baseline', type=str)
+    compare_parser.add_argument('current', type=str)
+    compare_parser.add_argument('--threshold', type=float,
+                                default=REGRESSION_THRESHOLD,
+                                help='relative slowdown that fails the '
+                                     'comparison (default: {})'.format(
+                                         REGRESSION_THRESHOLD))
+    compare_parser.add_argument('--statistic', choices=('min', 'median'),
+                                default='min',
+                                help='what is compared (default: min)')
+    compare_parser.add_argument('--noise-floor', type=float,
+                                default=NOISE_FLOOR,
+                                help='seconds a stage may grow by regardless '
+                                     '(default: {})'.format(NOISE_FLOOR))
+
+    args = parser.parse_args()
+    if args.command == 'run' and args.repeat < 1:
+        parser.error('--repeat must be at least 1')
+    (run if args.command == 'run' else compare)(args)
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+'''
+Content-addressed cache of finished install trees.
+
+Shared by py34_install.py and kerl: an install tree is stored as a
+compressed archive named after a hash of everything that went into the
+build (source checksum, configure options, distribution and compiler), so
+identical machines can restore it instead of compiling it again.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import tarfile
+import argparse
+import tempfile
+
+import build_utils
+import distro_info
+import stream_extract
+
+BUILD_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.build-cache')
+
+BUILD_CACHE_MAX_SIZE = '20G'
+
+ARCHIVE_SUFFIX = '.tar.gz'
+
+SIZE_UNITS = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+
+def cache_directory(cache_dir=None):
+    return cache_dir or os.environ.get('BUILD_CACHE_DIR', BUILD_CACHE_DIR)
+
+
+def parse_size(size):
+    size = str(size).strip().upper().rstrip('B')
+    unit = size[-1:] if size[-1:] in SIZE_UNITS else ''
+    number = size[:-1] if unit else size
+    return int(float(number) * SIZE_UNITS[unit])
+
+
+def cache_max_bytes(max_size=None):
+    return parse_size(max_size or os.environ.get('BUILD_CACHE_MAX_SIZE',
+                                                 BUILD_CACHE_MAX_SIZE))
+
+
+def cache_key(parts):
+    encoded = json.dumps(parts, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def archive_filepath(key, cache_dir=None):
+    return os.path.join(cache_directory(cache_dir), key[:2],
+                        key + ARCHIVE_SUFFIX)
+
+
+def metadata_filepath(key, cache_dir=None):
+    return os.path.join(cache_directory(cache_dir), key[:2], key + '.json')
+
+
+def cache_entries(cache_dir=None):
+    # (last use, size, key) for every archive in the cache
+    entries = []
+    root = cache_directory(cache_dir)
+    if not os.path.isdir(root):
+        return entries
+    for prefix in os.listdir(root):
+        prefix_dir = os.path.join(root, prefix)
+        if not os.path.isdir(prefix_dir):
+            continue
+        for name in os.listdir(prefix_dir):
+            if not name.endswith(ARCHIVE_SUFFIX):
+                continue
+            try:
+                st = os.stat(os.path.join(prefix_dir, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size,
+                            name[:-len(ARCHIVE_SUFFIX)]))
+    return entries
+
+
+def evict(max_bytes, cache_dir=None, keep=None):
+    entries = sorted(cache_entries(cache_dir))
+    total = sum(size for _, size, _ in entries)
+    evicted = []
+    for _, size, key in entries:
+        if total <= max_bytes:
+            break
+        if key == keep:
+            continue
+        for path in (archive_filepath(key, cache_dir),
+                     metadata_filepath(key, cache_dir)):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        total -= size
+        evicted.append(key)
+    return evicted
+
+
+def lookup(key, cache_dir=None):
+    path = archive_filepath(key, cache_dir)
+    if not os.path.isfile(path):
+        return None
+    # The archive mtime doubles as its last use time for LRU eviction
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+    return path
+
+
+def restore(key, destination, cache_dir=None):
+    path = lookup(key, cache_dir)
+    if path is None:
+        return False
+
+    destination = os.path.abspath(destination)
+    parent = os.path.dirname(destination)
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+
+    # Unpack next to the destination and move it into place, so a broken
+    # archive or an interrupted restore never leaves half a tree behind
+    tmp_dir = tempfile.mkdtemp(prefix='.restore-', dir=parent)
+    # The cache may be shared: every member is checked against the links
+    # extracted before it, and no link may point outside of the tree (the
+    # relocatable trees stored here have no absolute links)
+    staging = os.path.realpath(tmp_dir)
+    extra = {'filter': 'tar'} if hasattr(tarfile, 'tar_filter') else {}
+    try:
+        with tarfile.open(path, 'r:gz') as archive:
+            for member in archive:
+                stream_extract.check_member(member, staging)
+                archive.extract(member, staging, **extra)
+        if os.path.exists(destination):
+            shutil.rmtree(destination)
+        os.rename(os.path.join(tmp_dir, 'tree'), destination)
+    except stream_extract.ExtractError as msg:
+        print('Refusing to restore {}: {}'.format(path, msg), file=sys.stderr)
+        return False
+    except (IOError, OSError, tarfile.TarError) as msg:
+        print('Could not restore {}: {}'.format(path, msg), file=sys.stderr)
+        return False
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return True
+
+
+def store(key, source, parts=None, cache_dir=None, max_size=None):
+    path = archive_filepath(key, cache_dir)
+    prefix_dir = os.path.dirname(path)
+    if not os.path.exists(prefix_dir):
+        os.makedirs(prefix_dir)
+
+    fd, tmp_path = tempfile.mkstemp(prefix='.store-', dir=prefix_dir)
+    os.close(fd)
+    try:
+        with tarfile.open(tmp_path, 'w:gz', compresslevel=6) as archive:
+            archive.add(source, arcname='tree')
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    metadata = {'key': key,
+                'parts': parts or {},
+                'size': os.path.getsize(path),
+                'created': time.time()}
+    tmp_meta = metadata_filepath(key, cache_dir) + '.tmp'
+    with open(tmp_meta, 'w') as meta_file:
+        json.dump(metadata, meta_file, indent=2, sort_keys=True)
+    os.replace(tmp_meta, metadata_filepath(key, cache_dir))
+
+    evict(cache_max_bytes(max_size), cache_dir, keep=key)
+    return path
+
+
+def toolchain_parts(distro, compiler):
+    return {'distro': '{}-{}'.format(distro.get('ID'),
+                                     distro.get('RELEASE')),
+            'machine': os.uname()[4],
+            'compiler': compiler}
+
+
+def main(args):
+    if args.command == 'key':
+        # Without the sum, every source would share a key
+        if not args.source_checksum:
+            print('No source checksum, no cache key', file=sys.stderr)
+            exit(1)
+        parts = {'product': args.product,
+                 'source_checksum': args.source_checksum,
+                 'configure_options': args.configure_options.split()}
+        if args.release:
+            parts['release'] = args.release
+        if args.applications:
+            parts['applications'] = args.applications.split()
+        if args.target_applications:
+            # Their closure is fixed by the source, already in the key
+            parts['target_applications'] = sorted(
+                args.target_applications.split())
+        parts.update(toolchain_parts(distro_info.get_distro_information(),
+                                     build_utils.compiler_version()))
+        print(cache_key(parts))
+    elif args.command == 'restore':
+        if not restore(args.key, args.destination, args.cache_dir):
+            exit(1)
+    elif args.command == 'store':
+        store(args.key, args.source, cache_dir=args.cache_dir,
+              max_size=args.max_size)
+    elif args.command == 'evict':
+        for key in evict(cache_max_bytes(args.max_size), args.cache_dir):
+            print('Evicted {}'.format(key))
+    elif args.command == 'list':
+        for last_use, size, key in sorted(cache_entries(args.cache_dir),
+                                          reverse=True):
+            print('{}  {:>12}  {}'.format(
+                key, size, time.strftime('%Y-%m-%d %H:%M',
+                                         time.localtime(last_use))))
+    exit(0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='build-cache',
+                                     description='Content-addressed cache '
+                                                 'of finished builds')
+    parser.add_argument('--cache-dir',
+                        type=str,
+                        default=None,
+                        help='(default: $BUILD_CACHE_DIR or {})'.format(
+                            BUILD_CACHE_DIR))
+    parser.add_argument('--max-size',
+                        type=str,
+                        default=None,
+                        help='evict least recently used archives above this '
+                             'size (default: $BUILD_CACHE_MAX_SIZE or '
+                             '{})'.format(BUILD_CACHE_MAX_SIZE))
+
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    key_parser = commands.add_parser('key', help='print the cache key of a '
+                                                 'build on this machine')
+    key_parser.add_argument('product', type=str)
+    key_parser.add_argument('source_checksum', type=str)
+    key_parser.add_argument('configure_options', type=str, nargs='?',
+                            default='')
+    key_parser.add_argument('--release', type=str, default=None)
+    key_parser.add_argument('--applications', type=str, default='',
+                            help='only these applications are built')
+    key_parser.add_argument('--target-applications', type=str, default='',
+                            help='only these applications and those they '
+                                 'depend on are built')
+
+    restore_parser = commands.add_parser('restore', help='restore a cached '
+                                                         'install tree')
+    restore_parser.add_argument('key', type=str)
+    restore_parser.add_argument('destination', type=str)
+
+    store_parser = commands.add_parser('store', help='store an install tree')
+    store_parser.add_argument('key', type=str)
+    store_parser.add_argument('source', type=str)
+
+    commands.add_parser('evict', help='apply the size cap')
+    commands.add_parser('list', help='list cached archives')
+
+    main(parser.parse_args())
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+'''
+Helpers shared by the build drivers (py34_install.py, erlang_install.py) and
+the caches: how many CPUs a build may use, sharing a make job budget between
+concurrent builds, the compiler in use, the installed dpkg packages, copying
+and hashing downloads, and the size of install trees.
+'''
+import os
+import sys
+import math
+import hashlib
+import itertools
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# Releases built side by side get at least this many make jobs each
+MIN_JOBS_PER_BUILD = 2
+
+BLOCK_SIZE = 2**16
+
+
+def cgroup_cpu_limit():
+    cgroup_root = os.environ.get('PY34_CGROUP_ROOT', '/sys/fs/cgroup')
+
+    # cgroup v2: '<quota> <period>' or 'max <period>' in cpu.max, looked up
+    # in our own cgroup first and then at the root of the hierarchy
+    candidates = []
+    try:
+        with open('/proc/self/cgroup') as cgroup_file:
+            for line in cgroup_file:
+                if line.startswith('0::'):
+                    path = line.strip()[3:].lstrip('/')
+                    if path:
+                        candidates.append(os.path.join(cgroup_root, path))
+    except IOError:
+        pass
+    candidates.append(cgroup_root)
+
+    for directory in candidates:
+        try:
+            with open(os.path.join(directory, 'cpu.max')) as cpu_max:
+                quota, period = cpu_max.read().split()[:2]
+        except (IOError, ValueError):
+            continue
+        if quota == 'max':
+            return None
+        try:
+            return int(quota) / int(period)
+        except (ValueError, ZeroDivisionError):
+            return None
+
+    # cgroup v1
+    try:
+        with open(os.path.join(cgroup_root, 'cpu', 'cpu.cfs_quota_us')) as f:
+            quota = int(f.read())
+        with open(os.path.join(cgroup_root, 'cpu', 'cpu.cfs_period_us')) as f:
+            period = int(f.read())
+    except (IOError, ValueError):
+        return None
+    if quota > 0 and period > 0:
+        return quota / period
+    return None
+
+
+def usable_cpu_count():
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        count = os.cpu_count() or 1
+
+    limit = cgroup_cpu_limit()
+    if limit:
+        count = min(count, max(1, int(math.ceil(limit))))
+    return count
+
+
+def run_with_job_budget(work, items, jobs_budget, max_parallel):
+    # Calls work(item, jobs) for every item, at most max_parallel at once.
+    # Every call gets an equal slice of what is left of the job budget when
+    # it starts, so concurrent builds never oversubscribe the CPUs and a
+    # build that starts late gets the jobs freed by the ones before it
+    concurrency = max(1, min(len(items), max_parallel))
+    budget = threading.Condition()
+    state = {'free': jobs_budget, 'pending': len(items), 'running': 0}
+
+    def acquire_jobs():
+        with budget:
+            while state['running'] >= concurrency or state['free'] < 1:
+                budget.wait()
+            share = min(state['pending'], concurrency - state['running'])
+            jobs = max(1, state['free'] // share)
+            state['free'] -= jobs
+            state['pending'] -= 1
+            state['running'] += 1
+            return jobs
+
+    def release_jobs(jobs):
+        with budget:
+            state['free'] += jobs
+            state['running'] -= 1
+            budget.notify_all()
+
+    def worker(item):
+        jobs = acquire_jobs()
+        try:
+            return work(item, jobs)
+        finally:
+            release_jobs(jobs)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(worker, item) for item in items]
+        return [future.result() for future in futures]
+
+
+_compiler_version = None
+
+
+def compiler_version():
+    global _compiler_version
+    if _compiler_version is None:
+        cc = os.environ.get('CC', 'cc').split()
+        try:
+            output = subprocess.check_output(cc + ['--version'],
+                                             stderr=subprocess.STDOUT,
+                                             timeout=10)
+            lines = output.decode('utf-8', 'replace').splitlines()
+            _compiler_version = lines[0].strip() if lines else 'unknown'
+        except (OSError, subprocess.SubprocessError):
+            _compiler_version = 'unknown'
+    return _compiler_version
+
+
+def format_bytes(count):
+    if count is None:
+        return '-'
+    for unit in ('B', 'K', 'M', 'G'):
+        if count < 1024 or unit == 'G':
+            return '{:.0f}{}'.format(count, unit) if unit == 'B' else \
+                '{:.1f}{}'.format(count, unit)
+        count /= 1024.0
+
+
+def tree_size(directory):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def copy_hashed(source, outputs=(), digest=None, block_size=BLOCK_SIZE):
+    # Copies the file object source into every output, hashing it along the
+    # way; returns the number of bytes copied
+    copied = 0
+    for data in iter(lambda: source.read(block_size), b''):
+        if digest is not None:
+            digest.update(data)
+        for output in outputs:
+            output.write(data)
+        copied += len(data)
+    return copied
+
+
+def file_checksum(filepath, algorithm='md5', block_size=BLOCK_SIZE):
+    # Hex digest of the file, None when it cannot be read
+    digest = hashlib.new(algorithm)
+    try:
+        with open(filepath, 'rb') as data:
+            copy_hashed(data, digest=digest, block_size=block_size)
+    except IOError:
+        print('Error calculating {} sum for file {}'.format(
+            algorithm.upper(), filepath), file=sys.stderr)
+        return None
+    return digest.hexdigest()
+
+
+def dpkg_installed_versions(status_filepath, packages=None, accept=None):
+    # {package: version} of the packages installed according to the dpkg
+    # status file: those in packages when given, and those accept(package)
+    # is true for when given. Raises IOError without the file.
+    wanted = set(packages) if packages is not None else None
+    installed = {}
+    package = version = state = None
+    with open(status_filepath) as status_file:
+        for line in itertools.chain(status_file, ['\n']):
+            if line.startswith('Package: '):
+                package = line[9:].strip()
+            elif line.startswith('Status: '):
+                # Status: <want> <error flag> <state>
+                state = line.split()[-1]
+            elif line.startswith('Version: '):
+                version = line[9:].strip()
+            elif line == '\n':
+                if package and state == 'installed' and \
+                        (wanted is None or package in wanted) and \
+                        (accept is None or accept(package)):
+                    installed[package] = version
+                    if wanted is not None and \
+                            len(installed) == len(wanted):
+                        break
+                package = version = state = None
+    return installed
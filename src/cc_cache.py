@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+'''
+Compiler cache shared by the Python and Erlang builds.
+
+compiler_cache_env() points CC and CXX at ccache when it is installed, and
+otherwise at this script, which is then run as
+
+    cc_cache.py <compiler> <compiler arguments...>
+
+and keeps a simple object cache: a single-source compile (-c) is keyed on
+the compiler binary, its arguments and the preprocessed source, and a hit
+copies the stored object instead of compiling it. Anything else (linking,
+dependency generation, several sources) goes straight to the compiler.
+The objects are kept under CC_CACHE_MAX_SIZE (default 5G), evicting the
+least recently used ones first.
+
+    cc_cache.py --shell-env DIR    prints the CC/CXX exports for sh
+    cc_cache.py --stats DIR        prints the hit/miss counters
+'''
+import os
+import sys
+import json
+import fcntl
+import shlex
+import shutil
+import hashlib
+import tempfile
+import subprocess
+
+COMPILER_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.compiler-cache')
+
+COMPILER_CACHE_MAX_SIZE = '5G'
+
+SOURCE_SUFFIXES = ('.c', '.cc', '.cpp', '.cxx', '.C', '.S')
+
+# Flags whose output the bundled cache cannot reproduce from an object file
+UNCACHEABLE_FLAGS = ('-M', '-MM', '-MD', '-MMD', '-MF', '-MT', '-MQ', '-E',
+                     '-S', '--coverage', '-save-temps')
+
+STATS_FILENAME = 'stats.json'
+
+# Append-only log of the previous versions, replaced by STATS_FILENAME
+LEGACY_STATS_FILENAME = 'stats.log'
+
+BUNDLED_STATS_KEYS = {'hit': 'hits', 'miss': 'misses',
+                      'uncacheable': 'uncacheable'}
+
+
+def compiler_cache_directory(cache_dir=None):
+    return cache_dir or os.environ.get('COMPILER_CACHE_DIR',
+                                       COMPILER_CACHE_DIR)
+
+
+def compiler_cache_env(cache_dir=None, env=None):
+    cache_dir = compiler_cache_directory(cache_dir)
+    env = dict(os.environ if env is None else env)
+    cc = env.get('CC', 'cc')
+    cxx = env.get('CXX', 'c++')
+    if 'ccache' in cc or 'cc_cache' in cc:
+        return env
+
+    if shutil.which('ccache'):
+        env['CCACHE_DIR'] = os.path.join(cache_dir, 'ccache')
+        env['CC'] = 'ccache ' + cc
+        env['CXX'] = 'ccache ' + cxx
+    else:
+        env['CC_CACHE_DIR'] = os.path.join(cache_dir, 'objects')
+        wrapper = '{} {}'.format(shlex.quote(sys.executable),
+                                 shlex.quote(os.path.abspath(__file__)))
+        env['CC'] = '{} {}'.format(wrapper, cc)
+        env['CXX'] = '{} {}'.format(wrapper, cxx)
+    return env
+
+
+def ccache_stats(env):
+    # ccache >= 3.7 has a machine readable format, older ones only -s
+    stats = {'hits': 0, 'misses': 0, 'uncacheable': 0}
+    try:
+        output = subprocess.check_output(['ccache', '--print-stats'],
+                                         env=env, stderr=subprocess.DEVNULL)
+        for line in output.decode('utf-8', 'replace').splitlines():
+            key, _, value = line.partition('\t')
+            if not value.strip().isdigit():
+                continue
+            if key in ('direct_cache_hit', 'preprocessed_cache_hit'):
+                stats['hits'] += int(value)
+            elif key == 'cache_miss':
+                stats['misses'] += int(value)
+            elif key.startswith('unsupported_') or key in (
+                    'called_for_link', 'called_for_preprocessing',
+                    'compile_failed', 'multiple_source_files'):
+                stats['uncacheable'] += int(value)
+        return stats
+    except (OSError, subprocess.CalledProcessError):
+        pass
+
+    try:
+        output = subprocess.check_output(['ccache', '-s'], env=env,
+                                         stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return stats
+    for line in output.decode('utf-8', 'replace').splitlines():
+        bits = line.rsplit(None, 1)
+        if len(bits) != 2 or not bits[1].isdigit():
+            continue
+        if bits[0].startswith('cache hit'):
+            stats['hits'] += int(bits[1])
+        elif bits[0].startswith('cache miss'):
+            stats['misses'] += int(bits[1])
+        elif bits[0].startswith(('called for link', 'unsupported')):
+            stats['uncacheable'] += int(bits[1])
+    return stats
+
+
+def bundled_stats(objects_dir):
+    stats = {'hits': 0, 'misses': 0, 'uncacheable': 0}
+    try:
+        with open(os.path.join(objects_dir, STATS_FILENAME)) as stats_file:
+            counters = json.load(stats_file)
+    except (IOError, ValueError):
+        return stats
+    for key in stats:
+        stats[key] = counters.get(key, 0)
+    return stats
+
+
+def cache_stats(env):
+    if env.get('CCACHE_DIR') and env.get('CC', '').startswith('ccache'):
+        stats = ccache_stats(env)
+        stats['backend'] = 'ccache'
+    else:
+        stats = bundled_stats(env.get('CC_CACHE_DIR', ''))
+        stats['backend'] = 'bundled'
+    return stats
+
+
+def stats_delta(before, after):
+    return dict((key, after[key] - before.get(key, 0)) if
+                isinstance(after[key], int) else (key, after[key])
+                for key in after)
+
+
+def print_cache_stats(stats, title='Compiler cache'):
+    lookups = stats['hits'] + stats['misses']
+    ratio = 100.0 * stats['hits'] / lookups if lookups else 0.0
+    print('{} ({}): {} hits, {} misses ({:.1f}% hit rate), '
+          '{} not cacheable'.format(title, stats['backend'], stats['hits'],
+                                    stats['misses'], ratio,
+                                    stats['uncacheable']))
+
+
+def cache_max_bytes():
+    # Imported here, only a miss pays for it and not every compile
+    import build_cache
+    return build_cache.parse_size(os.environ.get('CC_CACHE_MAX_SIZE',
+                                                 COMPILER_CACHE_MAX_SIZE))
+
+
+def object_entries(objects_dir):
+    # (last use, size, path) for every object in the cache
+    entries = []
+    for prefix in os.listdir(objects_dir):
+        prefix_dir = os.path.join(objects_dir, prefix)
+        if not os.path.isdir(prefix_dir):
+            continue
+        for name in os.listdir(prefix_dir):
+            if not name.endswith('.o'):
+                continue
+            path = os.path.join(prefix_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+    return entries
+
+
+def evict(objects_dir, max_bytes):
+    # Removes the least recently used objects; returns the size left
+    entries = sorted(object_entries(objects_dir))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        total -= size
+    return total
+
+
+def record(objects_dir, outcome, stored=0):
+    # The counters, and the size of the objects, are rewritten in place
+    # under a lock, so parallel jobs neither lose updates nor grow the file
+    try:
+        fd = os.open(os.path.join(objects_dir, STATS_FILENAME),
+                     os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, 'r+') as stats_file:
+            fcntl.flock(stats_file, fcntl.LOCK_EX)
+            try:
+                counters = json.loads(stats_file.read() or '{}')
+            except ValueError:
+                counters = {}
+            if 'bytes' in counters:
+                counters['bytes'] += stored
+            else:
+                # First use, or a cache written by a previous version; the
+                # object just stored is already on disk
+                counters['bytes'] = sum(
+                    size for _, size, _ in object_entries(objects_dir))
+                try:
+                    os.unlink(os.path.join(objects_dir,
+                                           LEGACY_STATS_FILENAME))
+                except OSError:
+                    pass
+            key = BUNDLED_STATS_KEYS[outcome]
+            counters[key] = counters.get(key, 0) + 1
+            if stored:
+                max_bytes = cache_max_bytes()
+                if counters['bytes'] > max_bytes:
+                    # Down to 90% so the next misses do not evict again
+                    counters['bytes'] = evict(objects_dir,
+                                              max_bytes * 9 // 10)
+            stats_file.seek(0)
+            stats_file.truncate()
+            stats_file.write(json.dumps(counters, sort_keys=True))
+    except (OSError, ValueError):
+        pass
+
+
+def compile_plan(args):
+    # (source, output, preprocessor arguments) of a cacheable compile
+    if '-c' not in args:
+        return None
+    sources = []
+    output = None
+    pp_args = []
+    skip = False
+    for index, arg in enumerate(args):
+        if skip:
+            skip = False
+            continue
+        if arg in UNCACHEABLE_FLAGS or arg.startswith('-Wp,-M') or \
+                arg.startswith('-fprofile-') or arg == '-':
+            return None
+        if arg == '-o':
+            if index + 1 >= len(args):
+                return None
+            output = args[index + 1]
+            skip = True
+            continue
+        if arg.startswith('-o'):
+            output = arg[2:]
+            continue
+        if arg == '-c':
+            continue
+        if not arg.startswith('-') and arg.endswith(SOURCE_SUFFIXES):
+            sources.append(arg)
+        pp_args.append(arg)
+    if len(sources) != 1:
+        return None
+    if output is None:
+        output = os.path.splitext(os.path.basename(sources[0]))[0] + '.o'
+    return sources[0], output, pp_args
+
+
+def compiler_identity(compiler):
+    path = shutil.which(compiler) or compiler
+    try:
+        st = os.stat(path)
+    except OSError:
+        return compiler
+    return '{}:{}:{}'.format(os.path.realpath(path), st.st_size,
+                             int(st.st_mtime))
+
+
+def cached_compile(compiler_args):
+    objects_dir = os.environ.get('CC_CACHE_DIR') or os.path.join(
+        compiler_cache_directory(), 'objects')
+    compiler, args = compiler_args[0], compiler_args[1:]
+    try:
+        os.makedirs(objects_dir, exist_ok=True)
+    except OSError:
+        return subprocess.call(compiler_args)
+
+    plan = compile_plan(args)
+    if plan is None:
+        record(objects_dir, 'uncacheable')
+        return subprocess.call(compiler_args)
+    source, output, pp_args = plan
+
+    pp = subprocess.Popen([compiler] + pp_args + ['-E'],
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    preprocessed = pp.communicate()[0]
+    if pp.returncode != 0:
+        record(objects_dir, 'uncacheable')
+        return subprocess.call(compiler_args)
+
+    key = hashlib.sha256()
+    key.update(compiler_identity(compiler).encode('utf-8'))
+    key.update('\0'.join(pp_args).encode('utf-8'))
+    key.update(b'\0')
+    key.update(preprocessed)
+    digest = key.hexdigest()
+    object_path = os.path.join(objects_dir, digest[:2], digest + '.o')
+
+    try:
+        shutil.copyfile(object_path, output)
+    except IOError:
+        # Not cached, or evicted meanwhile by a parallel job
+        pass
+    else:
+        try:
+            # The mtime is the last use for the eviction
+            os.utime(object_path)
+        except OSError:
+            pass
+        record(objects_dir, 'hit')
+        return 0
+
+    status = subprocess.call(compiler_args)
+    if status == 0 and os.path.isfile(output):
+        stored = 0
+        try:
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(object_path))
+            os.close(fd)
+            shutil.copyfile(output, tmp_path)
+            os.replace(tmp_path, object_path)
+            stored = os.path.getsize(object_path)
+        except OSError:
+            pass
+        record(objects_dir, 'miss', stored)
+    return status
+
+
+def main(argv):
+    if len(argv) == 3 and argv[1] == '--shell-env':
+        env = compiler_cache_env(argv[2])
+        for var in ('CC', 'CXX', 'CCACHE_DIR', 'CC_CACHE_DIR'):
+            if var in env and env[var] != os.environ.get(var):
+                print('{}={}; export {}'.format(var, shlex.quote(env[var]),
+                                                var))
+        exit(0)
+    elif len(argv) == 3 and argv[1] == '--stats':
+        print_cache_stats(cache_stats(compiler_cache_env(argv[2])))
+        exit(0)
+    elif len(argv) < 2 or argv[1].startswith('-'):
+        print(__doc__.strip())
+        exit(1)
+    exit(cached_compile(argv[1:]))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+'''
+Shared autoconf config.cache for the configure runs of py34_install.py and
+kerl.
+
+configure probes the same compiler and libc features on every build; given
+a cache file it reads the answers of an earlier run instead. One cache is
+kept per product, distribution, architecture, compiler, configure options
+and precious variables (CC, CFLAGS, ...), together with a stamp of the
+toolchain it was made with: the compiler binary and the versions of the
+installed -dev packages. When the stamp no longer matches the cache is
+dropped, so a new compiler or library is probed again.
+
+Every build configures with a private copy of the cache, which replaces
+the shared one only when configure succeeded. configure itself still
+checks the precious variables recorded in the cache against the
+environment.
+
+    config_cache.py [--cache-dir DIR] prepare PRODUCT CACHE_FILE
+        [--configure-options OPTIONS]
+    config_cache.py [--cache-dir DIR] save PRODUCT CACHE_FILE SECONDS
+    config_cache.py [--cache-dir DIR] drop PRODUCT CACHE_FILE
+'''
+import os
+import sys
+import json
+import fcntl
+import argparse
+import tempfile
+
+import build_cache
+import build_utils
+import cc_cache
+import distro_info
+
+CONFIG_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.config-cache')
+
+CACHE_NAME = 'config.cache'
+META_NAME = 'meta.json'
+STATE_SUFFIX = '.state.json'
+
+# The precious variables of autoconf: configure refuses a cache made with
+# other values of them, so each set of values gets a cache of its own
+PRECIOUS_VARIABLES = ('CC', 'CFLAGS', 'LDFLAGS', 'LIBS', 'CPPFLAGS', 'CPP',
+                      'CXX', 'CXXFLAGS', 'CCC', 'CXXCPP', 'PKG_CONFIG',
+                      'PKG_CONFIG_PATH', 'PKG_CONFIG_LIBDIR')
+
+# Options that only say where the install goes, not what configure finds
+LOCATION_OPTIONS = ('--prefix=', '--exec-prefix=')
+
+DPKG_STATUS = '/var/lib/dpkg/status'
+
+
+def config_cache_directory(cache_dir=None):
+    return cache_dir or os.environ.get('CONFIG_CACHE_DIR', CONFIG_CACHE_DIR)
+
+
+def dev_package_versions(status_filepath=None, packages=None):
+    # {package: version} of the installed -dev packages, all of them or
+    # those in packages; empty without a dpkg status file
+    try:
+        return build_utils.dpkg_installed_versions(
+            status_filepath or os.environ.get('PY34_DPKG_STATUS',
+                                              DPKG_STATUS),
+            packages or None,
+            lambda package: package.split(':')[0].endswith('-dev'))
+    except IOError:
+        return {}
+
+
+def real_compiler(env=None):
+    # The compiler behind CC, also when it goes through a compiler cache
+    words = (env or os.environ).get('CC', 'cc').split()
+    for word in words:
+        name = os.path.basename(word)
+        if name != 'ccache' and not name.startswith('python') and \
+                not name.startswith('cc_cache'):
+            return word
+    return 'cc'
+
+
+def toolchain_stamp(compiler_version, dev_packages, env=None):
+    return {'compiler': compiler_version,
+            'compiler_binary': cc_cache.compiler_identity(
+                real_compiler(env)),
+            'dev_packages': dev_packages}
+
+
+def stamp_changes(before, after):
+    changes = []
+    for key in ('compiler', 'compiler_binary'):
+        if before.get(key) != after.get(key):
+            changes.append('{}: {} -> {}'.format(key, before.get(key),
+                                                 after.get(key)))
+    old = before.get('dev_packages', {})
+    new = after.get('dev_packages', {})
+    for package in sorted(set(old) | set(new)):
+        if old.get(package) != new.get(package):
+            changes.append('{}: {} -> {}'.format(
+                package, old.get(package, 'not installed'),
+                new.get(package, 'not installed')))
+    return changes
+
+
+def configure_parts(options=(), env=None):
+    env = os.environ if env is None else env
+    return {'configure_options': [option for option in options
+                                  if not option.startswith(LOCATION_OPTIONS)],
+            'precious': dict((name, env[name]) for name in PRECIOUS_VARIABLES
+                             if name in env)}
+
+
+def cache_key(product, distro, compiler_version, options=(), env=None):
+    parts = {'product': product}
+    parts.update(build_cache.toolchain_parts(distro, compiler_version))
+    parts.update(configure_parts(options, env))
+    return build_cache.cache_key(parts)[:16]
+
+
+def entry_directory(key, cache_dir=None):
+    return os.path.join(config_cache_directory(cache_dir), key)
+
+
+def read_meta(directory):
+    try:
+        with open(os.path.join(directory, META_NAME)) as meta_file:
+            return json.load(meta_file)
+    except (IOError, ValueError):
+        return None
+
+
+def write_file(filepath, data):
+    fd, tmp_filepath = tempfile.mkstemp(prefix='.config-cache-',
+                                        dir=os.path.dirname(filepath))
+    with os.fdopen(fd, 'w') as tmp_file:
+        tmp_file.write(data)
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp_filepath, 0o666 & ~umask)
+    os.replace(tmp_filepath, filepath)
+
+
+def entry_lock(directory):
+    lock_file = open(os.path.join(directory, '.lock'), 'a')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+
+def prepare(key, stamp, cache_file, cache_dir=None):
+    # Copies the shared cache to cache_file when it was made with the same
+    # toolchain; returns the state save() needs, with status hit, miss or
+    # invalidated (and the changes that invalidated it)
+    directory = entry_directory(key, cache_dir)
+    state = {'key': key, 'stamp': stamp, 'status': 'miss', 'changes': []}
+    if os.path.exists(cache_file):
+        os.unlink(cache_file)
+    if not os.path.exists(directory):
+        return state
+
+    with entry_lock(directory):
+        meta = read_meta(directory)
+        shared = os.path.join(directory, CACHE_NAME)
+        if meta is None or not os.path.exists(shared):
+            return state
+        state['changes'] = stamp_changes(meta['stamp'], stamp)
+        if state['changes']:
+            os.unlink(shared)
+            state['status'] = 'invalidated'
+            return state
+        with open(shared) as cached:
+            data = cached.read()
+    write_file(cache_file, data)
+    state['status'] = 'hit'
+    return state
+
+
+def drop(state, cache_dir=None):
+    # After configure failed with the cache: the next run probes again
+    shared = os.path.join(entry_directory(state['key'], cache_dir),
+                          CACHE_NAME)
+    if os.path.exists(shared):
+        os.unlink(shared)
+
+
+def save(state, cache_file, seconds, cache_dir=None):
+    # Stores the cache_file of a successful configure as the shared cache;
+    # returns the entry metadata with the seconds this run saved, when it
+    # used the cache and an earlier run without it was timed
+    directory = entry_directory(state['key'], cache_dir)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    with entry_lock(directory):
+        meta = read_meta(directory) or {'hits': 0, 'seconds_saved': 0.0,
+                                        'cold_seconds': None}
+        meta['stamp'] = state['stamp']
+        meta['saved'] = None
+        if state['status'] == 'hit':
+            meta['hits'] += 1
+            if meta['cold_seconds'] is not None:
+                meta['saved'] = round(max(0.0, meta['cold_seconds'] -
+                                          seconds), 3)
+                meta['seconds_saved'] = round(meta['seconds_saved'] +
+                                              meta['saved'], 3)
+        else:
+            meta['cold_seconds'] = round(seconds, 3)
+        if os.path.exists(cache_file):
+            with open(cache_file) as configured:
+                write_file(os.path.join(directory, CACHE_NAME),
+                           configured.read())
+        write_file(os.path.join(directory, META_NAME),
+                   json.dumps(meta, indent=2, sort_keys=True))
+    return meta
+
+
+def describe(state, meta, seconds):
+    if state['status'] != 'hit':
+        reason = ' ({})'.format(', '.join(state['changes'])) \
+            if state['changes'] else ''
+        return 'Config cache: {}{}, configure took {:.1f}s and filled ' \
+            'it'.format(state['status'], reason, seconds)
+    if meta['saved'] is None:
+        return 'Config cache: hit, configure took {:.1f}s'.format(seconds)
+    return 'Config cache: hit, configure took {:.1f}s, {:.1f}s less than ' \
+        'without it ({:.1f}s saved so far)'.format(
+            seconds, meta['saved'], meta['seconds_saved'])
+
+
+def product_toolchain(product, options=()):
+    # (cache key, toolchain stamp) of this host and these configure
+    # options, for kerl
+    compiler = build_utils.compiler_version()
+    return (cache_key(product, distro_info.get_distro_information(), compiler,
+                      options),
+            toolchain_stamp(compiler, dev_package_versions()))
+
+
+def main(args):
+    state_filepath = args.cache_file + STATE_SUFFIX
+    if args.command == 'prepare':
+        key, stamp = product_toolchain(args.product,
+                                       args.configure_options.split())
+        state = prepare(key, stamp, os.path.abspath(args.cache_file),
+                        args.cache_dir)
+        with open(state_filepath, 'w') as state_file:
+            json.dump(state, state_file)
+    else:
+        try:
+            with open(state_filepath) as state_file:
+                state = json.load(state_file)
+        except (IOError, ValueError):
+            print('No {}, run prepare first'.format(state_filepath),
+                  file=sys.stderr)
+            exit(1)
+        if args.command == 'drop':
+            drop(state, args.cache_dir)
+        else:
+            meta = save(state, args.cache_file, args.seconds,
+                        args.cache_dir)
+            print(describe(state, meta, args.seconds))
+        os.unlink(state_filepath)
+    exit(0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='config-cache',
+                                     description='Shared autoconf '
+                                                 'config.cache')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='(default: $CONFIG_CACHE_DIR or {})'.format(
+                            CONFIG_CACHE_DIR))
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    prepare_parser = commands.add_parser('prepare', help='copy the shared '
+                                                         'cache to the '
+                                                         'cache file')
+    prepare_parser.add_argument('product', type=str)
+    prepare_parser.add_argument('cache_file', type=str)
+    prepare_parser.add_argument('--configure-options', type=str, default='',
+                                help='the options configure runs with')
+
+    save_parser = commands.add_parser('save', help='store the cache file of '
+                                                   'a successful configure')
+    save_parser.add_argument('product', type=str)
+    save_parser.add_argument('cache_file', type=str)
+    save_parser.add_argument('seconds', type=float,
+                             help='how long configure took')
+
+    drop_parser = commands.add_parser('drop', help='drop the shared cache '
+                                                   'after configure failed')
+    drop_parser.add_argument('product', type=str)
+    drop_parser.add_argument('cache_file', type=str)
+
+    main(parser.parse_args())
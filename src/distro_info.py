@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+'''
+Distribution detection, as lsb_release does it: /etc/os-release and
+/etc/lsb-release, falling back to the Debian version files and apt-cache
+policy. Shared by py34_install.py and the build and configure caches, whose
+keys carry the distribution.
+
+With PY34_DISTRO_CACHE set, what is detected is kept in that file until one
+of the files it was detected from changes.
+'''
+import os
+import re
+import sys
+import json
+import warnings
+import subprocess
+
+# This should really be included in apt-cache policy output... it is already
+# in the Release file...
+RELEASE_CODENAME_LOOKUP = {
+    '1.1': 'buzz',
+    '1.2': 'rex',
+    '1.3': 'bo',
+    '2.0': 'hamm',
+    '2.1': 'slink',
+    '2.2': 'potato',
+    '3.0': 'woody',
+    '3.1': 'sarge',
+    '4.0': 'etch',
+    '5.0': 'lenny',
+    '6.0': 'squeeze',
+    '7.0': 'wheezy',
+    '8.0': 'jessie',
+    '8.1': 'jessie',
+    }
+
+TESTING_CODENAME = 'unknown.new.testing'
+
+RELEASES_ORDER = list(RELEASE_CODENAME_LOOKUP.items())
+RELEASES_ORDER.sort()
+RELEASES_ORDER = list(list(zip(*RELEASES_ORDER))[1])
+RELEASES_ORDER.extend(['stable', 'testing', 'unstable', 'sid'])
+
+
+releasere = re.compile(r'(\d+)\.(\d+)(r(\d+))?')
+
+
+def lookup_codename(release, unknown=None):
+    m = releasere.match(release)
+    if not m:
+        return unknown
+
+    shortrelease = '%s.%s' % m.group(1, 2)
+    return RELEASE_CODENAME_LOOKUP.get(shortrelease, unknown)
+
+# LSB compliance packages... may grow eventually
+PACKAGES = 'lsb-core lsb-cxx lsb-graphics lsb-desktop ' \
+    'lsb-languages lsb-multimedia lsb-printing lsb-security'
+
+modnamere = re.compile(r'lsb-(?P<module>[a-z0-9]+)-(?P<arch>[^ ]+)'
+                       r'(?: \(= (?P<version>[0-9.]+)\))?')
+
+
+def valid_lsb_versions(version, module):
+    # If a module is ever released that only appears in >= version, deal
+    # with that here
+    if version == '3.0':
+        return ['2.0', '3.0']
+    elif version == '3.1':
+        if module in ('desktop', 'qt4'):
+            return ['3.1']
+        elif module == 'cxx':
+            return ['3.0', '3.1']
+        else:
+            return ['2.0', '3.0', '3.1']
+    elif version == '3.2':
+        if module == 'desktop':
+            return ['3.1', '3.2']
+        elif module == 'qt4':
+            return ['3.1']
+        elif module in ('printing', 'languages', 'multimedia'):
+            return ['3.2']
+        elif module == 'cxx':
+            return ['3.0', '3.1', '3.2']
+        else:
+            return ['2.0', '3.0', '3.1', '3.2']
+    elif version == '4.0':
+        if module == 'desktop':
+            return ['3.1', '3.2', '4.0']
+        elif module == 'qt4':
+            return ['3.1']
+        elif module in ('printing', 'languages', 'multimedia'):
+            return ['3.2', '4.0']
+        elif module == 'security':
+            return ['4.0']
+        elif module == 'cxx':
+            return ['3.0', '3.1', '3.2', '4.0']
+        else:
+            return ['2.0', '3.0', '3.1', '3.2', '4.0']
+    elif version == '4.1':
+        if module == 'desktop':
+            return ['3.1', '3.2', '4.0', '4.1']
+        elif module == 'qt4':
+            return ['3.1']
+        elif module in ('printing', 'languages', 'multimedia'):
+            return ['3.2', '4.0', '4.1']
+        elif module == 'security':
+            return ['4.0', '4.1']
+        elif module == 'cxx':
+            return ['3.0', '3.1', '3.2', '4.0', '4.1']
+        else:
+            return ['2.0', '3.0', '3.1', '3.2', '4.0', '4.1']
+
+    return [version]
+
+
+# This is Debian-specific at present
+def check_modules_installed():
+    # Find which LSB modules are installed on this system
+    C_env = os.environ.copy()
+    C_env['LC_ALL'] = 'C'
+
+    output = subprocess.Popen(['dpkg-query', '-f',
+                               "${Version} ${Provides}\n", '-W'] +
+                              PACKAGES.split(),
+                              env=C_env,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE,
+                              close_fds=True).communicate()[0].decode('utf-8')
+
+    if not output:
+        return []
+
+    modules = set()
+    for line in output.split(os.linesep):
+        if not line:
+            break
+
+        version, provides = line.split(' ', 1)
+        # Debian package versions can be 3.2-$REV, 3.2+$REV or 3.2~$REV.
+        version = re.split('[-+~]', version, 1)[0]
+        for pkg in provides.split(','):
+            mob = modnamere.search(pkg)
+            if not mob:
+                continue
+
+            mgroups = mob.groupdict()
+            # If no versioned provides...
+            if mgroups.get('version'):
+                module = '%(module)s-%(version)s-%(arch)s' % mgroups
+                modules.add(module)
+            else:
+                module = mgroups['module']
+                for v in valid_lsb_versions(version, module):
+                    mgroups['version'] = v
+                    module = '%(module)s-%(version)s-%(arch)s' % mgroups
+                    modules.add(module)
+
+    modules = list(modules)
+    modules.sort()
+    return modules
+
+longnames = {'v': 'version', 'o': 'origin', 'a': 'suite',
+             'c': 'component', 'l': 'label'}
+
+
+def parse_policy_line(data):
+    retval = {}
+    bits = data.split(',')
+    for bit in bits:
+        kv = bit.split('=', 1)
+        if len(kv) > 1:
+            k, v = kv[:2]
+            if k in longnames:
+                retval[longnames[k]] = v
+    return retval
+
+
+def release_index(x):
+    suite = x[1].get('suite')
+    if suite:
+        if suite in RELEASES_ORDER:
+            return int(len(RELEASES_ORDER) - RELEASES_ORDER.index(suite))
+        else:
+            return suite
+    return 0
+
+
+def compare_release(x, y):
+    warnings.warn('compare_release(x,y) is deprecated; '
+                  'please use the release_index(x) as key for sort() instead.',
+                  DeprecationWarning, stacklevel=2)
+
+    suite_x_i = release_index(x)
+    suite_y_i = release_index(y)
+
+    try:
+        return suite_x_i - suite_y_i
+    except TypeError:
+        return (suite_x_i > suite_y_i) - (suite_x_i < suite_y_i)
+
+
+priorityre = re.compile(r'-?\d+')
+
+
+def parse_apt_policy():
+    data = []
+
+    C_env = os.environ.copy()
+    C_env['LC_ALL'] = 'C'
+
+    policy = subprocess.Popen(['apt-cache', 'policy'],
+                              env=C_env,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE,
+                              close_fds=True).communicate()[0].decode('utf-8')
+
+    for line in policy.split('\n'):
+        line = line.strip()
+        m = priorityre.match(line)
+        if m:
+            priority = int(m.group(0))
+        if line.startswith('release'):
+            bits = line.split(' ', 1)
+            if len(bits) > 1:
+                data.append((priority, parse_policy_line(bits[1])))
+
+    return data
+
+
+FTP_DEBIAN = 'ftp.debian-ports.org'
+
+
+def guess_release_from_apt(origin='Debian', component='main',
+                           ignoresuites=('experimental'),
+                           label='Debian',
+                           alternate_olabels={'Debian Ports': FTP_DEBIAN}):
+    releases = parse_apt_policy()
+
+    if not releases:
+        return None
+
+    # We only care about the specified origin, component, and label
+    releases = [x for x in releases if (
+        x[1].get('origin', '') == origin and
+        x[1].get('component', '') == component and
+        x[1].get('label', '') == label) or (
+        x[1].get('origin', '') in alternate_olabels and
+        x[1].get('label', '') ==
+            alternate_olabels.get(x[1].get('origin', '')))]
+
+    # Check again to make sure we didn't wipe out all of the releases
+    if not releases:
+        return None
+
+    releases.sort(key=lambda tpl: tpl[0], reverse=True)
+
+    # We've sorted the list by descending priority, so the first entry should
+    # be the "main" release in use on the system
+
+    max_priority = releases[0][0]
+    releases = [x for x in releases if x[0] == max_priority]
+    releases.sort(key=release_index)
+
+    return releases[0][1]
+
+
+def guess_debian_release():
+    distinfo = {}
+
+    distinfo['ID'] = 'Debian'
+    # Use /etc/dpkg/origins/default to fetch the distribution name
+    etc_dpkg_origins_default = os.environ.get('LSB_ETC_DPKG_ORIGINS_DEFAULT',
+                                              '/etc/dpkg/origins/default')
+
+    if os.path.exists(etc_dpkg_origins_default):
+        try:
+            with open(etc_dpkg_origins_default) as dpkg_origins_file:
+                for line in dpkg_origins_file:
+                    try:
+                        (header, content) = line.split(': ', 1)
+                        header = header.lower()
+                        content = content.strip()
+                        if header == 'vendor':
+                            distinfo['ID'] = content
+                    except ValueError:
+                        pass
+        except IOError as msg:
+            print('Unable to open ' + etc_dpkg_origins_default + ':', str(msg),
+                  file=sys.stderr)
+
+    kern = os.uname()[0]
+    if kern in ('Linux', 'Hurd', 'NetBSD'):
+        distinfo['OS'] = 'GNU/'+kern
+    elif kern == 'FreeBSD':
+        distinfo['OS'] = 'GNU/k'+kern
+    elif kern in ('GNU/Linux', 'GNU/kFreeBSD'):
+        distinfo['OS'] = kern
+    else:
+        distinfo['OS'] = 'GNU'
+
+    distinfo['DESCRIPTION'] = '%(ID)s %(OS)s' % distinfo
+
+    etc_debian_version = os.environ.get('LSB_ETC_DEBIAN_VERSION',
+                                        '/etc/debian_version')
+    if os.path.exists(etc_debian_version):
+        try:
+            with open(etc_debian_version) as debian_version:
+                release = debian_version.read().strip()
+        except IOError as msg:
+            print('Unable to open ' + etc_debian_version + ':', str(msg),
+                  file=sys.stderr)
+            release = 'unknown'
+
+        if not release[0:1].isalpha():
+            # /etc/debian_version should be numeric
+            codename = lookup_codename(release, 'n/a')
+            distinfo.update({'RELEASE': release, 'CODENAME': codename})
+        elif release.endswith('/sid'):
+            if release.rstrip('/sid').lower().isalpha() != 'testing':
+                global TESTING_CODENAME
+                TESTING_CODENAME = release.rstrip('/sid')
+            distinfo['RELEASE'] = 'testing/unstable'
+        else:
+            distinfo['RELEASE'] = release
+
+    # Only use apt information if we did not get the proper information
+    # from /etc/debian_version or if we don't have a codename
+    # (which will happen if /etc/debian_version does not contain a
+    # number but some text like 'testing/unstable' or 'lenny/sid')
+    #
+    # This is slightly faster and less error prone in case the user
+    # has an entry in his /etc/apt/sources.list but has not actually
+    # upgraded the system.
+    if not distinfo.get('CODENAME'):
+        rinfo = guess_release_from_apt()
+        if rinfo:
+            release = rinfo.get('version')
+
+        # Special case Debian-Ports as their Release file has 'version': '1.0'
+        if release == '1.0' and rinfo.get('origin') == 'Debian Ports' and \
+                rinfo.get('label') == 'ftp.debian-ports.org':
+            release = None
+            rinfo.update({'suite': 'unstable'})
+
+        if release:
+            codename = lookup_codename(release, 'n/a')
+        else:
+            release = rinfo.get('suite', 'unstable')
+            if release == 'testing':
+                # Would be nice if I didn't have to hardcode this.
+                codename = TESTING_CODENAME
+            else:
+                codename = 'sid'
+        distinfo.update({'RELEASE': release, 'CODENAME': codename})
+
+    if distinfo.get('RELEASE'):
+        distinfo['DESCRIPTION'] += ' %(RELEASE)s' % distinfo
+    if distinfo.get('CODENAME'):
+        distinfo['DESCRIPTION'] += ' (%(CODENAME)s)' % distinfo
+
+    return distinfo
+
+
+# Whatever is guessed above can be overridden in /etc/lsb-release
+def get_lsb_information():
+    distinfo = {}
+    etc_lsb_release = os.environ.get('LSB_ETC_LSB_RELEASE', '/etc/lsb-release')
+    if os.path.exists(etc_lsb_release):
+        try:
+            with open(etc_lsb_release) as lsb_release_file:
+                for line in lsb_release_file:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    # Skip invalid lines
+                    if '=' not in line:
+                        continue
+                    var, arg = line.split('=', 1)
+                    if var.startswith('DISTRIB_'):
+                        var = var[8:]
+                        if arg.startswith('"') and arg.endswith('"'):
+                            arg = arg[1:-1]
+                        if arg:  # Ignore empty arguments
+                            distinfo[var] = arg.strip()
+        except IOError as msg:
+            print('Unable to open ' + etc_lsb_release + ':', str(msg),
+                  file=sys.stderr)
+
+    return distinfo
+
+
+# os-release IDs and the names lsb_release reports for them
+OS_RELEASE_IDS = {'debian': 'Debian', 'ubuntu': 'Ubuntu'}
+
+
+def get_os_release_information():
+    distinfo = {}
+    etc_os_release = os.environ.get('LSB_ETC_OS_RELEASE', '/etc/os-release')
+    if not os.path.exists(etc_os_release):
+        return distinfo
+
+    fields = {}
+    try:
+        with open(etc_os_release) as os_release_file:
+            for line in os_release_file:
+                line = line.strip()
+                if not line or line.startswith('#') or '=' not in line:
+                    continue
+                var, arg = line.split('=', 1)
+                if len(arg) > 1 and arg[0] == arg[-1] and arg[0] in '"\'':
+                    arg = arg[1:-1]
+                fields[var] = arg
+    except IOError as msg:
+        print('Unable to open ' + etc_os_release + ':', str(msg),
+              file=sys.stderr)
+        return distinfo
+
+    if fields.get('ID'):
+        distinfo['ID'] = OS_RELEASE_IDS.get(fields['ID'],
+                                            fields['ID'].capitalize())
+    if fields.get('VERSION_ID'):
+        distinfo['RELEASE'] = fields['VERSION_ID']
+    codename = fields.get('VERSION_CODENAME') or \
+        fields.get('UBUNTU_CODENAME')
+    if codename:
+        distinfo['CODENAME'] = codename
+    if fields.get('PRETTY_NAME'):
+        distinfo['DESCRIPTION'] = fields['PRETTY_NAME']
+
+    # os-release only has the major version on Debian (8, not 8.1), while
+    # DEPS and lsb_release use the point release from /etc/debian_version
+    if distinfo.get('ID') == 'Debian':
+        etc_debian_version = os.environ.get('LSB_ETC_DEBIAN_VERSION',
+                                            '/etc/debian_version')
+        try:
+            with open(etc_debian_version) as debian_version:
+                release = debian_version.read().strip()
+        except IOError:
+            release = ''
+        if release[0:1].isdigit():
+            distinfo['RELEASE'] = release
+        elif release.endswith('/sid'):
+            distinfo['RELEASE'] = 'testing/unstable'
+
+    return distinfo
+
+
+def detect_distro_information():
+    # /etc/os-release and /etc/lsb-release are enough on any recent system,
+    # apt-cache policy is only asked when they leave something out
+    distinfo = get_os_release_information()
+    distinfo.update(get_lsb_information())
+    # OS is only used inside guess_debian_release anyway
+    for key in ('ID', 'RELEASE', 'CODENAME', 'DESCRIPTION',):
+        if key not in distinfo:
+            guessed = guess_debian_release()
+            guessed.update(distinfo)
+            return guessed
+    else:
+        return distinfo
+
+
+def distro_cache_sources():
+    return (os.environ.get('LSB_ETC_OS_RELEASE', '/etc/os-release'),
+            os.environ.get('LSB_ETC_LSB_RELEASE', '/etc/lsb-release'),
+            os.environ.get('LSB_ETC_DEBIAN_VERSION', '/etc/debian_version'),
+            os.environ.get('LSB_ETC_DPKG_ORIGINS_DEFAULT',
+                           '/etc/dpkg/origins/default'),
+            os.environ.get('PY34_APT_LISTS', '/var/lib/apt/lists'))
+
+
+def distro_cache_stamp():
+    stamp = {}
+    for path in distro_cache_sources():
+        try:
+            stamp[path] = os.stat(path).st_mtime
+        except OSError:
+            stamp[path] = None
+    return stamp
+
+
+def read_distro_cache(cache_filepath):
+    try:
+        with open(cache_filepath) as cache_file:
+            cached = json.load(cache_file)
+    except (IOError, ValueError):
+        return None
+    if not isinstance(cached, dict) or \
+            cached.get('stamp') != distro_cache_stamp():
+        return None
+    return cached.get('distinfo')
+
+
+def write_distro_cache(cache_filepath, distinfo):
+    tmp_filepath = '{}.{}.tmp'.format(cache_filepath, os.getpid())
+    try:
+        with open(tmp_filepath, 'w') as cache_file:
+            json.dump({'stamp': distro_cache_stamp(), 'distinfo': distinfo},
+                      cache_file, sort_keys=True)
+        os.replace(tmp_filepath, cache_filepath)
+    except (IOError, OSError) as msg:
+        print('Unable to write ' + cache_filepath + ':', str(msg),
+              file=sys.stderr)
+
+
+_distro_information = None
+
+
+def get_distro_information():
+    # Detected once per process; with PY34_DISTRO_CACHE set, also kept on
+    # disk until one of the files it was detected from changes
+    global _distro_information
+    if _distro_information is None:
+        cache_filepath = os.environ.get('PY34_DISTRO_CACHE')
+        distinfo = read_distro_cache(cache_filepath) \
+            if cache_filepath else None
+        if not distinfo:
+            distinfo = detect_distro_information()
+            if cache_filepath:
+                write_distro_cache(cache_filepath, distinfo)
+        _distro_information = distinfo
+    return dict(_distro_information)
@@ -1,16 +1,27 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -o- coding: utf-8 -o-
 '''
 Created on 26/09/2013
 @author: Carlo Pires <carlopires@gmail.com>
 '''
-import os, argparse
+import os, sys, json, time, sqlite3, hashlib, argparse
 from subprocess import call, check_output, Popen, PIPE
 
+from build_utils import usable_cpu_count, run_with_job_budget, format_bytes, MIN_JOBS_PER_BUILD
+import cc_cache
+import config_cache
+import registry
+
 ERLANG_DOWNLOAD_URL='http://www.erlang.org/download'
 ERLANG_RELEASE='R15B02'
 ERLANG_DIRECTORY='erlang'
 
+KERL = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'utils', 'kerl')
+
+BUILD_TIMEOUT = 4 * 3600
+INSTALL_TIMEOUT = 1800
+PREFETCH_TIMEOUT = 3600
+
 def user_home():
     return os.path.expanduser('~')
 
@@ -26,28 +37,246 @@ def erlang_home():
 def erlang_release_home(release):
     return os.path.sep.join((erlang_home(), release.lower()))
 
-def main(erlang_release, erlang_directory):
+def erlang_logs_directory():
+    return os.path.sep.join((erlang_home(), 'logs'))
+
+def kerl_base_directory():
+    return os.path.sep.join((user_home(), '.kerl'))
+
+def kerl_built(release, name):
+    # kerl records its builds in the registry; the otp_builds of an older kerl is imported first
+    try:
+        connection = registry.connect()
+        if any(os.path.exists(os.path.sep.join((kerl_base_directory(), list_name))) for list_name in registry.KERL_LISTS):
+            registry.import_kerl(connection, kerl_base_directory())
+        build = registry.find_build(connection, 'erlang', name)
+    except (sqlite3.Error, IOError, OSError) as msg:
+        print('Could not read the build registry ({}), kerl will tell'.format(msg))
+        return False
+    return build is not None and build['release'] == release
+
+def build_name(release, applications=None):
+    if not applications:
+        return release.lower()
+    # Builds of other applications must not pass for this one
+    return '{}-{}'.format(release.lower(), hashlib.sha1(' '.join(sorted(set(applications))).encode('utf-8')).hexdigest()[:8])
+
+def installed_applications(directory):
+    lib = os.path.sep.join((directory, 'lib'))
+    if not os.path.isdir(lib):
+        return []
+    return sorted(name.rsplit('-', 1)[0] for name in os.listdir(lib))
+
+def full_build_reference(connection, release):
+    # (seconds, install size) of the full builds of release in the registry: the slowest build, the others
+    # were restored from the build cache, and the largest install
+    seconds = size = None
+    for build in registry.find_builds(connection, 'erlang', release):
+        if build['applications']:
+            continue
+        if build['seconds'] and (seconds is None or build['seconds'] > seconds):
+            seconds = build['seconds']
+        for installation in registry.find_installations(connection, 'erlang', build['name']):
+            if installation['size'] and (size is None or installation['size'] > size):
+                size = installation['size']
+    return seconds, size
+
+def minimal_build_savings(result):
+    # Build time and install size of a minimal build, and of a full build of the same release to compare with
+    savings = {'applications': installed_applications(result['directory']), 'seconds': None, 'size': None,
+               'full_seconds': None, 'full_size': None}
+    try:
+        connection = registry.connect()
+        build = registry.find_build(connection, 'erlang', result['name'])
+        installation = registry.find_installation(connection, result['directory'])
+        savings['full_seconds'], savings['full_size'] = full_build_reference(connection, result['release'])
+    except (sqlite3.Error, IOError, OSError) as msg:
+        print('Could not read the build registry ({}), no savings to report'.format(msg))
+        return savings
+    savings['seconds'] = build and build['seconds']
+    savings['size'] = installation and installation['size']
+    return savings
+
+def run_kerl(kerl, args, log_filepath, timeout, env=None):
+    start = time.monotonic()
+    with open(log_filepath, 'a') as output:
+        output.write('$ kerl {}\n'.format(' '.join(args)))
+        output.flush()
+        try:
+            status = call([kerl] + args, stdout=output, stderr=output, env=env, timeout=timeout)
+        except Exception as msg:
+            output.write('{}\n'.format(msg))
+            status = None
+    return status, round(time.monotonic() - start, 1)
+
+def build_release(kerl, release, directory, jobs, build_env=None, applications=None):
+    name = build_name(release, applications)
+    log_filepath = os.path.sep.join((erlang_logs_directory(), '{}-build.log'.format(name)))
+    result = {'release': release, 'name': name, 'directory': directory,
+              'jobs': jobs, 'status': 'failed', 'build_seconds': None,
+              'install_seconds': None, 'already_built': False,
+              'log': log_filepath}
+
+    with open(log_filepath, 'w'):
+        pass
+
+    if kerl_built(release, name):
+        result['build_seconds'] = 0.0
+        result['already_built'] = True
+    else:
+        # otp_build runs plain make, which takes its job count from MAKEFLAGS
+        env = dict(build_env or os.environ)
+        env['MAKEFLAGS'] = '-j{}'.format(jobs)
+        if applications:
+            # kerl builds them and what they depend on, resolved from the .app.src files of the source
+            env['KERL_TARGET_APPLICATIONS'] = ' '.join(applications)
+        status, seconds = run_kerl(kerl, ['build', release, name], log_filepath, BUILD_TIMEOUT, env)
+        result['build_seconds'] = seconds
+        if status != 0:
+            result['error'] = 'build failed'
+            return result
+
+    status, seconds = run_kerl(kerl, ['install', name, directory], log_filepath, INSTALL_TIMEOUT)
+    result['install_seconds'] = seconds
+    if status != 0:
+        result['error'] = 'install failed'
+        return result
+
+    result['status'] = 'ok'
+    if applications:
+        result['savings'] = minimal_build_savings(result)
+    return result
+
+def prefetch_releases(kerl, releases, applications=None):
+    # Downloads every archive still needed at once, with the MD5 index fetched a single time
+    needed = [release for release, directory in releases if not kerl_built(release, build_name(release, applications))]
+    if not needed:
+        return True
+    log_filepath = os.path.sep.join((erlang_logs_directory(), 'prefetch.log'))
+    with open(log_filepath, 'w'):
+        pass
+    print('Prefetching Erlang/OTP {}...'.format(', '.join(needed)))
+    sys.stdout.flush()
+    status, seconds = run_kerl(kerl, ['prefetch'] + needed, log_filepath, PREFETCH_TIMEOUT)
+    if status != 0:
+        print('Prefetch failed after {}s, see {}; the builds download what is missing'.format(seconds, log_filepath))
+    return status == 0
+
+def build_releases(kerl, releases, jobs_budget, max_parallel, build_env=None, applications=None):
+    def worker(item, jobs):
+        release, directory = item
+        print('Building Erlang/OTP {} with {} jobs...'.format(release, jobs))
+        sys.stdout.flush()
+        result = build_release(kerl, release, directory, jobs, build_env, applications)
+        print('Erlang/OTP {}: {}'.format(release, result['status'] if result['status'] == 'ok' else
+                                         '{}, see {}'.format(result['error'], result['log'])))
+        sys.stdout.flush()
+        return result
+
+    return run_with_job_budget(worker, releases, jobs_budget, max_parallel)
+
+def print_results(results):
+    print('Build summary:')
+    for result in results:
+        print('  {:12} {:6} jobs={:<3} build={:>8}s install={:>6}s  {}'.format(
+            result['release'], result['status'], result['jobs'],
+            result['build_seconds'] if result['build_seconds'] is not None else '-',
+            result['install_seconds'] if result['install_seconds'] is not None else '-',
+            result['directory']))
+
+def saving(value, full):
+    if value is None or not full:
+        return 'nothing to compare'
+    percent = round(100.0 * (full - value) / full)
+    return '{}% {}'.format(abs(percent), 'less' if percent >= 0 else 'more')
+
+def print_savings(results):
+    print('Minimal builds against a full build:')
+    for result in results:
+        savings = result.get('savings')
+        if not savings:
+            continue
+        if savings['full_seconds'] is None and savings['full_size'] is None:
+            print('  {:12} {} applications, no full build of {} in the registry to compare with'.format(
+                result['release'], len(savings['applications']), result['release']))
+            continue
+        print('  {:12} {} applications  build {}s instead of {}s ({})  install {} instead of {} ({})'.format(
+            result['release'], len(savings['applications']),
+            '-' if savings['seconds'] is None else '{:.0f}'.format(savings['seconds']),
+            '-' if savings['full_seconds'] is None else '{:.0f}'.format(savings['full_seconds']),
+            saving(savings['seconds'], savings['full_seconds']),
+            format_bytes(savings['size']), format_bytes(savings['full_size']),
+            saving(savings['size'], savings['full_size'])))
+
+def main(erlang_releases, erlang_directory, jobs, max_parallel, kerl, report, compiler_cache_dir=None, mirror=None, config_cache_dir=None,
+         applications=None):
     home = users_home()
-    
+
+    if mirror:
+        # kerl rewrites its download URL for the mirror
+        os.environ['KERL_MIRROR'] = mirror
+    if config_cache_dir:
+        # kerl configures from the shared config.cache in there
+        os.environ['KERL_CONFIG_CACHE_DIR'] = config_cache_dir
+
     if not os.path.exists(home):
         print('User home directory ({}) not found '.format(home))
         exit(1)
-      
+
     ehome = erlang_home()
-        
+
     if not os.path.exists(ehome):
         os.mkdir(ehome)
         print('Created erlang home directory: {}'.format(ehome))
-        
-    print('REL: ', erlang_release, '\n', 'DIR: ', erlang_directory)
-    
+
+    if not os.path.exists(erlang_logs_directory()):
+        os.mkdir(erlang_logs_directory())
+
+    if erlang_directory and len(erlang_releases) == 1:
+        releases = [(erlang_releases[0], erlang_directory)]
+    else:
+        releases = [(release, erlang_release_home(release)) for release in erlang_releases]
+
+    build_env = cache_stats = None
+    if compiler_cache_dir:
+        build_env = cc_cache.compiler_cache_env(compiler_cache_dir)
+        cache_stats = cc_cache.cache_stats(build_env)
+
+    prefetch_releases(kerl, releases, applications)
+    results = build_releases(kerl, releases, jobs, max_parallel, build_env, applications)
+    print_results(results)
+    if applications:
+        print_savings(results)
+
+    if build_env:
+        cc_cache.print_cache_stats(cc_cache.stats_delta(cache_stats, cc_cache.cache_stats(build_env)))
+
+    if report:
+        with open(report, 'w') as report_file:
+            json.dump(results, report_file, indent=2)
+
+    exit(0 if all(result['status'] == 'ok' for result in results) else 1)
+
 if __name__ == "__main__":
-    ehome = erlang_release_home(ERLANG_RELEASE)
-    
     parser = argparse.ArgumentParser(prog='einstall', description='Compile and install erlang')
-    parser.add_argument('--erlang-release', type=str, default=ERLANG_RELEASE, help='(default: {})'.format(ERLANG_RELEASE))
-    parser.add_argument('--erlang-directory', type=str, default=ehome, help='(default: {})'.format(ehome))
-    
+    parser.add_argument('--erlang-release', type=str, action='append', default=None, help='may be repeated to build several releases at once (default: {})'.format(ERLANG_RELEASE))
+    parser.add_argument('--erlang-directory', type=str, default=None, help='install directory of a single release (default: {})'.format(erlang_release_home('<release>')))
+    parser.add_argument('--jobs', '-j', type=int, default=usable_cpu_count(), help='make jobs shared by all builds (default: usable CPUs, {})'.format(usable_cpu_count()))
+    parser.add_argument('--max-parallel', type=int, default=None, help='releases built at the same time (default: as many as --jobs allows, {} jobs each)'.format(MIN_JOBS_PER_BUILD))
+    parser.add_argument('--kerl', type=str, default=KERL, help='(default: {})'.format(os.path.normpath(KERL)))
+    parser.add_argument('--report', type=str, default=None, help='write the build results as JSON to this file')
+    parser.add_argument('--mirror', type=str, default=os.environ.get('KERL_MIRROR'), metavar='URL', help='download the sources through this source_mirror.py server (default: $KERL_MIRROR)')
+    parser.add_argument('--compiler-cache', action='store_true', help='compile through ccache, or through the bundled object cache when ccache is not installed')
+    parser.add_argument('--compiler-cache-dir', type=str, default=cc_cache.compiler_cache_directory(), help='(default: $COMPILER_CACHE_DIR or {}, shared with py34_install.py and kerl)'.format(cc_cache.COMPILER_CACHE_DIR))
+    parser.add_argument('--config-cache', action='store_true', help='configure from a shared autoconf config.cache of this distribution, architecture and compiler, dropped when the compiler or the -dev packages change')
+    parser.add_argument('--config-cache-dir', type=str, default=config_cache.config_cache_directory(), help='(default: $CONFIG_CACHE_DIR or {}, shared with py34_install.py and kerl)'.format(config_cache.CONFIG_CACHE_DIR))
+    parser.add_argument('--application', type=str, action='append', default=None, metavar='APP', help='build only this OTP application and the ones it depends on (kernel and stdlib always), may be repeated; the savings against a full build of the release in the build registry are reported')
+
     args = parser.parse_args()
-    main(args.erlang_release, args.erlang_directory)
-    
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    max_parallel = args.max_parallel or max(1, args.jobs // MIN_JOBS_PER_BUILD)
+    main(args.erlang_release or [ERLANG_RELEASE], args.erlang_directory, args.jobs, max_parallel, args.kerl, args.report,
+         args.compiler_cache_dir if args.compiler_cache else None, args.mirror,
+         args.config_cache_dir if args.config_cache else None, args.application)
+
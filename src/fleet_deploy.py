@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+'''
+Push a finished build to many hosts at once.
+
+The install tree is copied with rsync to every host of an inventory by a
+bounded pool of workers, each host with its own timeout and retries, and an
+optional command is run in the copied tree afterwards (kerl's Erlang/OTP
+releases need ./Install to be run again at their new location). With
+--relay the local tree is sent in full only once: every host that already
+has the build becomes a source for the next ones.
+
+Hosts are ssh destinations ([user@]host), or directories standing in for
+hosts (any host starting with '/' or '.'), which is handy for testing.
+'''
+import os
+import sys
+import json
+import time
+import queue
+import shlex
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+DEPLOY_WORKERS = 8
+DEPLOY_TIMEOUT = 900
+DEPLOY_RETRIES = 2
+DEPLOY_BACKOFF = 5
+
+# The local tree, as opposed to a host that already received it
+ORIGIN = None
+
+
+def is_directory_host(host):
+    return host.startswith('/') or host.startswith('.')
+
+
+def read_inventory(filepath, default_path):
+    # One host per line, optionally followed by its own remote path
+    hosts = []
+    with open(filepath) as inventory:
+        for line in inventory:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            bits = line.split()
+            path = bits[1] if len(bits) > 1 else default_path
+            hosts.append((bits[0], path))
+    return hosts
+
+
+def host_path(host, path):
+    if is_directory_host(host):
+        return os.path.join(os.path.abspath(host), path.lstrip('/'))
+    return path
+
+
+def rsync_destination(host, path):
+    if is_directory_host(host):
+        return host_path(host, path) + '/'
+    return '{}:{}/'.format(host, path)
+
+
+def ssh_args(options, host):
+    return shlex.split(options.ssh_command) + \
+        shlex.split(options.ssh_options) + [host]
+
+
+def rsync_args(options):
+    return ['rsync', '-az', '--delete', '--partial', '--stats',
+            '-e', ' '.join([options.ssh_command, options.ssh_options])] + \
+        shlex.split(options.rsync_options)
+
+
+def transfer_args(options, source, host, path):
+    destination = rsync_destination(host, path)
+    if source is ORIGIN:
+        return rsync_args(options) + [options.artifact.rstrip('/') + '/',
+                                      destination]
+
+    source_host, source_path = source
+    if is_directory_host(source_host):
+        if not is_directory_host(host):
+            # A directory stand-in can only relay to another directory
+            return rsync_args(options) + [
+                options.artifact.rstrip('/') + '/', destination]
+        return rsync_args(options) + [
+            host_path(source_host, source_path) + '/', destination]
+
+    # Host to host: the source host pushes to the target itself
+    command = ' '.join(shlex.quote(arg) for arg in rsync_args(options) +
+                       [source_path + '/', destination])
+    return ssh_args(options, source_host) + [command]
+
+
+def post_command_args(options, host, path):
+    if is_directory_host(host):
+        return ['sh', '-c', options.post_command]
+    return ssh_args(options, host) + [
+        'cd {} && {}'.format(shlex.quote(path), options.post_command)]
+
+
+def bytes_sent(output):
+    for line in output.splitlines():
+        if line.startswith('Total bytes sent:'):
+            try:
+                return int(line.split(':', 1)[1].strip().replace(',', ''))
+            except ValueError:
+                return None
+    return None
+
+
+def run(args, timeout, cwd=None):
+    try:
+        proc = subprocess.Popen(args, cwd=cwd, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+    except OSError as msg:
+        return None, str(msg)
+    try:
+        output = proc.communicate(timeout=timeout)[0]
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        return None, 'timed out after {:.0f}s'.format(timeout)
+    return proc.returncode, output.decode('utf-8', 'replace')
+
+
+def deploy_once(options, source, host, path, deadline):
+    # Returns (error or None, bytes sent)
+    if not is_directory_host(host):
+        status, output = run(ssh_args(options, host) + ['true'],
+                             max(1, deadline - time.monotonic()))
+        if status != 0:
+            return 'could not ssh to {}: {}'.format(
+                host, output.strip()), None
+    else:
+        target = host_path(host, path)
+        if not os.path.exists(target):
+            os.makedirs(target)
+
+    status, output = run(transfer_args(options, source, host, path),
+                         max(1, deadline - time.monotonic()))
+    if status != 0:
+        return 'rsync failed: {}'.format(output.strip()[-500:]), None
+    sent = bytes_sent(output)
+
+    if options.post_command:
+        cwd = host_path(host, path) if is_directory_host(host) else None
+        status, output = run(post_command_args(options, host, path),
+                             max(1, deadline - time.monotonic()), cwd)
+        if status != 0:
+            return 'post command failed: {}'.format(
+                output.strip()[-500:]), sent
+
+    return None, sent
+
+
+def deploy_host(options, sources, host, path):
+    result = {'host': host, 'path': path, 'status': 'failed',
+              'attempts': 0, 'seconds': 0.0, 'bytes_sent': None,
+              'source': None, 'error': None}
+    start = time.monotonic()
+    deadline = start + options.timeout
+
+    for attempt in range(options.retries + 1):
+        if time.monotonic() >= deadline:
+            result['error'] = 'timed out after {}s'.format(options.timeout)
+            break
+        result['attempts'] = attempt + 1
+
+        source = ORIGIN
+        if sources is not None:
+            try:
+                # The deadline may have passed since the check above
+                source = sources.get(timeout=max(0, deadline -
+                                                 time.monotonic()))
+            except queue.Empty:
+                result['error'] = 'no relay source became available'
+                break
+
+        try:
+            error, sent = deploy_once(options, source, host, path, deadline)
+        except OSError as msg:
+            error, sent = str(msg), None
+
+        result['error'] = error
+        result['bytes_sent'] = sent
+        result['source'] = 'local' if source is ORIGIN else source[0]
+
+        if sources is not None:
+            # The local tree seeds a single host, after that the hosts that
+            # have the build feed the others and the local uplink is idle
+            if error is None:
+                sources.put((host, path))
+                if source is not ORIGIN:
+                    sources.put(source)
+            else:
+                sources.put(source)
+
+        if error is None:
+            result['status'] = 'ok'
+            break
+
+        if attempt < options.retries:
+            time.sleep(min(options.backoff * 2 ** attempt,
+                           max(0, deadline - time.monotonic())))
+
+    result['seconds'] = round(time.monotonic() - start, 1)
+    return result
+
+
+def deploy(options, hosts):
+    sources = None
+    if options.relay:
+        sources = queue.Queue()
+        sources.put(ORIGIN)
+
+    lock = threading.Lock()
+
+    def worker(host, path):
+        result = deploy_host(options, sources, host, path)
+        with lock:
+            print('{}: {} ({} attempt(s), {}s){}'.format(
+                host, result['status'], result['attempts'],
+                result['seconds'],
+                '' if result['error'] is None else
+                ' - ' + result['error'].splitlines()[-1]))
+            sys.stdout.flush()
+        return result
+
+    with ThreadPoolExecutor(max_workers=options.workers) as executor:
+        futures = [executor.submit(worker, host, path)
+                   for host, path in hosts]
+        return [future.result() for future in futures]
+
+
+def print_summary(results, seconds):
+    ok = [result for result in results if result['status'] == 'ok']
+    width = max([len(result['host']) for result in results] + [4])
+    print('Deploy summary:')
+    for result in results:
+        sent = result['bytes_sent']
+        print('  {}  {:6}  {:>3}  {:8.1f}s  {:>14}  {}'.format(
+            result['host'].ljust(width), result['status'],
+            result['attempts'], result['seconds'],
+            '-' if sent is None else '{} bytes'.format(sent),
+            result['source'] or ''))
+    total_sent = sum(result['bytes_sent'] or 0 for result in results)
+    print('  {} of {} hosts deployed in {:.1f}s, {} bytes sent'.format(
+        len(ok), len(results), seconds, total_sent))
+
+
+def main(options):
+    if not os.path.isdir(options.artifact):
+        print('Build artifact {} is not a directory'.format(options.artifact))
+        exit(1)
+
+    remote_path = options.remote_path or os.path.abspath(options.artifact)
+    hosts = []
+    if options.inventory:
+        hosts.extend(read_inventory(options.inventory, remote_path))
+    hosts.extend((host, remote_path) for host in options.hosts)
+    if not hosts:
+        print('No hosts given')
+        exit(1)
+
+    print('Deploying {} to {} hosts with {} workers...'.format(
+        options.artifact, len(hosts), min(options.workers, len(hosts))))
+    start = time.monotonic()
+    results = deploy(options, hosts)
+    seconds = time.monotonic() - start
+    print_summary(results, seconds)
+
+    if options.report:
+        with open(options.report, 'w') as report:
+            json.dump({'artifact': options.artifact,
+                       'seconds': round(seconds, 1),
+                       'hosts': results}, report, indent=2)
+
+    exit(0 if all(result['status'] == 'ok' for result in results) else 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='fleet-deploy',
+                                     description='Deploy a build to many '
+                                                 'hosts concurrently')
+    parser.add_argument('artifact', type=str,
+                        help='install tree to deploy, e.g. /opt/python34')
+    parser.add_argument('hosts', type=str, nargs='*',
+                        help='[user@]host or a directory standing in for one')
+    parser.add_argument('--inventory', type=str, default=None,
+                        help='file with one "host [remote_path]" per line')
+    parser.add_argument('--remote-path', type=str, default=None,
+                        help='(default: the artifact path)')
+    parser.add_argument('--workers', type=int, default=DEPLOY_WORKERS,
+                        help='(default: {})'.format(DEPLOY_WORKERS))
+    parser.add_argument('--timeout', type=int, default=DEPLOY_TIMEOUT,
+                        help='seconds per host, retries included '
+                             '(default: {})'.format(DEPLOY_TIMEOUT))
+    parser.add_argument('--retries', type=int, default=DEPLOY_RETRIES,
+                        help='(default: {})'.format(DEPLOY_RETRIES))
+    parser.add_argument('--backoff', type=float, default=DEPLOY_BACKOFF,
+                        help='seconds before the first retry, doubled after '
+                             'each one (default: {})'.format(DEPLOY_BACKOFF))
+    parser.add_argument('--relay', action='store_true',
+                        help='send the full tree once and let hosts that '
+                             'have it feed the others (they must be able '
+                             'to ssh to each other)')
+    parser.add_argument('--post-command', type=str, default=None,
+                        help='shell command run in the deployed tree, e.g. '
+                             '\'env ERL_TOP=`pwd` ./Install -minimal `pwd`\'')
+    parser.add_argument('--ssh-command', type=str, default='ssh',
+                        help='(default: ssh)')
+    parser.add_argument('--ssh-options', type=str,
+                        default=os.environ.get('KERL_DEPLOY_SSH_OPTIONS', ''),
+                        help='(default: $KERL_DEPLOY_SSH_OPTIONS)')
+    parser.add_argument('--rsync-options', type=str,
+                        default=os.environ.get('KERL_DEPLOY_RSYNC_OPTIONS',
+                                               ''),
+                        help='(default: $KERL_DEPLOY_RSYNC_OPTIONS)')
+    parser.add_argument('--report', type=str, default=None,
+                        help='write a JSON report of every host here')
+
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    main(args)
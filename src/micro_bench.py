@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+'''
+Small interpreter benchmarks, in the spirit of pyperformance, to compare
+two Python builds on the same host.
+
+The workloads run inside the interpreter under test, so they only use
+what Python 3.4 already has.
+'''
+import os
+import json
+import math
+import argparse
+import tempfile
+import subprocess
+
+BENCHMARK_SCRIPT = r'''
+import sys, json, timeit
+
+SETUP = """
+import re, json
+def fib(n):
+    return n if n < 2 else fib(n - 1) + fib(n - 2)
+class Point(object):
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+    def norm(self):
+        return (self.x * self.x + self.y * self.y) ** 0.5
+WORDS = ('alpha beta gamma delta epsilon zeta eta theta ' * 50).split()
+DOC = {'a': list(range(100)), 'b': {'c': 'text' * 10, 'd': [1.5] * 20}}
+TEXT = 'user=carlo id=42 host=build-07 ' * 40
+PATTERN = re.compile(r'(\w+)=(\w+)')
+"""
+
+BENCHMARKS = [
+    ('call_recursive', 'fib(18)'),
+    ('attribute_access', 'sum(Point(i, i + 1).norm() for i in range(2000))'),
+    ('int_loop', 'total = 0\nfor i in range(20000):\n    total += i * i % 7'),
+    ('float_math', 'sum((i * 0.5) ** 1.5 / (i + 1.0) for i in range(10000))'),
+    ('dict_ops', 'd = {}\nfor w in WORDS:\n    d[w] = d.get(w, 0) + 1'),
+    ('list_sort', 'sorted(WORDS * 4, key=len)'),
+    ('str_ops', '"-".join(w.upper() for w in WORDS).split("-")'),
+    ('regex', 'PATTERN.findall(TEXT)'),
+    ('json_roundtrip', 'json.loads(json.dumps(DOC))'),
+    ('comprehensions', '[x * 2 for x in range(5000) if x % 3]'),
+]
+
+repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+results = {}
+for name, stmt in BENCHMARKS:
+    timer = timeit.Timer(stmt, SETUP)
+    number = 1
+    while timer.timeit(number) < 0.05:
+        number *= 2
+    results[name] = min(timer.repeat(repeat, number)) / number
+sys.stdout.write(json.dumps(results))
+'''
+
+BENCHMARK_REPEAT = 5
+BENCHMARK_TIMEOUT = 600
+
+
+def run_benchmarks(python, repeat=BENCHMARK_REPEAT):
+    # Seconds per iteration of every benchmark, or None if the interpreter
+    # could not run them
+    fd, script = tempfile.mkstemp(prefix='micro-bench-', suffix='.py')
+    try:
+        with os.fdopen(fd, 'w') as script_file:
+            script_file.write(BENCHMARK_SCRIPT)
+        output = subprocess.check_output([python, '-S', script, str(repeat)],
+                                         stderr=subprocess.DEVNULL,
+                                         timeout=BENCHMARK_TIMEOUT)
+        return json.loads(output.decode('utf-8'))
+    except (OSError, ValueError, subprocess.SubprocessError):
+        return None
+    finally:
+        os.unlink(script)
+
+
+def compare(before, after):
+    # after/before time ratio per benchmark, and their geometric mean
+    ratios = dict((name, after[name] / before[name]) for name in before
+                  if name in after and before[name] > 0)
+    if not ratios:
+        return ratios, None
+    mean = math.exp(sum(math.log(ratio) for ratio in ratios.values()) /
+                    len(ratios))
+    return ratios, mean
+
+
+def print_comparison(before, after, before_label='before',
+                     after_label='after'):
+    ratios, mean = compare(before, after)
+    width = max(len(name) for name in ratios) if ratios else 4
+    print('Micro-benchmarks ({} vs {}):'.format(after_label, before_label))
+    for name in sorted(ratios):
+        print('  {}  {:10.2f}us {:10.2f}us  {:5.2f}x faster'.format(
+            name.ljust(width), before[name] * 1e6, after[name] * 1e6,
+            1 / ratios[name]))
+    if mean is not None:
+        print('  {}  {:5.2f}x faster (geometric mean)'.format(
+            'overall'.ljust(width), 1 / mean))
+    return mean
+
+
+def main(args):
+    before = run_benchmarks(args.before, args.repeat)
+    after = run_benchmarks(args.after, args.repeat)
+    if before is None or after is None:
+        print('Could not run the benchmarks with {}'.format(
+            args.before if before is None else args.after))
+        exit(1)
+    print_comparison(before, after, args.before, args.after)
+    exit(0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='micro-bench',
+                                     description='Compare two Python '
+                                                 'interpreters')
+    parser.add_argument('before', type=str, help='baseline interpreter')
+    parser.add_argument('after', type=str, help='interpreter under test')
+    parser.add_argument('--repeat', type=int, default=BENCHMARK_REPEAT,
+                        help='(default: {})'.format(BENCHMARK_REPEAT))
+    main(parser.parse_args())
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+'''
+Dependencies between the applications of an Erlang/OTP source tree, for
+builds of only the applications a node needs (KERL_TARGET_APPLICATIONS of
+kerl, --application of erlang_install.py).
+
+Every application in lib/ names the applications it needs in its .app.src
+(or .app) file, under applications, included_applications and
+runtime_dependencies. Compiling it can also need others: those whose
+headers it includes with -include_lib and those of its parse transforms.
+The closure of the targets over both is what has to be built, with kernel
+and stdlib always part of it. ERTS is not in lib/ and is always built.
+
+    otp_apps.py closure OTP_SOURCE_DIRECTORY APP...
+    otp_apps.py list OTP_SOURCE_DIRECTORY
+'''
+import os
+import re
+import sys
+import argparse
+
+# A release does not boot without them
+BASE_APPLICATIONS = ('kernel', 'stdlib')
+
+DEPENDENCY_KEYS = ('applications', 'included_applications')
+
+STRING = re.compile(r'"(?:[^"\\]|\\.)*"')
+# Comments go, strings and characters stay: neither "%VSN%" nor $% starts
+# a comment
+COMMENT = re.compile(r'(\$\\?.|"(?:[^"\\]|\\.)*")|%.*$', re.MULTILINE)
+DEPENDENCIES = re.compile(r'\{\s*(\w+)\s*,\s*\[([^\]]*)\]\s*\}')
+# "crypto-3.3": the application and the least version it needs
+RUNTIME_DEPENDENCIES = re.compile(
+    r'\{\s*runtime_dependencies\s*,\s*\[([^\]]*)\]\s*\}')
+VERSION_SUFFIX = re.compile(r'-[^-]*$')
+
+# What compiling a module needs from other applications
+INCLUDE_LIB = re.compile(r'^\s*-\s*include_lib\s*\(\s*"([^/"]+)/',
+                         re.MULTILINE)
+PARSE_TRANSFORM = re.compile(r'\{\s*parse_transform\s*,\s*\'?(\w+)')
+SOURCE_SUFFIXES = ('.erl', '.hrl')
+
+
+def app_file(application_directory, name):
+    # The .app.src of the source, or the .app of applications shipped
+    # prebuilt; None for the few without either (erl_interface, ...)
+    for filepath in (os.path.join(application_directory, 'src',
+                                  name + '.app.src'),
+                     os.path.join(application_directory, 'ebin',
+                                  name + '.app'),
+                     os.path.join(application_directory, 'ebin',
+                                  name + '.app.src')):
+        if os.path.isfile(filepath):
+            return filepath
+    return None
+
+
+def strip_comments(text):
+    return COMMENT.sub(lambda match: match.group(1) or '', text)
+
+
+def parse_dependencies(text):
+    # The applications an application resource file depends on
+    text = strip_comments(text)
+    runtime = [VERSION_SUFFIX.sub('', name[1:-1])
+               for names in RUNTIME_DEPENDENCIES.findall(text)
+               for name in STRING.findall(names)]
+    dependencies = []
+    for key, atoms in DEPENDENCIES.findall(STRING.sub('""', text)):
+        if key in DEPENDENCY_KEYS:
+            dependencies.extend(atom.strip().strip("'")
+                                for atom in atoms.split(',')
+                                if atom.strip())
+    return dependencies + [name for name in runtime
+                           if name not in dependencies]
+
+
+def source_applications(otp_source):
+    # {application: [applications it depends on]} of lib/
+    lib = os.path.join(otp_source, 'lib')
+    if not os.path.isdir(lib):
+        raise IOError('no lib directory in {}'.format(otp_source))
+    applications = {}
+    for name in sorted(os.listdir(lib)):
+        directory = os.path.join(lib, name)
+        if not os.path.isdir(directory):
+            continue
+        filepath = app_file(directory, name)
+        if filepath is None:
+            applications[name] = []
+            continue
+        with open(filepath, encoding='latin-1') as resource:
+            applications[name] = parse_dependencies(resource.read())
+    return applications
+
+
+def source_files(application_directory):
+    for subdirectory in ('src', 'include'):
+        directory = os.path.join(application_directory, subdirectory)
+        if not os.path.isdir(directory):
+            continue
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for filename in sorted(filenames):
+                if filename.endswith(SOURCE_SUFFIXES):
+                    yield os.path.join(dirpath, filename)
+
+
+def module_applications(otp_source):
+    # {module: application} of the modules in lib/
+    lib = os.path.join(otp_source, 'lib')
+    modules = {}
+    for name in sorted(os.listdir(lib)):
+        for filepath in source_files(os.path.join(lib, name)):
+            if filepath.endswith('.erl'):
+                modules[os.path.basename(filepath)[:-4]] = name
+    return modules
+
+
+def build_dependencies(otp_source, name, modules):
+    # The applications whose headers or parse transforms the sources of
+    # application name use
+    dependencies = set()
+    for filepath in source_files(os.path.join(otp_source, 'lib', name)):
+        with open(filepath, encoding='latin-1') as source:
+            text = strip_comments(source.read())
+        dependencies.update(INCLUDE_LIB.findall(text))
+        dependencies.update(modules[module] for module in
+                            PARSE_TRANSFORM.findall(text)
+                            if module in modules)
+    dependencies.discard(name)
+    return sorted(dependencies)
+
+
+def closure(applications, targets, build_needs=None):
+    # The targets, kernel, stdlib and all they depend on, sorted; what is
+    # not in lib/ (erts) is left out. build_needs(name) gives what compiling
+    # an application needs besides
+    unknown = [target for target in targets if target not in applications]
+    if unknown:
+        raise ValueError('no application {} in this Erlang/OTP'.format(
+            ', '.join(unknown)))
+    needed = set()
+    pending = list(targets) + [name for name in BASE_APPLICATIONS
+                               if name in applications]
+    while pending:
+        name = pending.pop()
+        if name in needed:
+            continue
+        needed.add(name)
+        dependencies = list(applications[name])
+        if build_needs:
+            dependencies.extend(build_needs(name))
+        pending.extend(dependency for dependency in dependencies
+                       if dependency in applications)
+    return sorted(needed)
+
+
+def main(args):
+    try:
+        applications = source_applications(args.otp_source)
+        if args.command == 'closure':
+            modules = module_applications(args.otp_source)
+            print(' '.join(closure(
+                applications, args.applications,
+                lambda name: build_dependencies(args.otp_source, name,
+                                                modules))))
+        else:
+            for name in sorted(applications):
+                print('{:20} {}'.format(name, ' '.join(applications[name])))
+    except (ValueError, IOError, OSError) as msg:
+        print('Could not resolve the applications of {}: {}'.format(
+            args.otp_source, msg), file=sys.stderr)
+        exit(1)
+    exit(0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='otp-apps',
+                                     description='Dependencies between '
+                                                 'Erlang/OTP applications')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    closure_parser = commands.add_parser('closure', help='print the '
+                                                         'applications to '
+                                                         'build for these')
+    closure_parser.add_argument('otp_source', type=str)
+    closure_parser.add_argument('applications', type=str, nargs='+')
+
+    list_parser = commands.add_parser('list', help='print every application '
+                                                   'and its dependencies')
+    list_parser.add_argument('otp_source', type=str)
+
+    main(parser.parse_args())
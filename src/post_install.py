@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+'''
+Post-install stage of py34_install.py: readies a Python install tree for
+fast interpreter startup on the hosts it is deployed to.
+
+The standard library is compiled to bytecode by the installed interpreter
+itself, at all three optimization levels (none, -O and -OO), split over
+several compileall processes; stale or missing .pyc files would otherwise
+be compiled by the first import on every host. ELF binaries and extension
+modules are then stripped of their symbols (static libraries only of their
+debugging information).
+
+The slim profile first drops what a production host never imports: the
+test suite, IDLE, Tkinter, turtle and the tests of the other packages.
+
+The install size and the startup time of python3 -c pass are measured
+before and after.
+
+    post_install.py [--profile standard|slim] [--jobs N] INSTALL_DIRECTORY
+'''
+import os
+import re
+import sys
+import glob
+import json
+import time
+import shutil
+import argparse
+import statistics
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from build_utils import tree_size, format_bytes
+
+PROFILES = ('standard', 'slim')
+
+# Relative to lib/pythonX.Y and to the install directory
+SLIM_LIBRARY = ('test', 'idlelib', 'tkinter', 'turtledemo', 'turtle.py',
+                'lib2to3/tests', 'ctypes/test', 'distutils/tests',
+                'sqlite3/test', 'unittest/test', 'lib-dynload/_tkinter*',
+                'lib-dynload/_test*', 'lib-dynload/xxlimited*')
+SLIM_INSTALL = ('bin/idle3*',)
+
+# What make install leaves out of compileall as well
+COMPILE_EXCLUDE = re.compile(r'bad_coding|badsyntax|site-packages|'
+                             r'lib2to3/tests/data')
+
+OPTIMIZATION_LEVELS = ((), ('-O',), ('-OO',))
+
+# Variables that would change what the compileall processes write
+PYTHON_ENV_EXCLUDE = ('PYTHONHOME', 'PYTHONPATH', 'PYTHONOPTIMIZE',
+                      'PYTHONDONTWRITEBYTECODE')
+
+STARTUP_RUNS = 20
+
+ELF_MAGIC = b'\x7fELF'
+
+
+def interpreter(install_directory):
+    return os.path.join(install_directory, 'bin', 'python3')
+
+
+def library_directory(install_directory):
+    # lib/pythonX.Y, the directory with os.py
+    for landmark in sorted(glob.glob(os.path.join(
+            install_directory, 'lib', 'python3*', 'os.py'))):
+        return os.path.dirname(landmark)
+    return None
+
+
+def python_env():
+    return dict((key, value) for key, value in os.environ.items()
+                if key not in PYTHON_ENV_EXCLUDE)
+
+
+def startup_seconds(python, runs=STARTUP_RUNS):
+    # Median wall time of python -c pass, after one warm-up run; -B keeps
+    # the runs from writing the bytecode that is missing
+    times = []
+    for run in range(runs + 1):
+        start = time.monotonic()
+        status = subprocess.call([python, '-B', '-c', 'pass'],
+                                 env=python_env(),
+                                 stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.DEVNULL)
+        if status != 0:
+            return None
+        if run:
+            times.append(time.monotonic() - start)
+    return statistics.median(times)
+
+
+def slim(install_directory):
+    # Removes the SLIM_* paths; returns those that were there
+    library = library_directory(install_directory)
+    patterns = [os.path.join(install_directory, pattern)
+                for pattern in SLIM_INSTALL]
+    if library:
+        patterns += [os.path.join(library, pattern)
+                     for pattern in SLIM_LIBRARY]
+    removed = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+            removed.append(os.path.relpath(path, install_directory))
+    return removed
+
+
+def source_files(library):
+    sources = []
+    for dirpath, dirnames, filenames in os.walk(library):
+        dirnames[:] = sorted(name for name in dirnames
+                             if name != '__pycache__')
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if name.endswith('.py') and not COMPILE_EXCLUDE.search(path):
+                sources.append(path)
+    return sources
+
+
+def compile_shard(python, level, files):
+    # compileall of the installed interpreter, reading the files from
+    # stdin, so it also works for the Pythons without compileall -j
+    proc = subprocess.Popen([python] + list(level) +
+                            ['-m', 'compileall', '-q', '-i', '-'],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, env=python_env())
+    output = proc.communicate('\n'.join(files).encode('utf-8'))[0]
+    return proc.returncode, output.decode('utf-8', 'replace')
+
+
+def compile_bytecode(python, files, jobs=1):
+    # Every optimization level of every shard is a process of its own, at
+    # most jobs at a time; returns the output of those that failed
+    shards = [files[index::jobs] for index in range(jobs)]
+    work = [(level, shard) for level in OPTIMIZATION_LEVELS
+            for shard in shards if shard]
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        results = list(pool.map(lambda item: compile_shard(python, *item),
+                                work))
+    return [output for status, output in results if status != 0]
+
+
+def binary_files(install_directory):
+    # (ELF files, static libraries) of the tree, without the symlinks
+    elf, archives = [], []
+    for dirpath, dirnames, filenames in os.walk(install_directory):
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+            if name.endswith('.a'):
+                archives.append(path)
+                continue
+            with open(path, 'rb') as binary:
+                if binary.read(4) == ELF_MAGIC:
+                    elf.append(path)
+    return elf, archives
+
+
+def strip_binaries(install_directory, jobs=1):
+    # Number of files stripped, or None without strip
+    strip = shutil.which('strip')
+    if strip is None:
+        return None
+    elf, archives = binary_files(install_directory)
+    # Only what neither dynamic linking nor static linking against it needs
+    work = [[strip, '--strip-unneeded', path] for path in elf] + \
+        [[strip, '--strip-debug', path] for path in archives]
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        statuses = list(pool.map(
+            lambda args: subprocess.call(args, stdout=subprocess.DEVNULL,
+                                         stderr=subprocess.DEVNULL), work))
+    return sum(1 for status in statuses if status == 0)
+
+
+def post_install(install_directory, profile='standard', jobs=1):
+    # Returns a report of what was done and its effect on size and startup
+    python = interpreter(install_directory)
+    library = library_directory(install_directory)
+    if library is None or not os.path.isfile(python):
+        raise IOError('no Python install in {}'.format(install_directory))
+
+    start = time.monotonic()
+    report = {'profile': profile,
+              'size_before': tree_size(install_directory),
+              'startup_before': startup_seconds(python),
+              'removed': [], 'compile_errors': []}
+    if profile == 'slim':
+        report['removed'] = slim(install_directory)
+    sources = source_files(library)
+    report['modules'] = len(sources)
+    report['optimization_levels'] = len(OPTIMIZATION_LEVELS)
+    report['compile_errors'] = compile_bytecode(python, sources, jobs)
+    report['stripped'] = strip_binaries(install_directory, jobs)
+    report['size_after'] = tree_size(install_directory)
+    report['startup_after'] = startup_seconds(python)
+    report['seconds'] = round(time.monotonic() - start, 3)
+    return report
+
+
+def format_startup(seconds):
+    return '-' if seconds is None else '{:.1f}ms'.format(seconds * 1000)
+
+
+def describe(report):
+    lines = ['Post-install ({}): {} modules compiled at {} optimization '
+             'levels, {} binaries stripped{}'.format(
+                 report['profile'], report['modules'],
+                 report['optimization_levels'],
+                 'no' if report['stripped'] is None else report['stripped'],
+                 ', {} paths removed'.format(len(report['removed']))
+                 if report['removed'] else ''),
+             '  install size {:>10} -> {}'.format(
+                 format_bytes(report['size_before']),
+                 format_bytes(report['size_after'])),
+             '  startup      {:>10} -> {} (python3 -c pass, median of '
+             '{})'.format(format_startup(report['startup_before']),
+                          format_startup(report['startup_after']),
+                          STARTUP_RUNS)]
+    if report['stripped'] is None:
+        lines.append('  strip is not installed, binaries were left as '
+                     'they are')
+    for output in report['compile_errors']:
+        lines.append('  compileall failed: {}'.format(
+            output.strip().splitlines()[-1] if output.strip() else '?'))
+    return lines
+
+
+def main(args):
+    try:
+        report = post_install(args.install_directory, args.profile,
+                              args.jobs)
+    except (IOError, OSError) as msg:
+        print('Could not post-install {}: {}'.format(args.install_directory,
+                                                     msg), file=sys.stderr)
+        exit(1)
+    print('\n'.join(describe(report)))
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+    exit(1 if report['compile_errors'] else 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='post-install',
+                                     description='Precompile, strip and '
+                                                 'slim a Python install')
+    parser.add_argument('install_directory', type=str)
+    parser.add_argument('--profile', choices=PROFILES, default='standard',
+                        help='slim also removes the test suite, IDLE, '
+                             'Tkinter and the like (default: standard)')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(),
+                        help='compileall and strip processes at the same '
+                             'time (default: {})'.format(os.cpu_count()))
+    parser.add_argument('--report', type=str, default=None,
+                        help='write the report as JSON here')
+    main(parser.parse_args())
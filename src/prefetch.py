@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+'''
+Concurrent prefetch of source tarballs into a download directory, shared by
+py34_install.py (--prefetch) and kerl (kerl prefetch).
+
+Every archive is fetched on its own connection, at most --connections at a
+time, and verified against its checksum while it is written. Archives
+already there with a good sum are not fetched again. For Erlang/OTP the MD5
+index is fetched once for the whole list instead of after every download.
+
+The directory doubles as the offline mirror of air-gapped hosts: copy it
+there and point $PY34_MIRROR_DIR (or --mirror-dir) and $KERL_MIRROR_DIR at
+it, the installers then build from it without any network access.
+
+    prefetch.py erlang [--url URL] [--connections N] DIRECTORY RELEASE...
+    prefetch.py verify DIRECTORY
+'''
+import os
+import re
+import sys
+import time
+import hashlib
+import argparse
+import tempfile
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from build_utils import copy_hashed, file_checksum, format_bytes
+
+ERLANG_DOWNLOAD_URL = 'http://www.erlang.org/download'
+ERLANG_INDEX = 'MD5'
+
+CONNECTIONS = 4
+DOWNLOAD_TIMEOUT = 60
+DOWNLOAD_RETRIES = 2
+DOWNLOAD_BACKOFF = 2
+BLOCK_SIZE = 2**16
+
+INDEX_LINE = re.compile(r'^MD5\((?P<name>[^)]+)\)= *(?P<sum>[0-9a-fA-F]+)')
+
+
+class PrefetchError(Exception):
+    pass
+
+
+def is_present(filepath, checksum):
+    # checksum is (algorithm, hex digest), or None to trust any file
+    if not os.path.isfile(filepath):
+        return False
+    return checksum is None or \
+        file_checksum(filepath, checksum[0], BLOCK_SIZE) == checksum[1].lower()
+
+
+def fetch_once(url, filepath, checksum):
+    algorithm = checksum[0] if checksum else 'md5'
+    digest = hashlib.new(algorithm)
+    # Named for this fetch only, so concurrent fetches of one file do not
+    # write into each other
+    fd, part = tempfile.mkstemp(prefix=os.path.basename(filepath) + '.',
+                                suffix='.part',
+                                dir=os.path.dirname(filepath) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as output:
+            with urllib.request.urlopen(url, timeout=DOWNLOAD_TIMEOUT) \
+                    as response:
+                received = copy_hashed(response, (output,), digest,
+                                       BLOCK_SIZE)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(part, 0o666 & ~umask)
+        if checksum and digest.hexdigest() != checksum[1].lower():
+            raise PrefetchError('{} sum of {} failed'.format(
+                algorithm.upper(), url))
+        os.replace(part, filepath)
+    finally:
+        if os.path.exists(part):
+            os.unlink(part)
+    return received
+
+
+def fetch(item, retries=DOWNLOAD_RETRIES, backoff=DOWNLOAD_BACKOFF):
+    # item is a dict with url, filepath and checksum; returns a result dict
+    start = time.monotonic()
+    result = {'name': os.path.basename(item['filepath']),
+              'url': item['url'], 'status': 'present', 'bytes': 0,
+              'seconds': 0.0, 'error': None}
+    if is_present(item['filepath'], item['checksum']):
+        return result
+
+    for attempt in range(retries + 1):
+        try:
+            result['bytes'] = fetch_once(item['url'], item['filepath'],
+                                         item['checksum'])
+        except (PrefetchError, IOError, OSError) as msg:
+            result['error'] = str(msg) or type(msg).__name__
+            if attempt < retries:
+                time.sleep(backoff * 2 ** attempt)
+        else:
+            result['status'] = 'fetched'
+            result['error'] = None
+            break
+    else:
+        result['status'] = 'failed'
+    result['seconds'] = round(time.monotonic() - start, 3)
+    return result
+
+
+def prefetch(items, connections=CONNECTIONS):
+    # Fetches every item, at most connections at a time, in item order
+    for item in items:
+        directory = os.path.dirname(item['filepath'])
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, connections)) as pool:
+        return list(pool.map(fetch, items))
+
+
+def print_results(results, seconds):
+    for result in results:
+        print('  {:30} {:8} {:>8}  {}'.format(
+            result['name'], result['status'], format_bytes(result['bytes']),
+            result['error'] or ''))
+    fetched = sum(result['bytes'] for result in results)
+    print('Prefetched {} in {:.1f}s ({}/s)'.format(
+        format_bytes(fetched), seconds,
+        format_bytes(fetched / max(seconds, 1e-6))))
+
+
+def read_index(filepath):
+    # {archive name: md5} from an erlang.org style MD5 file
+    sums = {}
+    with open(filepath) as index:
+        for line in index:
+            match = INDEX_LINE.match(line.strip())
+            if match:
+                sums[match.group('name')] = match.group('sum').lower()
+    return sums
+
+
+def fetch_index(url, directory, name=ERLANG_INDEX):
+    filepath = os.path.join(directory, name)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    fetch_once('{}/{}'.format(url, name), filepath, None)
+    return read_index(filepath)
+
+
+def erlang_items(url, directory, releases):
+    # The index is fetched once for all releases, and only when one of them
+    # is missing from the copy already there
+    filenames = ['otp_src_{}.tar.gz'.format(release) for release in releases]
+    index = os.path.join(directory, ERLANG_INDEX)
+    sums = read_index(index) if os.path.exists(index) else {}
+    if any(filename not in sums for filename in filenames):
+        print('Getting the checksum file from {}...'.format(url))
+        sums = fetch_index(url, directory)
+
+    items = []
+    for filename in filenames:
+        if filename not in sums:
+            raise PrefetchError('no checksum for {} in {}/{}'.format(
+                filename, url, ERLANG_INDEX))
+        items.append({'url': '{}/{}'.format(url, filename),
+                      'filepath': os.path.join(directory, filename),
+                      'checksum': ('md5', sums[filename])})
+    return items
+
+
+def verify(directory):
+    # Names of the archives in directory whose MD5 index entry does not
+    # match; archives without an entry are not checked
+    index = os.path.join(directory, ERLANG_INDEX)
+    sums = read_index(index) if os.path.exists(index) else {}
+    return [name for name in sorted(sums)
+            if os.path.exists(os.path.join(directory, name)) and
+            not is_present(os.path.join(directory, name), ('md5', sums[name]))]
+
+
+def main(args):
+    if args.command == 'verify':
+        corrupt = verify(args.directory)
+        for name in corrupt:
+            print('{}: MD5 sum failed'.format(name))
+        exit(1 if corrupt else 0)
+
+    start = time.monotonic()
+    try:
+        items = erlang_items(args.url.rstrip('/'), args.directory,
+                             args.releases)
+    except (PrefetchError, IOError, OSError) as msg:
+        print('Could not prefetch: {}'.format(msg), file=sys.stderr)
+        exit(1)
+    results = prefetch(items, args.connections)
+    print_results(results, time.monotonic() - start)
+    exit(0 if all(result['status'] != 'failed' for result in results)
+         else 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='prefetch',
+                                     description='Download source archives '
+                                                 'concurrently')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    erlang_parser = commands.add_parser('erlang', help='prefetch Erlang/OTP '
+                                                       'releases')
+    erlang_parser.add_argument('directory', type=str)
+    erlang_parser.add_argument('releases', type=str, nargs='+')
+    erlang_parser.add_argument('--url', type=str,
+                               default=ERLANG_DOWNLOAD_URL,
+                               help='(default: {})'.format(
+                                   ERLANG_DOWNLOAD_URL))
+    erlang_parser.add_argument('--connections', type=int,
+                               default=CONNECTIONS,
+                               help='downloads at the same time '
+                                    '(default: {})'.format(CONNECTIONS))
+
+    verify_parser = commands.add_parser('verify', help='check the archives '
+                                                       'against the MD5 index')
+    verify_parser.add_argument('directory', type=str)
+
+    main(parser.parse_args())
@@ -5,503 +5,632 @@ Created on 26/09/2013
 '''
 import os
 import sys
-import warnings
+import time
 import argparse
+import urllib.error
 import urllib.request
+import http.client
 import shutil
 import hashlib
+import tarfile
 import pwd
-import re
+import resource
+import sqlite3
+import json
+import errno
+import fcntl
+import tempfile
+import itertools
+import threading
+import collections
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager, ExitStack
 from subprocess import call
 
-# This should really be included in apt-cache policy output... it is already
-# in the Release file...
-RELEASE_CODENAME_LOOKUP = {
-    '1.1': 'buzz',
-    '1.2': 'rex',
-    '1.3': 'bo',
-    '2.0': 'hamm',
-    '2.1': 'slink',
-    '2.2': 'potato',
-    '3.0': 'woody',
-    '3.1': 'sarge',
-    '4.0': 'etch',
-    '5.0': 'lenny',
-    '6.0': 'squeeze',
-    '7.0': 'wheezy',
-    '8.0': 'jessie',
-    '8.1': 'jessie',
-    }
-
-TESTING_CODENAME = 'unknown.new.testing'
-
-RELEASES_ORDER = list(RELEASE_CODENAME_LOOKUP.items())
-RELEASES_ORDER.sort()
-RELEASES_ORDER = list(list(zip(*RELEASES_ORDER))[1])
-RELEASES_ORDER.extend(['stable', 'testing', 'unstable', 'sid'])
-
-
-def lookup_codename(release, unknown=None):
-    m = re.match(r'(\d+)\.(\d+)(r(\d+))?', release)
-    if not m:
-        return unknown
-
-    shortrelease = '%s.%s' % m.group(1, 2)
-    return RELEASE_CODENAME_LOOKUP.get(shortrelease, unknown)
-
-# LSB compliance packages... may grow eventually
-PACKAGES = 'lsb-core lsb-cxx lsb-graphics lsb-desktop ' \
-    'lsb-languages lsb-multimedia lsb-printing lsb-security'
-
-modnamere = re.compile(r'lsb-(?P<module>[a-z0-9]+)-(?P<arch>[^ ]+)'
-                       r'(?: \(= (?P<version>[0-9.]+)\))?')
-
-
-def valid_lsb_versions(version, module):
-    # If a module is ever released that only appears in >= version, deal
-    # with that here
-    if version == '3.0':
-        return ['2.0', '3.0']
-    elif version == '3.1':
-        if module in ('desktop', 'qt4'):
-            return ['3.1']
-        elif module == 'cxx':
-            return ['3.0', '3.1']
-        else:
-            return ['2.0', '3.0', '3.1']
-    elif version == '3.2':
-        if module == 'desktop':
-            return ['3.1', '3.2']
-        elif module == 'qt4':
-            return ['3.1']
-        elif module in ('printing', 'languages', 'multimedia'):
-            return ['3.2']
-        elif module == 'cxx':
-            return ['3.0', '3.1', '3.2']
-        else:
-            return ['2.0', '3.0', '3.1', '3.2']
-    elif version == '4.0':
-        if module == 'desktop':
-            return ['3.1', '3.2', '4.0']
-        elif module == 'qt4':
-            return ['3.1']
-        elif module in ('printing', 'languages', 'multimedia'):
-            return ['3.2', '4.0']
-        elif module == 'security':
-            return ['4.0']
-        elif module == 'cxx':
-            return ['3.0', '3.1', '3.2', '4.0']
-        else:
-            return ['2.0', '3.0', '3.1', '3.2', '4.0']
-    elif version == '4.1':
-        if module == 'desktop':
-            return ['3.1', '3.2', '4.0', '4.1']
-        elif module == 'qt4':
-            return ['3.1']
-        elif module in ('printing', 'languages', 'multimedia'):
-            return ['3.2', '4.0', '4.1']
-        elif module == 'security':
-            return ['4.0', '4.1']
-        elif module == 'cxx':
-            return ['3.0', '3.1', '3.2', '4.0', '4.1']
-        else:
-            return ['2.0', '3.0', '3.1', '3.2', '4.0', '4.1']
+import build_cache
+import cc_cache
+import config_cache
+import micro_bench
+import post_install
+import prefetch
+import registry
+import relocate
+import release_manifest
+import source_mirror
+import stream_extract
+from build_utils import MIN_JOBS_PER_BUILD, usable_cpu_count, \
+    run_with_job_budget, format_bytes, compiler_version, tree_size, \
+    copy_hashed, file_checksum, dpkg_installed_versions
+from distro_info import get_distro_information
+from release_manifest import RELEASE_MANIFEST, load_manifest
 
-    return [version]
+# STARTING OF REAL CODE
 
+DEFAULT_RELEASE = '3.4.3'
+
+# Rough wall-clock seconds each phase takes on a single core of our build
+# hosts. Timeouts are derived from these instead of a fixed limit, so that
+# neither a serial build nor a slow host is killed halfway through.
+EXPECTED_PHASE_SECONDS = {
+    'configure': 120,
+    'make': 1200,
+    'install': 240,
+}
+
+# Share of the compile that actually runs in parallel with make -j, the rest
+# (configure checks, linking, building the stdlib extensions) stays serial.
+MAKE_PARALLEL_FRACTION = 0.85
+
+# Link time optimization for --optimize; fat objects keep the static
+# libpython usable by programs that embed it without LTO
+LTO_CFLAGS = '-flto -ffat-lto-objects'
+LTO_LDFLAGS = '-flto'
+
+# Stdlib tests run as the profile training workload of --optimize: quick
+# ones that between them exercise the core types, the eval loop and the
+# most used C modules
+PGO_TRAINING_TESTS = ('test_array', 'test_base64', 'test_binascii',
+                      'test_binop', 'test_bisect', 'test_bytes',
+                      'test_cmath', 'test_codecs', 'test_collections',
+                      'test_complex', 'test_datetime', 'test_decimal',
+                      'test_difflib', 'test_float', 'test_functools',
+                      'test_generators', 'test_hashlib', 'test_heapq',
+                      'test_int', 'test_itertools', 'test_json',
+                      'test_long', 'test_math', 'test_memoryview',
+                      'test_operator', 'test_pickle', 'test_pprint',
+                      'test_re', 'test_set', 'test_sort', 'test_string',
+                      'test_struct', 'test_textwrap', 'test_unicode',
+                      'test_xml_etree')
+
+PGO_TRAINING_SECONDS = 900
+
+# Run by the instrumented interpreter: a failing test or script must not
+# fail the build, it only has to exercise the code
+PGO_TASK_SCRIPT = '''import sys, runpy, traceback
+args = sys.argv[1:]
+try:
+    if args and args[0].endswith('.py'):
+        sys.argv = args
+        runpy.run_path(args[0], run_name='__main__')
+    else:
+        from test import regrtest
+        sys.argv = ['regrtest', '-q'] + args
+        regrtest.main()
+except SystemExit:
+    pass
+except BaseException:
+    traceback.print_exc()
+sys.exit(0)
+'''
 
-# This is Debian-specific at present
-def check_modules_installed():
-    # Find which LSB modules are installed on this system
-    C_env = os.environ.copy()
-    C_env['LC_ALL'] = 'C'
+PHASE_TIMEOUT_FACTOR = 3
+PHASE_TIMEOUT_MIN = 60
 
-    output = subprocess.Popen(['dpkg-query', '-f',
-                               "${Version} ${Provides}\n", '-W'] +
-                              PACKAGES.split(),
-                              env=C_env,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE,
-                              close_fds=True).communicate()[0].decode('utf-8')
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 2
+DOWNLOAD_TIMEOUT = 60
+DOWNLOAD_BLOCK_SIZE = 2**16
 
-    if not output:
-        return []
+APT_INSTALL_TIMEOUT = 1800
 
-    modules = set()
-    for line in output.split(os.linesep):
-        if not line:
-            break
+# One record per phase, in the order the phases ran
+PHASE_REPORT = []
+PHASE_REPORT_LOCK = threading.Lock()
 
-        version, provides = line.split(' ', 1)
-        # Debian package versions can be 3.2-$REV, 3.2+$REV or 3.2~$REV.
-        version = re.split('[-+~]', version, 1)[0]
-        for pkg in provides.split(','):
-            mob = modnamere.search(pkg)
-            if not mob:
-                continue
+# The phases timed right now, by the thread running them
+_running_phases = []
 
-            mgroups = mob.groupdict()
-            # If no versioned provides...
-            if mgroups.get('version'):
-                module = '%(module)s-%(version)s-%(arch)s' % mgroups
-                modules.add(module)
-            else:
-                module = mgroups['module']
-                for v in valid_lsb_versions(version, module):
-                    mgroups['version'] = v
-                    module = '%(module)s-%(version)s-%(arch)s' % mgroups
-                    modules.add(module)
-
-    modules = list(modules)
-    modules.sort()
-    return modules
-
-longnames = {'v': 'version', 'o': 'origin', 'a': 'suite',
-             'c': 'component', 'l': 'label'}
-
-
-def parse_policy_line(data):
-    retval = {}
-    bits = data.split(',')
-    for bit in bits:
-        kv = bit.split('=', 1)
-        if len(kv) > 1:
-            k, v = kv[:2]
-            if k in longnames:
-                retval[longnames[k]] = v
-    return retval
-
-
-def release_index(x):
-    suite = x[1].get('suite')
-    if suite:
-        if suite in RELEASES_ORDER:
-            return int(len(RELEASES_ORDER) - RELEASES_ORDER.index(suite))
-        else:
-            return suite
-    return 0
+BUILD_PHASES = ('extract', 'configure', 'make', 'install')
 
+# Written into the install directory, see build_fingerprint()
+FINGERPRINT_NAME = '.build-fingerprint.json'
 
-def compare_release(x, y):
-    warnings.warn('compare_release(x,y) is deprecated; '
-                  'please use the release_index(x) as key for sort() instead.',
-                  DeprecationWarning, stacklevel=2)
+# --build-root tmpfs builds in RAM when the tmpfs and the free memory can
+# hold an extracted source tree plus a PGO build of it
+TMPFS_DIRECTORY = '/dev/shm'
+TMPFS_REQUIRED_BYTES = 2 * 2**30
 
-    suite_x_i = release_index(x)
-    suite_y_i = release_index(y)
+def user_home():
+    return os.path.expanduser('~')
 
-    try:
-        return suite_x_i - suite_y_i
-    except TypeError:
-        return (suite_x_i > suite_y_i) - (suite_x_i < suite_y_i)
 
+def users_home():
+    names = user_home().split(os.path.sep)
+    if names[-1] == os.environ.get('USER'):
+        names = names[:-1]
+    if names[0] == '':
+        names = names[1:]
+    return os.path.sep + os.path.sep.join(names)
 
-def parse_apt_policy():
-    data = []
 
-    C_env = os.environ.copy()
-    C_env['LC_ALL'] = 'C'
+_release = None
 
-    policy = subprocess.Popen(['apt-cache', 'policy'],
-                              env=C_env,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE,
-                              close_fds=True).communicate()[0].decode('utf-8')
+# --yes: replace install directories without asking
+_assume_yes = False
 
-    for line in policy.split('\n'):
-        line = line.strip()
-        m = re.match(r'(-?\d+)', line)
-        if m:
-            priority = int(m.group(1))
-        if line.startswith('release'):
-            bits = line.split(' ', 1)
-            if len(bits) > 1:
-                data.append((priority, parse_policy_line(bits[1])))
 
-    return data
+def set_assume_yes(assume_yes):
+    global _assume_yes
+    _assume_yes = assume_yes
 
 
-FTP_DEBIAN = 'ftp.debian-ports.org'
+def set_release(release):
+    global _release
+    _release = release
 
 
-def guess_release_from_apt(origin='Debian', component='main',
-                           ignoresuites=('experimental'),
-                           label='Debian',
-                           alternate_olabels={'Debian Ports': FTP_DEBIAN}):
-    releases = parse_apt_policy()
+def current_release():
+    if _release is None:
+        set_release(load_manifest()[DEFAULT_RELEASE])
+    return _release
 
-    if not releases:
-        return None
 
-    # We only care about the specified origin, component, and label
-    releases = [x for x in releases if (
-        x[1].get('origin', '') == origin and
-        x[1].get('component', '') == component and
-        x[1].get('label', '') == label) or (
-        x[1].get('origin', '') in alternate_olabels and
-        x[1].get('label', '') ==
-            alternate_olabels.get(x[1].get('origin', '')))]
-
-    # Check again to make sure we didn't wipe out all of the releases
-    if not releases:
-        return None
+def release_tag(release=None):
+    # python34 for 3.4.x: names the default build and install directories
+    major_minor = (release or current_release())['version'].split('.')[:2]
+    return 'python' + ''.join(major_minor)
 
-    releases.sort(key=lambda tpl: tpl[0], reverse=True)
 
-    # We've sorted the list by descending priority, so the first entry should
-    # be the "main" release in use on the system
+def release_home(release=None):
+    release = release or current_release()
+    return release.get('home') or '/opt/' + release_tag(release)
 
-    max_priority = releases[0][0]
-    releases = [x for x in releases if x[0] == max_priority]
-    releases.sort(key=release_index)
 
-    return releases[0][1]
+def release_checksum(release=None):
+    return release_manifest.release_checksum(release or current_release())
 
 
-def guess_debian_release():
-    distinfo = {}
+_mirror_directory = None
 
-    distinfo['ID'] = 'Debian'
-    # Use /etc/dpkg/origins/default to fetch the distribution name
-    etc_dpkg_origins_default = os.environ.get('LSB_ETC_DPKG_ORIGINS_DEFAULT',
-                                              '/etc/dpkg/origins/default')
 
-    if os.path.exists(etc_dpkg_origins_default):
-        try:
-            with open(etc_dpkg_origins_default) as dpkg_origins_file:
-                for line in dpkg_origins_file:
-                    try:
-                        (header, content) = line.split(': ', 1)
-                        header = header.lower()
-                        content = content.strip()
-                        if header == 'vendor':
-                            distinfo['ID'] = content
-                    except ValueError:
-                        pass
-        except IOError as msg:
-            print('Unable to open ' + etc_dpkg_origins_default + ':', str(msg),
-                  file=sys.stderr)
-
-    kern = os.uname()[0]
-    if kern in ('Linux', 'Hurd', 'NetBSD'):
-        distinfo['OS'] = 'GNU/'+kern
-    elif kern == 'FreeBSD':
-        distinfo['OS'] = 'GNU/k'+kern
-    elif kern in ('GNU/Linux', 'GNU/kFreeBSD'):
-        distinfo['OS'] = kern
-    else:
-        distinfo['OS'] = 'GNU'
+def set_mirror_directory(mirror_directory):
+    # Sources are then only read from (or prefetched into) this directory,
+    # builds never download them
+    global _mirror_directory
+    _mirror_directory = mirror_directory and os.path.abspath(mirror_directory)
 
-    distinfo['DESCRIPTION'] = '%(ID)s %(OS)s' % distinfo
 
-    etc_debian_version = os.environ.get('LSB_ETC_DEBIAN_VERSION',
-                                        '/etc/debian_version')
-    if os.path.exists(etc_debian_version):
-        try:
-            with open(etc_debian_version) as debian_version:
-                release = debian_version.read().strip()
-        except IOError as msg:
-            print('Unable to open ' + etc_debian_version + ':', str(msg),
-                  file=sys.stderr)
-            release = 'unknown'
-
-        if not release[0:1].isalpha():
-            # /etc/debian_version should be numeric
-            codename = lookup_codename(release, 'n/a')
-            distinfo.update({'RELEASE': release, 'CODENAME': codename})
-        elif release.endswith('/sid'):
-            if release.rstrip('/sid').lower().isalpha() != 'testing':
-                global TESTING_CODENAME
-                TESTING_CODENAME = release.rstrip('/sid')
-            distinfo['RELEASE'] = 'testing/unstable'
-        else:
-            distinfo['RELEASE'] = release
-
-    # Only use apt information if we did not get the proper information
-    # from /etc/debian_version or if we don't have a codename
-    # (which will happen if /etc/debian_version does not contain a
-    # number but some text like 'testing/unstable' or 'lenny/sid')
-    #
-    # This is slightly faster and less error prone in case the user
-    # has an entry in his /etc/apt/sources.list but has not actually
-    # upgraded the system.
-    if not distinfo.get('CODENAME'):
-        rinfo = guess_release_from_apt()
-        if rinfo:
-            release = rinfo.get('version')
-
-        # Special case Debian-Ports as their Release file has 'version': '1.0'
-        if release == '1.0' and rinfo.get('origin') == 'Debian Ports' and \
-                rinfo.get('label') == 'ftp.debian-ports.org':
-            release = None
-            rinfo.update({'suite': 'unstable'})
-
-        if release:
-            codename = lookup_codename(release, 'n/a')
-        else:
-            release = rinfo.get('suite', 'unstable')
-            if release == 'testing':
-                # Would be nice if I didn't have to hardcode this.
-                codename = TESTING_CODENAME
-            else:
-                codename = 'sid'
-        distinfo.update({'RELEASE': release, 'CODENAME': codename})
+def source_directory():
+    # Downloads of every release share this directory
+    return _mirror_directory or os.path.sep.join((user_home(), '.python34'))
 
-    if distinfo.get('RELEASE'):
-        distinfo['DESCRIPTION'] += ' %(RELEASE)s' % distinfo
-    if distinfo.get('CODENAME'):
-        distinfo['DESCRIPTION'] += ' (%(CODENAME)s)' % distinfo
 
-    return distinfo
+def source_missing_from_mirror(reason):
+    print('{}: the mirror {} is used offline, run --prefetch on a host '
+          'with network access and copy it here'.format(reason,
+                                                       _mirror_directory))
+    exit(1)
 
 
-# Whatever is guessed above can be overridden in /etc/lsb-release
-def get_lsb_information():
-    distinfo = {}
-    etc_lsb_release = os.environ.get('LSB_ETC_LSB_RELEASE', '/etc/lsb-release')
-    if os.path.exists(etc_lsb_release):
-        try:
-            with open(etc_lsb_release) as lsb_release_file:
-                for line in lsb_release_file:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    # Skip invalid lines
-                    if '=' not in line:
-                        continue
-                    var, arg = line.split('=', 1)
-                    if var.startswith('DISTRIB_'):
-                        var = var[8:]
-                        if arg.startswith('"') and arg.endswith('"'):
-                            arg = arg[1:-1]
-                        if arg:  # Ignore empty arguments
-                            distinfo[var] = arg.strip()
-        except IOError as msg:
-            print('Unable to open ' + etc_lsb_release + ':', str(msg),
-                  file=sys.stderr)
+_config_cache_directory = None
 
-    return distinfo
 
+def set_config_cache_directory(config_cache_directory):
+    # configure then starts from the shared config.cache of this toolchain
+    global _config_cache_directory
+    _config_cache_directory = config_cache_directory
 
-def get_distro_information():
-    lsbinfo = get_lsb_information()
-    # OS is only used inside guess_debian_release anyway
-    for key in ('ID', 'RELEASE', 'CODENAME', 'DESCRIPTION',):
-        if key not in lsbinfo:
-            distinfo = guess_debian_release()
-            distinfo.update(lsbinfo)
-            return distinfo
-    else:
-        return lsbinfo
 
+_post_install_profile = None
 
-# STARTING OF REAL CODE
 
-PYTHON34_HOME = '/opt/python34'
-
-PYTHON34_DOWNLOAD_URL = 'https://www.python.org/ftp/python/' \
-                        '3.4.3/Python-3.4.3.tar.xz'
-
-PYTHON34_MD5_CHECKSUM = '7d092d1bba6e17f0d9bd21b49e441dd5'
-
-DEPS = {}
-
-DEPS['Debian'] = {}
-
-DEPS['Debian']['8.0'] = ('build-essential',
-                         'openssl', 'libssl-dev',
-                         'libsqlite3-0', 'libsqlite3-dev',
-                         'libbz2-1.0', 'libbz2-dev',
-                         'libdb5.3', 'libdb-dev',
-                         'libgdbm3', 'libgdbm-dev',
-                         'liblzma5', 'liblzma-dev',
-                         'libncurses5', 'libncurses5-dev',
-                         'libreadline6', 'libreadline6-dev')
-
-DEPS['Debian']['8.1'] = DEPS['Debian']['8.0']
-
-DEPS['Debian']['7.8'] = ('build-essential',
-                         'openssl', 'libssl-dev',
-                         'libsqlite3-0', 'libsqlite3-dev',
-                         'libbz2-1.0', 'libbz2-dev',
-                         'libdb5.1', 'libdb-dev',
-                         'libgdbm3', 'libgdbm-dev',
-                         'liblzma5', 'liblzma-dev',
-                         'libncurses5', 'libncurses5-dev',
-                         'libreadline6', 'libreadline6-dev')
-
-DEPS['Ubuntu'] = {}
-
-DEPS['Ubuntu']['13.10'] = ('build-essential',
-                           'openssl', 'libssl-dev',
-                           'libsqlite3-0', 'libsqlite3-dev',
-                           'libbz2-1.0', 'libbz2-dev',
-                           'libdb5.1', 'libdb-dev',
-                           'libgdbm3', 'libgdbm-dev',
-                           'liblzma5', 'liblzma-dev',
-                           'libncurses5', 'libncurses5-dev',
-                           'libreadline6', 'libreadline6-dev')
-
-DEPS['Ubuntu']['14.04'] = ('build-essential',
-                           'openssl', 'libssl-dev',
-                           'libreadline6-dev',
-                           'zlib1g-dev', 'libbz2-dev', 'liblzma-dev',
-                           'libgdbm-dev', 'libdb-dev', 'libssl-dev',
-                           'libexpat1-dev', 'libmpdec-dev',
-                           'libbluetooth-dev', 'locales',
-                           'libsqlite3-dev', 'libffi-dev',
-                           'libgpm2', 'mime-support', 'netbase', 'bzip2',
-                           'net-tools', 'xvfb', 'xauth')
+def set_post_install_profile(profile):
+    # The post-install stage is part of what the install phase produces
+    global _post_install_profile
+    _post_install_profile = profile
 
 
-def user_home():
-    return os.path.expanduser('~')
+_build_root = None
 
 
-def users_home():
-    names = user_home().split(os.path.sep)
-    if names[-1] == os.environ.get('USER'):
-        names = names[:-1]
-    if names[0] == '':
-        names = names[1:]
-    return os.path.sep + os.path.sep.join(names)
+def default_build_directory():
+    return os.path.sep.join((user_home(), '.{}-build'.format(release_tag())))
 
 
-def source_directory():
-    return os.path.sep.join((user_home(), '.python34'))
+def build_directory():
+    return _build_root or default_build_directory()
 
 
-def build_directory():
-    return os.path.sep.join((user_home(), '.python34-build'))
+def memory_available():
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError, IndexError):
+        pass
+    return None
 
 
-def md5sum(filename, block_size=2**16):
-    md5 = hashlib.md5()
+def tmpfs_build_directory():
+    # None when the tmpfs is missing or there is not enough RAM behind it
     try:
-        file = open(filename, 'rb')
-        while 1:
-            data = file.read(block_size)
-            if not data:
-                break
-            md5.update(data)
-    except IOError:
-        print('Error calculating MD5 sum for file {}'.format(filename))
+        st = os.statvfs(TMPFS_DIRECTORY)
+    except OSError:
         return None
-    except:
+    available = memory_available()
+    if st.f_bavail * st.f_frsize < TMPFS_REQUIRED_BYTES or \
+            (available is not None and available < TMPFS_REQUIRED_BYTES):
         return None
-    return md5.hexdigest()
+    return os.path.sep.join((TMPFS_DIRECTORY, '{}-build-{}'.format(
+        release_tag(), os.getuid())))
+
+
+def set_build_root(build_root):
+    global _build_root
+    if build_root == 'tmpfs':
+        _build_root = tmpfs_build_directory()
+        if _build_root is None:
+            print('Not enough memory for a build in {}, building in '
+                  '{}'.format(TMPFS_DIRECTORY, default_build_directory()))
+    else:
+        _build_root = build_root and os.path.abspath(build_root)
+    return build_directory()
+
+
+def make_unique_build_directory():
+    # A build directory of this run only, under the build root, so runs
+    # building the same release at once do not wait for each other
+    root = build_directory()
+    if not os.path.exists(root):
+        os.makedirs(root)
+    global _build_root
+    _build_root = tempfile.mkdtemp(prefix='run-{}-'.format(
+        time.strftime('%Y%m%d-%H%M%S')), dir=root)
+    return _build_root
+
+
+def remove_build_trees():
+    # What a unique build directory holds besides the logs
+    for name in os.listdir(build_directory()):
+        if name != 'logs':
+            path = os.path.join(build_directory(), name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.unlink(path)
+
+
+def phase_timeout(phase, jobs=1):
+    expected = EXPECTED_PHASE_SECONDS[phase]
+    if phase == 'make':
+        expected *= (1 - MAKE_PARALLEL_FRACTION) + \
+            MAKE_PARALLEL_FRACTION / max(jobs, 1)
+    return max(PHASE_TIMEOUT_MIN, int(expected * PHASE_TIMEOUT_FACTOR))
+
+
+def run_task(task, results, origin):
+    record = {'name': task['name'], 'requires': list(task['requires']),
+              'status': 'ok', 'result': None, 'error': None,
+              'start': round(time.monotonic() - origin, 3)}
+    try:
+        record['result'] = task['run'](results)
+    except SystemExit as error:
+        # The ensure_* functions report their own errors and exit
+        if error.code not in (0, None):
+            record['status'] = 'failed'
+            record['error'] = 'exit status {}'.format(error.code)
+    except BaseException as error:
+        record['status'] = 'failed'
+        record['error'] = '{}: {}'.format(type(error).__name__, error)
+    record['end'] = round(time.monotonic() - origin, 3)
+    record['seconds'] = round(record['end'] - record['start'], 3)
+    return record
+
+
+def run_task_graph(tasks):
+    # tasks are dicts with a name, the names of the tasks it requires, a
+    # run(results) function and optionally when(results), which skips the
+    # task when false. A task starts as soon as all it requires are done,
+    # so independent tasks run at the same time. One that fails blocks the
+    # tasks depending on it, the others still run. Returns {name: record}.
+    names = [task['name'] for task in tasks]
+    for task in tasks:
+        for required in task['requires']:
+            if required not in names:
+                raise ValueError('{} requires unknown task {}'.format(
+                    task['name'], required))
+
+    origin = time.monotonic()
+    records = collections.OrderedDict()
+    results = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(1, len(tasks))) as executor:
+        while len(records) < len(tasks):
+            resolved = len(records)
+            for task in tasks:
+                name = task['name']
+                if name in records or name in running.values():
+                    continue
+                required = [records.get(r) for r in task['requires']]
+                if None in required:
+                    continue
+                failed = [r['name'] for r in required
+                          if r['status'] in ('failed', 'blocked')]
+                if failed or (task.get('when') and
+                              not task['when'](results)):
+                    records[name] = {'name': name,
+                                     'requires': list(task['requires']),
+                                     'status': 'blocked' if failed
+                                     else 'skipped',
+                                     'result': None,
+                                     'error': failed and 'needs {}'.format(
+                                         ', '.join(failed)) or None}
+                    results[name] = None
+                    continue
+                running[executor.submit(run_task, task, results,
+                                        origin)] = name
+            if not running:
+                if len(records) == resolved:
+                    raise ValueError('the tasks {} require each other'.format(
+                        ', '.join(name for name in names
+                                  if name not in records)))
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                record = future.result()
+                del running[future]
+                records[record['name']] = record
+                results[record['name']] = record['result']
+    return records
+
+
+def critical_path(records):
+    # The chain of tasks that decided the run time: from the task that
+    # ended last, back through the requirement of each that ended last
+    ran = dict((name, record) for name, record in records.items()
+               if 'end' in record)
+    if not ran:
+        return []
+    def ran_requirements(record):
+        # Through the skipped tasks, to what they required in turn
+        required = []
+        for name in record['requires']:
+            required.extend([ran[name]] if name in ran else
+                            ran_requirements(records[name]))
+        return required
+
+    path = [max(ran.values(), key=lambda record: record['end'])]
+    while True:
+        required = ran_requirements(path[-1])
+        if not required:
+            break
+        path.append(max(required, key=lambda record: record['end']))
+    return [record['name'] for record in reversed(path)]
+
+
+def print_task_graph(records):
+    print('Tasks:')
+    for record in records.values():
+        if 'end' in record:
+            print('  {:24} {:8} {:>8.1f}s -> {:>8.1f}s{}'.format(
+                record['name'], record['status'], record['start'],
+                record['end'], '  ' + record['error'] if record['error']
+                else ''))
+        else:
+            print('  {:24} {}{}'.format(
+                record['name'], record['status'], '  ' + record['error']
+                if record['error'] else ''))
+    path = critical_path(records)
+    if path:
+        print('Critical path: {} ({:.1f}s)'.format(
+            ' -> '.join('{} {:.1f}s'.format(name, records[name]['seconds'])
+                        for name in path),
+            records[path[-1]]['end'] - records[path[0]]['start']))
+
+
+def process_io():
+    # Bytes that reached the storage layer, for this process and every
+    # child it has waited for (the kernel folds those into the parent)
+    counters = {}
+    try:
+        with open('/proc/self/io') as io_file:
+            for line in io_file:
+                name, _, value = line.partition(':')
+                counters[name] = int(value)
+    except (IOError, ValueError):
+        return None, None
+    return counters.get('read_bytes'), counters.get('write_bytes')
+
+
+def resource_snapshot():
+    return (time.monotonic(),
+            resource.getrusage(resource.RUSAGE_SELF),
+            resource.getrusage(resource.RUSAGE_CHILDREN),
+            process_io())
+
+
+@contextmanager
+def file_lock(filepath, what):
+    # Held until the block is left, or the process dies: the kernel drops
+    # flock locks with the file descriptor, so no stale lock is left behind
+    directory = os.path.dirname(filepath)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(filepath, 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as error:
+            if error.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            print('Waiting for another run using {}...'.format(what))
+            sys.stdout.flush()
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def install_lock_filepath(install_directory):
+    # Next to the install directory, which is removed and replaced
+    return os.path.abspath(install_directory).rstrip(os.sep) + '.lock'
+
+
+@contextmanager
+def timed_phase(name):
+    # rusage and /proc/self/io add up the whole process, so a phase that
+    # ran next to one of another thread keeps only its wall time; the
+    # figures of a phase include those of the phases nested in it
+    running = {'thread': threading.get_ident(), 'overlapped': False}
+    with PHASE_REPORT_LOCK:
+        for other in _running_phases:
+            if other['thread'] != running['thread']:
+                other['overlapped'] = running['overlapped'] = True
+        _running_phases.append(running)
+    start, self_start, children_start, io_start = resource_snapshot()
+    try:
+        yield
+    finally:
+        end, self_end, children_end, io_end = resource_snapshot()
+        record = {
+            'phase': name,
+            'seconds': round(end - start, 3),
+            'user_seconds': round(
+                self_end.ru_utime - self_start.ru_utime +
+                children_end.ru_utime - children_start.ru_utime, 3),
+            'sys_seconds': round(
+                self_end.ru_stime - self_start.ru_stime +
+                children_end.ru_stime - children_start.ru_stime, 3),
+            # ru_maxrss is a high-water mark over the whole run, so a phase
+            # only has a peak of its own when it raised the mark
+            'peak_rss_kb': max(
+                self_end.ru_maxrss if
+                self_end.ru_maxrss > self_start.ru_maxrss else 0,
+                children_end.ru_maxrss if
+                children_end.ru_maxrss > children_start.ru_maxrss else 0) or
+            None,
+            'read_bytes': None,
+            'write_bytes': None,
+        }
+        if io_start[0] is not None and io_end[0] is not None:
+            record['read_bytes'] = io_end[0] - io_start[0]
+            record['write_bytes'] = io_end[1] - io_start[1]
+        with PHASE_REPORT_LOCK:
+            _running_phases.remove(running)
+            if running['overlapped']:
+                record.update(user_seconds=None, sys_seconds=None,
+                              peak_rss_kb=None, read_bytes=None,
+                              write_bytes=None)
+            record['overlapped'] = running['overlapped']
+            PHASE_REPORT.append(record)
+
+
+def format_cpu_seconds(seconds):
+    return '-' if seconds is None else '{:.1f}s'.format(seconds)
+
+
+def print_phase_timings():
+    if not PHASE_REPORT:
+        return
+    width = max(len(record['phase']) for record in PHASE_REPORT + [
+        {'phase': 'total'}])
+    print('Phase timings:{}  {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        ' ' * (width - 11), 'wall', 'user', 'sys', 'peak rss', 'written'))
+    for record in PHASE_REPORT:
+        print('  {}  {:8.1f}s {:>9} {:>9} {:>9} {:>9}'.format(
+            record['phase'].ljust(width), record['seconds'],
+            format_cpu_seconds(record['user_seconds']),
+            format_cpu_seconds(record['sys_seconds']),
+            format_bytes(record['peak_rss_kb'] and
+                         record['peak_rss_kb'] * 1024),
+            format_bytes(record['write_bytes'])))
+    total = sum(record['seconds'] for record in PHASE_REPORT)
+    print('  {}  {:8.1f}s'.format('total'.ljust(width), total))
+    if any(record['overlapped'] for record in PHASE_REPORT):
+        print('  -: ran next to another phase, no figures of its own')
+
+
+def write_phase_report(report_filepath, **details):
+    report = dict(details)
+    report['phases'] = PHASE_REPORT
+    report['total_seconds'] = round(sum(record['seconds']
+                                        for record in PHASE_REPORT), 3)
+    directory = os.path.dirname(os.path.abspath(report_filepath))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(report_filepath, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
 
 
 def get_source_filename():
-    return PYTHON34_DOWNLOAD_URL.split(os.path.sep)[-1]
+    return current_release()['url'].split(os.path.sep)[-1]
 
 
 def get_source_filepath():
     return os.path.sep.join((source_directory(), get_source_filename()))
 
 
-def ensure_source_downloaded(turn=3):
+def fetch_part(url, part_filepath, algorithm='md5',
+               block_size=DOWNLOAD_BLOCK_SIZE):
+    # Appends the rest of url to part_filepath, resuming where an earlier
+    # attempt stopped, and returns the checksum of the whole file. The sum
+    # is computed while the bytes are written, so the file is never reread
+    # except for the part kept from an earlier attempt.
+    md5 = hashlib.new(algorithm)
+    offset = 0
+    if os.path.exists(part_filepath):
+        with open(part_filepath, 'rb') as part_file:
+            offset = copy_hashed(part_file, digest=md5,
+                                 block_size=block_size)
+
+    request = urllib.request.Request(url)
+    if offset:
+        request.add_header('Range', 'bytes={}-'.format(offset))
+
+    try:
+        response = urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+    except urllib.error.HTTPError as error:
+        # Nothing left to fetch: the part file is already complete
+        if error.code == 416 and offset:
+            return md5.hexdigest()
+        raise
+
+    with response:
+        if offset and response.status != 206:
+            # The server ignored the Range header and sends everything
+            md5 = hashlib.new(algorithm)
+            offset = 0
+        length = response.getheader('Content-Length')
+        expected = int(length) if length and length.isdigit() else None
+
+        with open(part_filepath, 'ab' if offset else 'wb') as out_file:
+            received = copy_hashed(response, (out_file,), md5, block_size)
+
+    if expected is not None and received < expected:
+        raise http.client.IncompleteRead(b'', expected - received)
+
+    return md5.hexdigest()
+
+
+def download_file(url, filepath, expected_checksum, retries=DOWNLOAD_RETRIES,
+                  backoff=DOWNLOAD_BACKOFF):
+    # expected_checksum is (algorithm, hex digest)
+    algorithm, expected = expected_checksum
+    part_filepath = filepath + '.part'
+    for attempt in range(retries + 1):
+        try:
+            checksum = fetch_part(url, part_filepath, algorithm)
+        except (IOError, OSError, http.client.HTTPException) as msg:
+            print('Download interrupted: {}'.format(
+                str(msg) or type(msg).__name__))
+        else:
+            if checksum == expected:
+                os.replace(part_filepath, filepath)
+                return True
+            print('{} sum failed.'.format(algorithm.upper()))
+            os.unlink(part_filepath)
+
+        if attempt < retries:
+            delay = backoff * 2 ** attempt
+            print('Trying again in {}s...'.format(delay), end='')
+            sys.stdout.flush()
+            time.sleep(delay)
+    return False
+
+
+def ensure_source_downloaded(url=None, verify=True):
     home = users_home()
     if not os.path.exists(home):
         print('User home directory: {} not found'.format(home))
@@ -513,25 +642,55 @@ def ensure_source_downloaded(turn=3):
         print('Created directory {}'.format(sdir))
 
     sfile = get_source_filepath()
-    if not os.path.exists(sfile):
-        print('Downloading source to {}...'.format(sfile), end='')
-        sys.stdout.flush()
+    if os.path.exists(sfile) and not verify:
+        # The caller checks the sum while it reads the file anyway
+        return
+    algorithm, expected = release_checksum()
+    if os.path.exists(sfile):
+        with timed_phase('checksum'):
+            checksum = file_checksum(sfile, algorithm)
+        if checksum == expected:
+            return
+        if _mirror_directory:
+            source_missing_from_mirror('{} sum of {} failed'.format(
+                algorithm.upper(), sfile))
+        print('{} sum of {} failed, downloading it again'.format(
+            algorithm.upper(), sfile))
+        os.unlink(sfile)
+    elif _mirror_directory:
+        source_missing_from_mirror('{} not found'.format(sfile))
+
+    print('Downloading source to {}...'.format(sfile), end='')
+    sys.stdout.flush()
+
+    # The checksum is computed while downloading, so there is no separate
+    # checksum phase for a fresh download
+    with timed_phase('download'):
+        downloaded = download_file(url or current_release()['url'], sfile,
+                                   release_checksum())
+    if not downloaded:
+        print('{} sum failed. Check you internet connection!'.format(
+            algorithm.upper()))
+        exit(1)
 
-        with urllib.request.urlopen(PYTHON34_DOWNLOAD_URL) as response, \
-                open(sfile, 'wb') as out_file:
-            shutil.copyfileobj(response, out_file)
+    print('done')
 
-        print('done')
 
-    checksum = md5sum(sfile)
-    if checksum != PYTHON34_MD5_CHECKSUM:
-        os.unlink(sfile)
-        if turn > 0:
-            print('MD5 sum failed. Trying again...')
-            ensure_source_downloaded(turn-1)
-        else:
-            print('MD5 sum failed. Check you internet connection!')
-            exit(1)
+def prefetch_sources(releases, connections=prefetch.CONNECTIONS):
+    # Downloads the tarballs of all releases at once into the source (or
+    # mirror) directory, skipping those already there with a good sum
+    items = [{'url': release['url'],
+              'filepath': os.path.sep.join(
+                  (source_directory(), release['url'].split('/')[-1])),
+              'checksum': release_checksum(release)}
+             for release in releases]
+    print('Prefetching {} source(s) into {}, {} at a time...'.format(
+        len(items), source_directory(), connections))
+    sys.stdout.flush()
+    start = time.monotonic()
+    results = prefetch.prefetch(items, connections)
+    prefetch.print_results(results, time.monotonic() - start)
+    return all(result['status'] != 'failed' for result in results)
 
 
 def get_lsb_release():
@@ -544,39 +703,89 @@ def ensure_user_root():
         exit(1)
 
 
-def ensure_distribution_supported():
+def ensure_distribution_supported(release=None):
     lsb = get_lsb_release()
-    dist = DEPS.get(lsb['ID'], None)
-    if dist:
-        dist_rel = dist.get(lsb['RELEASE'], None)
-        if dist_rel:
-            return dist_rel
-        else:
-            print('This release of {} is not supported'.format(lsb))
-            exit(1)
+    deps = (release or current_release())['deps']
+    dist_rel = deps.get('{}/{}'.format(lsb['ID'], lsb['RELEASE']), None)
+    if dist_rel:
+        return dist_rel
+    elif any(distro.split('/')[0] == lsb['ID'] for distro in deps):
+        print('This release of {} is not supported'.format(lsb))
+        exit(1)
     else:
         print('This Linux Distribution is not supported')
         exit(1)
 
 
-def ensure_packages_installed(packages, install_packages=True):
-    missing = []
+def installed_versions_from_dpkg_query(packages):
+    C_env = os.environ.copy()
+    C_env['LC_ALL'] = 'C'
 
-    with open('/dev/null', 'w+') as devnull:
-        for pkg in packages:
-            status = call(['dpkg', '-s', pkg],
-                          timeout=5, stdout=devnull, stderr=devnull)
-            if status != 0:
-                missing.append(pkg)
+    # dpkg-query exits with 1 when some package is unknown, but still
+    # reports every package it does know about
+    output = subprocess.Popen(['dpkg-query', '-W', '-f',
+                               '${Package}\t${Version}\t${Status}\n'] +
+                              list(packages),
+                              env=C_env,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE,
+                              close_fds=True).communicate()[0].decode('utf-8')
+
+    installed = {}
+    for line in output.splitlines():
+        package, version, status = (line.split('\t') + ['', ''])[:3]
+        if status.split()[-1:] == ['installed']:
+            installed[package] = version
+    return installed
+
+
+def installed_packages_from_dpkg_query(packages):
+    return set(installed_versions_from_dpkg_query(packages))
+
+
+def installed_package_versions(packages):
+    # Reads the dpkg status file, which is much faster than dpkg-query
+    try:
+        return dpkg_installed_versions(
+            os.environ.get('PY34_DPKG_STATUS', '/var/lib/dpkg/status'),
+            packages)
+    except IOError:
+        return installed_versions_from_dpkg_query(packages)
+
+
+def missing_packages(packages, read_status=False):
+    packages = list(collections.OrderedDict.fromkeys(packages))
+
+    status_filepath = os.environ.get('PY34_DPKG_STATUS')
+    if status_filepath or read_status:
+        try:
+            installed = set(dpkg_installed_versions(
+                status_filepath or '/var/lib/dpkg/status', packages))
+        except IOError as msg:
+            print('Unable to read dpkg status:', str(msg), file=sys.stderr)
+            installed = installed_packages_from_dpkg_query(packages)
+    else:
+        installed = installed_packages_from_dpkg_query(packages)
+
+    return [pkg for pkg in packages if pkg not in installed]
+
+
+def ensure_packages_installed(packages, install_packages=True,
+                              read_status=False):
+    with timed_phase('dependency check'):
+        missing = missing_packages(packages, read_status)
 
     if missing:
         if install_packages:
-            for pkg in missing:
-                status = call(['apt-get', 'install', '-y', pkg], timeout=600)
-                if status != 0:
-                    print('Could not install {} package'.format(pkg))
-                    exit(1)
-            ensure_packages_installed(packages, False)
+            # One transaction: apt resolves and unpacks everything together
+            with timed_phase('dependency install'):
+                status = call(['apt-get', 'install', '-y'] + missing,
+                              timeout=APT_INSTALL_TIMEOUT)
+            if status != 0:
+                print('Could not install packages: {}'.format(
+                    ','.join(missing)))
+                exit(1)
+            ensure_packages_installed(packages, False, read_status)
         else:
             print('Missing packages: {}'.format(','.join(missing)))
             exit(1)
@@ -588,111 +797,1296 @@ def get_extracted_dir():
     return os.sep.join((build_directory(), dir_fname))
 
 
-def ensure_python34_built(install_directory):
-    build_dir = build_directory()
-    if os.path.exists(build_dir):
-        if input('Yes to remove old {}?'.format(build_dir)) == 'Yes':
-            shutil.rmtree(build_dir)
+def configure_options(install_directory, optimize=None):
+    options = ['--prefix={}'.format(install_directory)] + \
+        list(current_release()['configure_options'])
+    if optimize:
+        # Passed as arguments rather than through the environment so that
+        # config.status, the stamps and the build cache key all see them
+        options.append('CFLAGS={}'.format(LTO_CFLAGS))
+        options.append('LDFLAGS={}'.format(LTO_LDFLAGS))
+        if shutil.which('gcc-ar'):
+            options.append('AR=gcc-ar')
+    return options
+
+
+def pgo_task_args(training):
+    # training is a script path, or the stdlib tests by default
+    if training and training != 'tests':
+        return [os.path.abspath(training)]
+    return list(PGO_TRAINING_TESTS)
+
+
+def write_pgo_task_script():
+    script = os.path.sep.join((build_directory(), 'pgo_task.py'))
+    with open(script, 'w') as script_file:
+        script_file.write(PGO_TASK_SCRIPT)
+    return script
+
+
+def variant_directory(install_directory, optimize=None):
+    # configure runs out of tree, in a directory of its own for every set
+    # of options, so one extracted source tree feeds all of them
+    options = [get_source_filename()] + \
+        configure_options(install_directory, optimize)
+    if optimize:
+        options = options + pgo_task_args(optimize)
+    variant = hashlib.sha1('\0'.join(options).encode('utf-8')).hexdigest()
+    return os.path.sep.join((build_directory(), 'variants', variant[:12]))
+
+
+def phase_directory(phase, install_directory, optimize=None):
+    # Where a phase keeps its stamp: the source tree is shared, the rest
+    # belongs to a variant
+    if phase == 'extract':
+        return build_directory()
+    return variant_directory(install_directory, optimize)
+
+
+def stamp_directory(directory):
+    return os.path.sep.join((directory, 'stamps'))
+
+
+def stamp_filepath(phase, directory):
+    return os.path.sep.join((stamp_directory(directory), phase + '.json'))
+
+
+def read_stamp(phase, directory):
+    try:
+        with open(stamp_filepath(phase, directory)) as stamp_file:
+            return json.load(stamp_file)
+    except (IOError, ValueError):
+        return None
+
+
+def write_stamp(phase, inputs, directory):
+    sdir = stamp_directory(directory)
+    if not os.path.exists(sdir):
+        os.makedirs(sdir)
+    tmp_filepath = stamp_filepath(phase, directory) + '.tmp'
+    with open(tmp_filepath, 'w') as stamp_file:
+        json.dump(inputs, stamp_file, indent=2, sort_keys=True)
+    os.replace(tmp_filepath, stamp_filepath(phase, directory))
+
+
+def remove_stamp(phase, directory):
+    if os.path.exists(stamp_filepath(phase, directory)):
+        os.unlink(stamp_filepath(phase, directory))
+
+
+def phase_inputs(phase, install_directory, env=None, optimize=None):
+    # Each phase records everything that can change its outcome, so a
+    # stamp written by a different source, flag set or compiler is stale
+    inputs = {'phase': phase,
+              'source': get_source_filename(),
+              'source_checksum': release_checksum()[1]}
+    if phase != 'extract':
+        inputs['configure_options'] = configure_options(install_directory,
+                                                        optimize)
+        inputs['compiler'] = compiler_version()
+        if optimize:
+            inputs['pgo_training'] = pgo_task_args(optimize)
+        # configure writes CC into the Makefile, so switching the compiler
+        # cache on or off has to configure again
+        inputs['cc'] = (env or os.environ).get('CC', 'cc')
+    if phase == 'install' and _post_install_profile:
+        # A slim install lacks what another profile keeps
+        inputs['post_install'] = _post_install_profile
+    return inputs
+
+
+def phase_output_exists(phase, install_directory, optimize=None):
+    src_dir = get_extracted_dir()
+    variant_dir = variant_directory(install_directory, optimize)
+    if phase == 'extract':
+        # A tree configured in place, by an older version of this script,
+        # cannot be configured out of tree again
+        return os.path.isfile(os.path.join(src_dir, 'configure')) and \
+            not os.path.exists(os.path.join(src_dir, 'config.status'))
+    elif phase == 'configure':
+        return os.path.isfile(os.path.join(variant_dir, 'Makefile'))
+    elif phase == 'make':
+        return os.path.isfile(os.path.join(variant_dir, 'python'))
+    elif phase == 'install':
+        return os.path.isfile(os.path.join(install_directory, 'bin',
+                                           'python3'))
+    return False
+
+
+def phases_to_run(install_directory, force_phases=(), env=None,
+                  optimize=None):
+    # Once a phase has to run, every phase after it runs as well
+    for index, phase in enumerate(BUILD_PHASES):
+        directory = phase_directory(phase, install_directory, optimize)
+        if phase in force_phases or \
+                read_stamp(phase, directory) != phase_inputs(
+                    phase, install_directory, env, optimize) \
+                or not phase_output_exists(phase, install_directory,
+                                           optimize):
+            return BUILD_PHASES[index:]
+    return ()
+
+
+def log_directory():
+    return os.path.sep.join((build_directory(), 'logs'))
+
+
+def phase_log_filepath(phase):
+    return os.path.sep.join((log_directory(), phase + '.log'))
+
+
+def run_build_phase(phase, args, cwd, timeout, env=None):
+    ldir = log_directory()
+    if not os.path.exists(ldir):
+        os.makedirs(ldir)
+    with timed_phase(phase), open(phase_log_filepath(phase), 'w') as output:
+        return call(args, cwd=cwd, timeout=timeout, env=env,
+                    stdout=output, stderr=output)
+
+
+def phase_record(name):
+    # The latest record of a phase; other phases may have ended since
+    for record in reversed(PHASE_REPORT):
+        if record['phase'] == name:
+            return record
+    return None
+
+
+def record_extraction(name, result):
+    # Adds the throughput of an extraction to its phase record
+    phase_record(name).update(
+        (key, result[key]) for key in ('decompressor', 'members',
+                                       'bytes_in', 'bytes_out'))
+
+
+def extract_source(url=None):
+    # Runs sharing the download directory take turns downloading a source;
+    # an offline mirror is only read, and may well be read-only
+    if _mirror_directory:
+        return download_and_extract(url)
+    sfile = get_source_filepath()
+    if not os.path.exists(source_directory()):
+        os.makedirs(source_directory())
+    with file_lock(sfile + '.lock', sfile):
+        download_and_extract(url)
+
+
+def download_and_extract(url=None):
+    # The tarball is streamed into tarfile (through pixz/xz when present)
+    # and unpacked into a staging directory that only replaces the source
+    # tree once the checksum matched, so a bad archive never half-extracts
+    src_dir = get_extracted_dir()
+    sfile = get_source_filepath()
+    url = url or current_release()['url']
+    checksum = release_checksum()
+
+    # Without a tarball (or a partial download to resume) the download is
+    # unpacked as it arrives, and kept for the next run
+    if _mirror_directory and not os.path.exists(sfile):
+        source_missing_from_mirror('{} not found'.format(sfile))
+    if not os.path.exists(sfile) and not os.path.exists(sfile + '.part'):
+        print('Downloading and extracting {}...'.format(url), end='')
+        sys.stdout.flush()
+        try:
+            with timed_phase('download+extract'):
+                result = stream_extract.extract(url, src_dir, 1, checksum,
+                                                save_to=sfile)
+        except (stream_extract.ExtractError, IOError, OSError,
+                http.client.HTTPException) as msg:
+            print('error: {}'.format(str(msg) or type(msg).__name__))
         else:
+            record_extraction('download+extract', result)
+            print('done')
+            print('Extracted {}'.format(stream_extract.describe(result)))
+            return
+
+    for attempt in range(2):
+        ensure_source_downloaded(url, verify=False)
+
+        print('Extracting {}..'.format(sfile), end='')
+        sys.stdout.flush()
+        try:
+            with timed_phase('extract'):
+                result = stream_extract.extract(sfile, src_dir, 1, checksum)
+        except stream_extract.ExtractError as msg:
+            print('error: {}'.format(msg))
+            if _mirror_directory:
+                source_missing_from_mirror('Could not extract {}'.format(
+                    sfile))
+            # A corrupt tarball is downloaded again, once
+            os.unlink(sfile)
+            continue
+        except (IOError, OSError) as msg:
+            print('error')
+            print('Could not extract files to {}: {}'.format(src_dir, msg))
             exit(1)
 
+        record_extraction('extract', result)
+        print('done')
+        print('Extracted {}'.format(stream_extract.describe(result)))
+        return
+
+    print('Could not extract {}'.format(sfile))
+    exit(1)
+
+
+def dev_packages():
+    # The -dev packages in DEPS for this distribution, whose headers and
+    # libraries configure probes
+    lsb = get_lsb_release()
+    packages = current_release()['deps'].get('{}/{}'.format(
+        lsb['ID'], lsb['RELEASE']), ())
+    return [package for package in packages if package.endswith('-dev')]
+
+
+def prepare_config_cache(cache_file, options, env=None):
+    # A cache made with another compiler or other -dev packages is dropped
+    packages = dev_packages()
+    key = config_cache.cache_key('python', get_distro_information(),
+                                 compiler_version(), options, env)
+    stamp = config_cache.toolchain_stamp(
+        compiler_version(),
+        installed_package_versions(packages) if packages else {}, env)
+    return config_cache.prepare(key, stamp, cache_file,
+                                _config_cache_directory)
+
+
+def configure_source(install_directory, env=None, optimize=None):
+    src_dir = get_extracted_dir()
+    variant_dir = variant_directory(install_directory, optimize)
+
+    # Objects left over from an earlier configure would look newer than
+    # freshly extracted sources, so make would keep them
+    if os.path.exists(variant_dir):
+        shutil.rmtree(variant_dir)
+    os.makedirs(variant_dir)
+
+    print('Configuring sources in {}...'.format(variant_dir), end='')
+    sys.stdout.flush()
+
+    options = configure_options(install_directory, optimize)
+    args = [os.path.join(src_dir, 'configure')] + options
+    cache = None
+    if _config_cache_directory:
+        cache_file = os.path.join(variant_dir, config_cache.CACHE_NAME)
+        cache = prepare_config_cache(cache_file, options, env)
+        args.append('--cache-file={}'.format(cache_file))
+
+    status = run_build_phase('configure', args, variant_dir,
+                             phase_timeout('configure'), env)
+    if status != 0 and cache and cache['status'] == 'hit':
+        # An answer the cache got wrong can break configure, which then
+        # probes everything again
+        print('failed with the config cache, again without it...', end='')
+        sys.stdout.flush()
+        config_cache.drop(cache, _config_cache_directory)
+        os.unlink(cache_file)
+        cache['status'] = 'invalidated'
+        cache['changes'] = ['configure failed with it']
+        status = run_build_phase('configure', args, variant_dir,
+                                 phase_timeout('configure'), env)
+    if status != 0:
+        print('error')
+        print('Could not configure python sources in {}, see {}'.format(
+            variant_dir, phase_log_filepath('configure')))
+        exit(1)
+
+    print('done')
+    if cache:
+        record = phase_record('configure')
+        meta = config_cache.save(cache, cache_file, record['seconds'],
+                                 _config_cache_directory)
+        record['config_cache'] = cache['status']
+        record['config_cache_saved_seconds'] = meta['saved']
+        print(config_cache.describe(cache, meta, record['seconds']))
+
+
+def compile_source(install_directory, jobs, env=None, optimize=None):
+    variant_dir = variant_directory(install_directory, optimize)
+
+    args = ['make', '-j{}'.format(jobs)]
+    timeout = phase_timeout('make', jobs)
+    if optimize:
+        # CPython's profile-opt target builds an instrumented interpreter,
+        # runs PROFILE_TASK with it and rebuilds with the profile data
+        task = [write_pgo_task_script()] + pgo_task_args(optimize)
+        args += ['profile-opt', 'PROFILE_TASK={}'.format(' '.join(task))]
+        timeout = 2 * timeout + PGO_TRAINING_SECONDS * PHASE_TIMEOUT_FACTOR
+        print('Compiling sources with {} jobs, PGO and LTO '
+              '(this builds twice)...'.format(jobs), end='')
+    else:
+        print('Compiling sources with {} jobs...'.format(jobs), end='')
+    sys.stdout.flush()
+
+    status = run_build_phase('make', args, variant_dir, timeout, env)
+    if status != 0:
+        print('error')
+        print('Could not compile python sources in {}, see {}'.format(
+            variant_dir, phase_log_filepath('make')))
+        exit(1)
+
+    print('done')
+
+
+def confirm(question):
+    if _assume_yes:
+        return True
+    try:
+        return input(question) == 'Yes'
+    except EOFError:
+        print('no answer, use --yes to run without a terminal')
+        return False
+
+
+def confirm_remove_install_directory(install_directory):
+    # Set by a multi-release run, which asked once for all of its builds
+    if os.environ.get('PY34_REPLACE_INSTALL') == install_directory:
+        if os.path.exists(install_directory):
+            shutil.rmtree(install_directory)
+        return
     if os.path.exists(install_directory):
-        if input('Yes to remove old {}?'.format(install_directory)) == 'Yes':
+        if confirm('Yes to remove old {}?'.format(install_directory)):
             shutil.rmtree(install_directory)
         else:
             exit(1)
 
-    log_filepath = os.path.sep.join((build_dir, 'errors.log'))
 
+def install_build(install_directory, optimize=None):
+    variant_dir = variant_directory(install_directory, optimize)
+
+    confirm_remove_install_directory(install_directory)
+
+    print('Installing to {}...'.format(install_directory), end='')
+    sys.stdout.flush()
+
+    # make install is mostly copying and byte-compiling, and upstream
+    # does not test it under -j, so it stays serial
+    status = run_build_phase('install', ['make', 'install'],
+                             variant_dir, phase_timeout('install'))
+    if status != 0:
+        print('error')
+        print('Could not install python3 in {}, see {}'.format(
+            install_directory, phase_log_filepath('install')))
+        exit(1)
+
+    print('done')
+
+
+def ensure_python34_built(install_directory, jobs=1, force_phases=(),
+                          env=None, optimize=None):
+    build_dir = build_directory()
     if not os.path.exists(build_dir):
-        os.mkdir(build_dir)
+        os.makedirs(build_dir)
 
-        # extract source
+    with file_lock(os.path.sep.join((build_dir, '.lock')), build_dir):
+        build_phases(install_directory, jobs, force_phases, env, optimize)
 
-        sfile = get_source_filepath()
-        print('Extracting {}..'.format(sfile), end='')
-        sys.stdout.flush()
 
-        with open(log_filepath, 'w+') as output:
+def build_phases(install_directory, jobs=1, force_phases=(), env=None,
+                 optimize=None):
+    for phase in plan_build(install_directory, force_phases, env, optimize):
+        run_phase(phase, install_directory, jobs, env, optimize)
 
-            status = call(['tar', 'xf', sfile, '-C', build_dir],
-                          timeout=10, stdout=output, stderr=output)
 
-            if status != 0:
-                print('error')
-                print('Could not extract files to {}'.format(build_dir))
-                exit(1)
+def plan_build(install_directory, force_phases=(), env=None, optimize=None):
+    pending = phases_to_run(install_directory, force_phases, env, optimize)
+    for phase in BUILD_PHASES:
+        if phase not in pending:
+            print('Skipping {}, already done'.format(phase))
 
-        print('done')
+    # Drop the stamps up front so an interrupted run never leaves a valid
+    # stamp behind a phase whose predecessor was redone
+    for phase in pending:
+        remove_stamp(phase, phase_directory(phase, install_directory,
+                                            optimize))
+    return pending
 
-        # compile
 
-        src_dir = get_extracted_dir()
-        os.chdir(src_dir)
+def run_phase(phase, install_directory, jobs=1, env=None, optimize=None):
+    if phase == 'extract':
+        extract_source()
+    elif phase == 'configure':
+        configure_source(install_directory, env, optimize)
+    elif phase == 'make':
+        compile_source(install_directory, jobs, env, optimize)
+    elif phase == 'install':
+        install_build(install_directory, optimize)
+    write_stamp(phase, phase_inputs(phase, install_directory, env, optimize),
+                phase_directory(phase, install_directory, optimize))
 
-        print('Configuring sources...', end='')
-        sys.stdout.flush()
 
-        with open(log_filepath, 'w+') as output:
-            status = call(['./configure',
-                           '--prefix={}'.format(install_directory),
-                           '--disable-ipv6',
-                           '--with-dbmliborder=bdb:gdbm'],
-                          timeout=600, stdout=output, stderr=output)
+def build_cache_parts(install_directory, optimize=None):
+    parts = {'product': 'python',
+             'release': current_release()['version'],
+             'source_checksum': release_checksum()[1],
+             'configure_options': configure_options(install_directory,
+                                                    optimize)}
+    if optimize:
+        parts['pgo_training'] = pgo_task_args(optimize)
+    if _post_install_profile:
+        parts['post_install'] = _post_install_profile
+    parts.update(build_cache.toolchain_parts(get_distro_information(),
+                                             compiler_version()))
+    return parts
 
-        if status != 0:
-            print('error')
-            print('Could not configure python sources in {}'.format(src_dir))
-            exit(1)
-        else:
-            print('done')
 
-        print('Compiling sources...', end='')
-        sys.stdout.flush()
+def restore_cached_build(install_directory, key, cache_dir):
+    if build_cache.lookup(key, cache_dir) is None:
+        print('No cached build {}'.format(key))
+        return False
 
-        with open(log_filepath, 'a') as output:
-            status = call(['make'], timeout=600, stdout=output, stderr=output)
+    confirm_remove_install_directory(install_directory)
 
-        if status != 0:
-            print('error')
-            print('Could not compile python sources in {}'.format(src_dir))
-            exit(1)
-        else:
-            print('done')
+    print('Restoring {} from build cache...'.format(install_directory),
+          end='')
+    sys.stdout.flush()
 
-        with open(log_filepath, 'a') as output:
-            status = call(['make', 'install'],
-                          timeout=600, stdout=output, stderr=output)
+    with timed_phase('cache restore'):
+        restored = build_cache.restore(key, install_directory, cache_dir)
 
-        if status != 0:
-            print('error')
-            print('Could not install python3 in {}'.format(src_dir))
-            exit(1)
-        else:
-            print('done')
-    else:
-        print('Could not empty {} directory'.format(build_dir))
+    print('done' if restored else 'error')
+    return restored
+
+
+def store_cached_build(install_directory, key, parts, cache_dir, max_size):
+    print('Storing {} in build cache...'.format(install_directory), end='')
+    sys.stdout.flush()
+
+    with timed_phase('cache store'):
+        build_cache.store(key, install_directory, parts, cache_dir, max_size)
+
+    print('done')
+
+
+def pack_build(install_directory, archive):
+    print('Packing {} into {}...'.format(install_directory, archive), end='')
+    sys.stdout.flush()
+    try:
+        with timed_phase('pack'):
+            manifest = relocate.pack(install_directory, archive, 'python',
+                                     current_release()['version'])
+    except (IOError, OSError, tarfile.TarError) as msg:
+        print('error')
+        print('Could not pack {}: {}'.format(install_directory, msg))
+        exit(1)
+    print('done ({}, {} files to rewrite when unpacked)'.format(
+        format_bytes(manifest['size']), len(manifest['rewrite'])))
+
+
+def unpack_build(archive, install_directory):
+    confirm_remove_install_directory(install_directory)
+
+    print('Unpacking {} into {}...'.format(archive, install_directory),
+          end='')
+    sys.stdout.flush()
+    try:
+        with timed_phase('unpack'):
+            manifest = relocate.unpack(archive, install_directory)
+    except (stream_extract.ExtractError, IOError, OSError,
+            tarfile.TarError) as msg:
+        print('error')
+        print('Could not unpack {}: {}'.format(archive, msg))
+        exit(1)
+    print('done ({} files rewritten for the new prefix)'.format(
+        manifest['rewritten']))
+
+
+def install_post_processed(install_directory, profile, jobs=1):
+    # Bytecode at every optimization level, stripped binaries and, for the
+    # slim profile, no test suite, so hosts start the interpreter faster
+    print('Post-processing {} ({})...'.format(install_directory, profile),
+          end='')
+    sys.stdout.flush()
+    try:
+        with timed_phase('post-install'):
+            report = post_install.post_install(install_directory, profile,
+                                               jobs)
+    except (IOError, OSError) as msg:
+        print('error')
+        print('Could not post-process {}: {}'.format(install_directory, msg))
         exit(1)
+    print('done')
+    print('\n'.join(post_install.describe(report)))
+    phase_record('post-install').update(
+        (key, value) for key, value in report.items() if key != 'seconds')
+
+
+def fingerprint_filepath(install_directory):
+    return os.path.sep.join((install_directory, FINGERPRINT_NAME))
+
+
+def build_fingerprint(install_directory, packages, optimize=None):
+    # Everything the install depends on: rebuilding with the same
+    # fingerprint would produce the same interpreter
+    distinfo = get_distro_information()
+    fingerprint = {'version': current_release()['version'],
+                   'source_checksum': list(release_checksum()),
+                   'configure_options': configure_options(install_directory,
+                                                          optimize),
+                   'optimize': optimize,
+                   'distro': '{}/{}'.format(distinfo.get('ID'),
+                                            distinfo.get('RELEASE')),
+                   'compiler': compiler_version(),
+                   'dependencies': installed_package_versions(packages)}
+    if optimize:
+        fingerprint['pgo_training'] = pgo_task_args(optimize)
+    if _post_install_profile:
+        fingerprint['post_install'] = _post_install_profile
+    return fingerprint
+
+
+def read_fingerprint(install_directory):
+    try:
+        with open(fingerprint_filepath(install_directory)) as fingerprint:
+            return json.load(fingerprint)
+    except (IOError, ValueError):
+        return None
+
+
+def write_fingerprint(install_directory, fingerprint):
+    filepath = fingerprint_filepath(install_directory)
+    with open(filepath + '.tmp', 'w') as fingerprint_file:
+        json.dump(fingerprint, fingerprint_file, indent=2, sort_keys=True)
+    os.replace(filepath + '.tmp', filepath)
+
+
+def fingerprint_changes(install_directory, fingerprint):
+    # What differs between the install and the requested build, nothing
+    # when it is up to date
+    if not os.path.isfile(os.path.sep.join((install_directory, 'bin',
+                                            'python3'))):
+        return ['no python3 in {}'.format(install_directory)]
+    installed = read_fingerprint(install_directory)
+    if installed is None:
+        return ['no build fingerprint in {}'.format(install_directory)]
+
+    changes = []
+    for key in sorted(set(installed) | set(fingerprint)):
+        if key == 'dependencies':
+            continue
+        if installed.get(key) != fingerprint.get(key):
+            changes.append('{}: {} -> {}'.format(key, installed.get(key),
+                                                 fingerprint.get(key)))
+    before = installed.get('dependencies', {})
+    after = fingerprint.get('dependencies', {})
+    for package in sorted(set(before) | set(after)):
+        if before.get(package) != after.get(package):
+            changes.append('{}: {} -> {}'.format(
+                package, before.get(package, 'not installed'),
+                after.get(package, 'not installed')))
+    return changes
+
+
+def registry_build_name(install_directory, optimize=None):
+    # The version and the variant, which stands for the configure options
+    return '{}-{}'.format(current_release()['version'], os.path.basename(
+        variant_directory(install_directory, optimize)))
+
+
+def registry_up_to_date(install_directory, fingerprint):
+    # One indexed lookup: the registry has the fingerprint key of every
+    # install recorded by record_in_registry()
+    try:
+        installation = registry.find_installation(registry.connect(),
+                                                  install_directory)
+    except (sqlite3.Error, IOError, OSError):
+        return False
+    return installation is not None and \
+        installation['product'] == 'python' and \
+        installation['fingerprint'] == build_cache.cache_key(fingerprint) \
+        and os.path.isfile(os.path.sep.join((install_directory, 'bin',
+                                             'python3')))
+
+
+def install_changes(install_directory, fingerprint):
+    # The registry answers for the installs it knows, the fingerprint file
+    # for the others (and tells what changed)
+    if registry_up_to_date(install_directory, fingerprint):
+        return []
+    return fingerprint_changes(install_directory, fingerprint)
 
 
-def main(install_directory):
+def record_in_registry(install_directory, fingerprint, records,
+                       optimize=None, keep_build=True):
+    # The build (when this run made one and keeps its tree) and the
+    # install go into the registry shared with kerl, with their size and
+    # the seconds they took
+    name = registry_build_name(install_directory, optimize)
+    key = build_cache.cache_key(fingerprint)
+    try:
+        connection = registry.connect()
+        built = [records[phase] for phase in BUILD_PHASES
+                 if 'end' in records[phase]]
+        if built and keep_build:
+            variant_dir = variant_directory(install_directory, optimize)
+            registry.record_build(
+                connection, 'python', name, fingerprint['version'],
+                variant_dir, key, tree_size(variant_dir),
+                round(sum(record['seconds'] for record in built), 3))
+        registry.record_installation(
+            connection, 'python', name, install_directory,
+            fingerprint['version'], key,
+            tree_size(install_directory),
+            max(record['end'] for record in records.values()
+                if 'end' in record))
+    except (sqlite3.Error, IOError, OSError) as msg:
+        print('Could not record the install in the registry {}: {}'.format(
+            registry.registry_path(), msg))
+
+
+def check_install(install_directory, optimize=None):
+    # --check: exits with 0 when the install matches the request, with 1
+    # (after listing what changed) when it has to be built again
+    packages = ensure_distribution_supported()
+    changes = install_changes(install_directory, build_fingerprint(
+        install_directory, packages, optimize))
+    if not changes:
+        print('Python {} in {} is up to date'.format(
+            current_release()['version'], install_directory))
+        return True
+    print('Python {} in {} needs a build:'.format(
+        current_release()['version'], install_directory))
+    for change in changes:
+        print('  {}'.format(change))
+    return False
+
+
+def install_tasks(args, state, locks):
+    # The task graph of an install: the source is downloaded and extracted
+    # (unless the build cache has the build) while the build dependencies
+    # are installed. The baseline benchmark waits for both, so that it
+    # measures an otherwise idle host, and configure, a cache restore or an
+    # unpack wait for it. state collects what the steps after the graph
+    # need.
+    def needed(results):
+        return state['needed']
+
+    def distribution_check(results):
+        with timed_phase('distribution check'):
+            return ensure_distribution_supported()
+
+    def fingerprint_check(results):
+        # Nothing to do when the install already is the requested build,
+        # so that running this again (from configuration management) is
+        # cheap
+        changes = install_changes(args.install_directory,
+                                  build_fingerprint(
+                                      args.install_directory,
+                                      results['distribution check'],
+                                      args.optimize))
+        state['needed'] = bool(changes or args.force_phase or args.unpack)
+
+    def dependencies(results):
+        ensure_packages_installed(results['distribution check'],
+                                  read_status=args.read_dpkg_status)
+
+    def baseline_benchmark(results):
+        # The interpreter being replaced is the baseline an optimized build
+        # has to beat, so it is measured before it goes away
+        if not os.path.exists(state['baseline_python']):
+            print('No baseline interpreter at {}, use --baseline-python to '
+                  'compare the optimized build against one'.format(
+                      state['baseline_python']))
+            return
+        with timed_phase('baseline benchmark'):
+            state['baseline'] = micro_bench.run_benchmarks(
+                state['baseline_python'])
+
+    def cache_lookup(results):
+        # Only whether the build is cached: restoring it replaces the
+        # interpreter the baseline benchmark measures
+        state['cache_parts'] = build_cache_parts(args.install_directory,
+                                                 args.optimize)
+        state['cache_key'] = build_cache.cache_key(state['cache_parts'])
+        state['cached'] = build_cache.lookup(state['cache_key'],
+                                             args.cache_dir) is not None
+        if not state['cached']:
+            print('No cached build {}'.format(state['cache_key']))
+
+    def cache_restore(results):
+        state['restored'] = restore_cached_build(
+            args.install_directory, state['cache_key'], args.cache_dir)
+        if not state['restored']:
+            print('Building {} instead'.format(args.install_directory))
+            for phase in plan(results):
+                phase_task(phase)(results)
+
+    def unpack(results):
+        unpack_build(args.unpack, args.install_directory)
+
+    def plan(results):
+        # A unique build directory is made first, so that the lock is the
+        # one of this run and not the one shared by the release
+        if args.unique_build_dir:
+            print('Building in {}'.format(make_unique_build_directory()))
+        build_dir = build_directory()
+        if not os.path.exists(build_dir):
+            os.makedirs(build_dir)
+        locks.enter_context(file_lock(os.path.sep.join((build_dir,
+                                                        '.lock')),
+                                      build_dir))
+        if args.compiler_cache:
+            state['build_env'] = cc_cache.compiler_cache_env(
+                args.compiler_cache_dir)
+            state['cache_stats'] = cc_cache.cache_stats(state['build_env'])
+        return plan_build(args.install_directory, args.force_phase,
+                          state['build_env'], args.optimize)
+
+    def post_install_stage(results):
+        install_post_processed(args.install_directory, args.post_install,
+                               args.jobs)
+
+    def phase_task(phase):
+        def run(results):
+            run_phase(phase, args.install_directory, args.jobs,
+                      state['build_env'], args.optimize)
+        return run
+
+    def phase_pending(phase):
+        return lambda results: phase in (results['plan'] or ())
+
+    tasks = [
+        {'name': 'distribution check', 'requires': (),
+         'run': distribution_check},
+        {'name': 'fingerprint', 'requires': ('distribution check',),
+         'run': fingerprint_check},
+        {'name': 'dependencies', 'requires': ('fingerprint',),
+         'run': dependencies,
+         'when': lambda results: needed(results) and
+         not args.skip_dependencies},
+        {'name': 'cache lookup', 'requires': ('fingerprint',),
+         'run': cache_lookup,
+         'when': lambda results: needed(results) and
+         bool(args.cache_dir) and not args.unpack},
+        {'name': 'plan', 'requires': ('cache lookup',), 'run': plan,
+         'when': lambda results: needed(results) and not args.unpack and
+         not state['cached']},
+        {'name': 'extract', 'requires': ('plan',)},
+        {'name': 'baseline benchmark',
+         'requires': ('dependencies', 'extract'),
+         'run': baseline_benchmark,
+         'when': lambda results: needed(results) and bool(args.optimize)},
+        {'name': 'cache restore', 'requires': ('baseline benchmark',),
+         'run': cache_restore,
+         'when': lambda results: needed(results) and state['cached']},
+        {'name': 'unpack', 'requires': ('baseline benchmark',),
+         'run': unpack,
+         'when': lambda results: needed(results) and bool(args.unpack)},
+        {'name': 'configure',
+         'requires': ('extract', 'dependencies', 'baseline benchmark')},
+        {'name': 'make', 'requires': ('configure',)},
+        {'name': 'install', 'requires': ('make',)},
+        {'name': 'post-install',
+         'requires': ('install', 'cache restore', 'unpack'),
+         'run': post_install_stage,
+         'when': lambda results: needed(results) and
+         bool(args.post_install) and not state['restored']},
+    ]
+    for task in tasks:
+        if task['name'] in BUILD_PHASES:
+            task['run'] = phase_task(task['name'])
+            task['when'] = phase_pending(task['name'])
+    return tasks
+
+
+def main(args):
+    if args.check:
+        exit(0 if check_install(args.install_directory, args.optimize)
+             else 1)
+
     ensure_user_root()
-    ensure_source_downloaded()
-    packages_needed = ensure_distribution_supported()
-    ensure_packages_installed(packages_needed)
-    ensure_python34_built(install_directory)
+    build_dir = set_build_root(args.build_root)
+    if args.build_root:
+        print('Building in {}'.format(build_dir))
+
+    state = {'needed': True, 'cached': False, 'restored': False,
+             'build_env': None, 'cache_stats': None, 'cache_key': None,
+             'cache_parts': None, 'baseline': None,
+             'baseline_python': args.baseline_python or os.path.sep.join(
+                 (args.install_directory, 'bin', 'python3'))}
+
+    # Runs for the same install directory take turns; one that waited
+    # usually finds the install up to date
+    with file_lock(install_lock_filepath(args.install_directory),
+                   args.install_directory), ExitStack() as locks:
+        records = run_task_graph(install_tasks(args, state, locks))
+        failed = [record for record in records.values()
+                  if record['status'] == 'failed']
+        if failed:
+            print_task_graph(records)
+            for record in failed:
+                print('{} failed ({}), see the messages above'.format(
+                    record['name'], record['error']))
+            exit(1)
+        if not state['needed']:
+            print('Python {} in {} is up to date, use --force-phase to '
+                  'build it again'.format(current_release()['version'],
+                                          args.install_directory))
+            exit(0)
+
+        if state['build_env']:
+            cc_cache.print_cache_stats(cc_cache.stats_delta(
+                state['cache_stats'], cc_cache.cache_stats(
+                    state['build_env'])))
+        if state['cache_key'] and not state['restored']:
+            store_cached_build(args.install_directory, state['cache_key'],
+                               state['cache_parts'], args.cache_dir,
+                               args.cache_max_size)
+
+        # Taken again: the dependencies may have changed since the check
+        fingerprint = build_fingerprint(
+            args.install_directory, records['distribution check']['result'],
+            args.optimize)
+        write_fingerprint(args.install_directory, fingerprint)
+        record_in_registry(args.install_directory, fingerprint, records,
+                           args.optimize, not args.unique_build_dir)
+
+        if args.pack:
+            pack_build(args.install_directory, args.pack)
+
+    benchmark = None
+    baseline_python = state['baseline_python']
+    if state['baseline']:
+        with timed_phase('optimized benchmark'):
+            optimized = micro_bench.run_benchmarks(os.path.sep.join(
+                (args.install_directory, 'bin', 'python3')))
+        if optimized:
+            speedup = micro_bench.print_comparison(state['baseline'],
+                                                   optimized,
+                                                   baseline_python,
+                                                   'optimized build')
+            benchmark = {'baseline_python': baseline_python,
+                         'baseline': state['baseline'],
+                         'optimized': optimized,
+                         'speedup': speedup and round(1 / speedup, 3)}
+            if speedup and speedup >= 1:
+                print('WARNING: the optimized build is not faster than '
+                      '{}'.format(baseline_python))
+
+    print_phase_timings()
+    print_task_graph(records)
+    write_phase_report(args.report or os.path.sep.join(
+                           (log_directory(), 'report.json')),
+                       version=current_release()['version'],
+                       source=get_source_filename(),
+                       install_directory=args.install_directory,
+                       jobs=args.jobs,
+                       optimize=args.optimize,
+                       benchmark=benchmark,
+                       tasks=[dict((key, value) for key, value in
+                                   record.items() if key != 'result')
+                              for record in records.values()],
+                       critical_path=critical_path(records))
+    if args.unique_build_dir:
+        remove_build_trees()
     exit(0)
 
 
+def releases_logs_directory():
+    return os.path.sep.join((user_home(), '.python-builds'))
+
+
+def release_command(args, release, jobs, report_filepath):
+    # py34_install.py building a single release of a multi-release run
+    command = [sys.executable, os.path.abspath(__file__),
+               '--manifest', os.path.abspath(args.manifest),
+               '--release', release['version'],
+               '--install-directory', release_home(release),
+               '--jobs', str(jobs),
+               '--skip-dependencies',
+               '--report', report_filepath]
+    if args.build_root:
+        command += ['--build-root', args.build_root
+                    if args.build_root == 'tmpfs' else os.path.join(
+                        args.build_root, 'python-' + release['version'])]
+    for phase in args.force_phase:
+        command += ['--force-phase', phase]
+    if args.unique_build_dir:
+        command.append('--unique-build-dir')
+    if args.compiler_cache:
+        command.append('--compiler-cache')
+    if args.compiler_cache_dir:
+        command += ['--compiler-cache-dir', args.compiler_cache_dir]
+    if args.config_cache:
+        command.append('--config-cache')
+    if args.config_cache_dir:
+        command += ['--config-cache-dir', args.config_cache_dir]
+    if args.optimize:
+        command.append('--optimize={}'.format(args.optimize))
+    if args.mirror:
+        command += ['--mirror', args.mirror]
+    if args.mirror_dir:
+        command += ['--mirror-dir', os.path.abspath(args.mirror_dir)]
+    if args.cache_dir:
+        command += ['--cache-dir', args.cache_dir]
+    if args.cache_max_size:
+        command += ['--cache-max-size', args.cache_max_size]
+    if args.post_install:
+        command.append('--post-install={}'.format(args.post_install))
+    return command
+
+
+def build_release(args, release, jobs, confirmed):
+    version = release['version']
+    ldir = releases_logs_directory()
+    log_filepath = os.path.sep.join((ldir, 'python-{}.log'.format(version)))
+    report_filepath = os.path.sep.join(
+        (ldir, 'python-{}-report.json'.format(version)))
+    result = {'version': version, 'install_directory': release_home(release),
+              'jobs': jobs, 'status': 'failed', 'seconds': None,
+              'log': log_filepath}
+
+    env = dict(os.environ)
+    if release_home(release) in confirmed:
+        env['PY34_REPLACE_INSTALL'] = release_home(release)
+
+    print('Building Python {} with {} jobs...'.format(version, jobs))
+    sys.stdout.flush()
+    start = time.monotonic()
+    with open(log_filepath, 'w') as output:
+        status = call(release_command(args, release, jobs, report_filepath),
+                      stdin=subprocess.DEVNULL, stdout=output,
+                      stderr=subprocess.STDOUT, env=env)
+    result['seconds'] = round(time.monotonic() - start, 1)
+    try:
+        with open(report_filepath) as report_file:
+            result['report'] = json.load(report_file)
+    except (IOError, ValueError):
+        result['report'] = None
+
+    if status == 0:
+        result['status'] = 'ok'
+    print('Python {}: {}'.format(version, result['status'] if status == 0
+                                 else 'failed, see {}'.format(log_filepath)))
+    sys.stdout.flush()
+    return result
+
+
+def main_releases(args, releases):
+    # Several releases at once: dependencies are installed here in one go,
+    # then every release is built by its own py34_install.py sharing the
+    # download directory, the compiler, config and build caches
+    if args.check:
+        up_to_date = []
+        for release in releases:
+            set_release(release)
+            up_to_date.append(check_install(release_home(release),
+                                            args.optimize))
+        exit(0 if all(up_to_date) else 1)
+
+    ensure_user_root()
+
+    homes = [release_home(release) for release in releases]
+    tags = [release_tag(release) for release in releases]
+    if len(set(homes)) != len(homes) or \
+            (not args.build_root and len(set(tags)) != len(tags)):
+        print('Releases of the same minor version need a "home" of their '
+              'own in the manifest and --build-root')
+        exit(1)
+
+    with timed_phase('distribution check'):
+        release_packages = [ensure_distribution_supported(release)
+                            for release in releases]
+    if not args.skip_dependencies:
+        ensure_packages_installed(
+            list(itertools.chain.from_iterable(release_packages)),
+            read_status=args.read_dpkg_status)
+
+    # Releases already up to date do not get a py34_install.py of their own
+    if not args.force_phase:
+        pending = []
+        for release, packages in zip(releases, release_packages):
+            set_release(release)
+            if install_changes(release_home(release), build_fingerprint(
+                    release_home(release), packages, args.optimize)):
+                pending.append(release)
+            else:
+                print('Python {} in {} is up to date'.format(
+                    release['version'], release_home(release)))
+        releases = pending
+        homes = [release_home(release) for release in releases]
+        if not releases:
+            exit(0)
+
+    # Nobody is watching the builds' output, so ask about every install
+    # directory that would be replaced before any of them starts
+    confirmed = set()
+    for home in homes:
+        if os.path.exists(home):
+            if not confirm('Yes to remove old {}?'.format(home)):
+                exit(1)
+            confirmed.add(home)
+
+    ldir = releases_logs_directory()
+    if not os.path.exists(ldir):
+        os.makedirs(ldir)
+
+    # All sources are fetched up front, so releases waiting for a free job
+    # slot do not wait for their download too; a failed one is retried by
+    # its build
+    if not args.mirror_dir:
+        with timed_phase('prefetch'):
+            prefetch_sources(releases, args.connections)
+
+    max_parallel = args.max_parallel or max(1, args.jobs //
+                                            MIN_JOBS_PER_BUILD)
+    results = run_with_job_budget(
+        lambda release, jobs: build_release(args, release, jobs, confirmed),
+        releases, args.jobs, max_parallel)
+
+    print('Build summary:')
+    for result in results:
+        print('  {:10} {:6} jobs={:<3} {:>8}s  {}'.format(
+            result['version'], result['status'], result['jobs'],
+            result['seconds'], result['install_directory']))
+
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump(results, report_file, indent=2)
+
+    exit(0 if all(result['status'] == 'ok' for result in results) else 1)
+
+
 if __name__ == "__main__":
     parser = \
         argparse.ArgumentParser(prog='py34-install',
-                                description='Compile and install Python 3.4.3')
+                                description='Compile and install Python')
+
+    parser.add_argument('--manifest',
+                        type=str,
+                        default=RELEASE_MANIFEST,
+                        help='JSON (or TOML) release manifest (default: '
+                             '{})'.format(RELEASE_MANIFEST))
+
+    parser.add_argument('--release',
+                        type=str,
+                        action='append',
+                        default=None,
+                        help='version from the manifest, or "all"; may be '
+                             'repeated to build several releases at once '
+                             '(default: {})'.format(DEFAULT_RELEASE))
 
     parser.add_argument('--install-directory',
                         type=str,
-                        default=PYTHON34_HOME,
-                        help='(default: {})'.format(PYTHON34_HOME))
+                        default=None,
+                        help='install directory of a single release '
+                             '(default: its "home" in the manifest, or '
+                             '/opt/python<major><minor>)')
+
+    parser.add_argument('--max-parallel',
+                        type=int,
+                        default=None,
+                        help='releases built at the same time (default: as '
+                             'many as --jobs allows, {} jobs '
+                             'each)'.format(MIN_JOBS_PER_BUILD))
+
+    parser.add_argument('--skip-dependencies',
+                        action='store_true',
+                        help='do not check or install the build dependencies')
+
+    parser.add_argument('--yes', '-y',
+                        action='store_true',
+                        help='replace existing install directories without '
+                             'asking, for unattended runs')
+
+    parser.add_argument('--unique-build-dir',
+                        action='store_true',
+                        help='build in a directory of this run only, under '
+                             'the build root, instead of sharing (and '
+                             'waiting for) the build directory of the '
+                             'release; only its logs are kept')
+
+    parser.add_argument('--check',
+                        action='store_true',
+                        help='only tell whether the install matches the '
+                             'requested build (exit status 0) or has to be '
+                             'built again (exit status 1, with what '
+                             'changed)')
+
+    parser.add_argument('--jobs', '-j',
+                        type=int,
+                        default=usable_cpu_count(),
+                        help='parallel make jobs (default: usable CPUs, '
+                             '{})'.format(usable_cpu_count()))
+
+    parser.add_argument('--force-phase',
+                        choices=BUILD_PHASES,
+                        action='append',
+                        default=[],
+                        help='rerun this build phase (and the ones after '
+                             'it) even if its stamp is still valid; '
+                             'may be repeated')
+
+    parser.add_argument('--build-root',
+                        type=str,
+                        default=os.environ.get('PY34_BUILD_ROOT'),
+                        help='directory the sources are extracted and built '
+                             'in, or "tmpfs" to build in {} when there is '
+                             'enough free memory; only the install writes '
+                             'to the install directory (default: '
+                             '$PY34_BUILD_ROOT or '
+                             '~/.python<major><minor>-build)'.format(
+                                 TMPFS_DIRECTORY))
+
+    parser.add_argument('--mirror',
+                        type=str,
+                        default=os.environ.get('PY34_MIRROR'),
+                        metavar='URL',
+                        help='download the sources through this '
+                             'source_mirror.py server instead of from '
+                             'upstream (default: $PY34_MIRROR)')
+
+    parser.add_argument('--mirror-dir',
+                        type=str,
+                        default=os.environ.get('PY34_MIRROR_DIR'),
+                        help='read the sources from this directory and '
+                             'never download them, for hosts without '
+                             'network access; --prefetch fills it '
+                             '(default: $PY34_MIRROR_DIR)')
+
+    parser.add_argument('--prefetch',
+                        action='store_true',
+                        help='only download the sources of the releases, '
+                             'concurrently, into the mirror directory (or '
+                             '~/.python34) and exit')
+
+    parser.add_argument('--connections',
+                        type=int,
+                        default=prefetch.CONNECTIONS,
+                        help='downloads at the same time with --prefetch '
+                             '(default: {})'.format(prefetch.CONNECTIONS))
+
+    parser.add_argument('--read-dpkg-status',
+                        action='store_true',
+                        help='check build dependencies by reading the dpkg '
+                             'status file instead of running dpkg-query '
+                             '($PY34_DPKG_STATUS overrides its location)')
+
+    parser.add_argument('--compiler-cache',
+                        action='store_true',
+                        help='compile through ccache, or through the bundled '
+                             'object cache when ccache is not installed')
+
+    parser.add_argument('--compiler-cache-dir',
+                        type=str,
+                        default=None,
+                        help='(default: $COMPILER_CACHE_DIR or {}, shared '
+                             'with erlang_install.py and kerl)'.format(
+                                 cc_cache.COMPILER_CACHE_DIR))
+
+    parser.add_argument('--config-cache',
+                        action='store_true',
+                        help='configure from a shared autoconf config.cache '
+                             'of this distribution, architecture and '
+                             'compiler, dropped when the compiler or the '
+                             '-dev packages change')
+
+    parser.add_argument('--config-cache-dir',
+                        type=str,
+                        default=None,
+                        help='(default: $CONFIG_CACHE_DIR or {}, shared '
+                             'with kerl)'.format(
+                                 config_cache.CONFIG_CACHE_DIR))
+
+    parser.add_argument('--optimize',
+                        nargs='?',
+                        const='tests',
+                        default=None,
+                        metavar='TRAINING_SCRIPT',
+                        help='build with profile guided optimization and '
+                             'LTO, training on a set of stdlib tests or on '
+                             'the given script, then benchmark the result')
+
+    parser.add_argument('--post-install',
+                        nargs='?',
+                        const='standard',
+                        choices=post_install.PROFILES,
+                        default=os.environ.get('PY34_POST_INSTALL'),
+                        metavar='PROFILE',
+                        help='after the install, compile the stdlib '
+                             'bytecode at every optimization level and '
+                             'strip the binaries; the slim profile also '
+                             'removes the test suite, IDLE and Tkinter '
+                             '(default: $PY34_POST_INSTALL)')
+
+    parser.add_argument('--baseline-python',
+                        type=str,
+                        default=None,
+                        help='interpreter the --optimize build is '
+                             'benchmarked against (default: the one in the '
+                             'install directory, before it is replaced)')
+
+    parser.add_argument('--report',
+                        type=str,
+                        default=None,
+                        help='write the per-phase timing and resource report '
+                             'as JSON here (default: logs/report.json in '
+                             'the build root)')
+
+    parser.add_argument('--pack',
+                        type=str,
+                        default=None,
+                        metavar='ARCHIVE',
+                        help='pack the finished install into a relocatable '
+                             '.tar.zst, .tar.xz or .tar.gz archive')
+
+    parser.add_argument('--unpack',
+                        type=str,
+                        default=None,
+                        metavar='ARCHIVE',
+                        help='install from an archive made by --pack, under '
+                             'any --install-directory, instead of building')
+
+    parser.add_argument('--cache-dir',
+                        type=str,
+                        default=os.environ.get('BUILD_CACHE_DIR'),
+                        help='restore the install from, and store it in, '
+                             'this build cache directory (default: '
+                             '$BUILD_CACHE_DIR, disabled when unset)')
+
+    parser.add_argument('--cache-max-size',
+                        type=str,
+                        default=None,
+                        help='evict least recently used builds above this '
+                             'size (default: $BUILD_CACHE_MAX_SIZE or '
+                             '{})'.format(build_cache.BUILD_CACHE_MAX_SIZE))
 
     args = parser.parse_args()
-    main(args.install_directory)
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.connections < 1:
+        parser.error('--connections must be at least 1')
+
+    manifest = load_manifest(args.manifest)
+    versions = args.release or [DEFAULT_RELEASE if DEFAULT_RELEASE in
+                                manifest else next(iter(manifest), None)]
+    if 'all' in versions:
+        versions = list(manifest)
+    if args.mirror:
+        for release in manifest.values():
+            release['url'] = source_mirror.mirrored_url(args.mirror,
+                                                        release['url'])
+    versions = list(collections.OrderedDict.fromkeys(versions))
+    for version in versions:
+        if version not in manifest:
+            parser.error('release {} is not in {}'.format(version,
+                                                          args.manifest))
+
+    set_mirror_directory(args.mirror_dir)
+    if args.prefetch:
+        exit(0 if prefetch_sources([manifest[version] for version in
+                                    versions], args.connections) else 1)
+
+    set_assume_yes(args.yes)
+    set_post_install_profile(args.post_install)
+    if args.config_cache:
+        set_config_cache_directory(config_cache.config_cache_directory(
+            args.config_cache_dir))
+    if len(versions) > 1:
+        if args.install_directory:
+            parser.error('--install-directory needs a single --release')
+        main_releases(args, [manifest[version] for version in versions])
+    else:
+        set_release(manifest[versions[0]])
+        args.install_directory = args.install_directory or release_home()
+        main(args)
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+'''
+Registry of the Python and Erlang/OTP builds and installations of a host,
+shared by py34_install.py, erlang_install.py and kerl.
+
+Every build and installation is a row of a SQLite database with its
+product, name, release, location, fingerprint, size and build time.
+Lookups by name, location, release or fingerprint go through an index, so
+an "already built?" question stays a single fast query with thousands of
+entries. Updates run in transactions (the database is in WAL mode, and
+writers wait for each other), so concurrent builds never lose an entry.
+
+kerl kept this in the flat files otp_builds and otp_installations; those
+are imported once and renamed to *.imported.
+
+    registry.py [--registry FILE] add-build PRODUCT NAME RELEASE LOCATION
+    registry.py [--registry FILE] add-installation PRODUCT NAME LOCATION
+    registry.py [--registry FILE] build [--fingerprint] PRODUCT NAME
+    registry.py [--registry FILE] installation LOCATION
+    registry.py [--registry FILE] remove-build PRODUCT NAME
+    registry.py [--registry FILE] remove-installation LOCATION
+    registry.py [--registry FILE] list builds|installations
+    registry.py [--registry FILE] import-kerl KERL_BASE_DIR
+'''
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+from contextlib import contextmanager
+
+from build_utils import tree_size
+
+REGISTRY_PATH = os.path.join(os.path.expanduser('~'), '.build-registry.db')
+
+SCHEMA_VERSION = 2
+
+# Seconds a writer waits for another one before giving up
+BUSY_TIMEOUT = 60
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS builds (
+    id INTEGER PRIMARY KEY,
+    product TEXT NOT NULL,
+    name TEXT NOT NULL,
+    release TEXT NOT NULL,
+    location TEXT,
+    fingerprint TEXT,
+    size INTEGER,
+    seconds REAL,
+    applications TEXT,
+    created REAL NOT NULL,
+    UNIQUE (product, name)
+);
+CREATE INDEX IF NOT EXISTS builds_release ON builds (product, release);
+CREATE INDEX IF NOT EXISTS builds_fingerprint ON builds (fingerprint);
+CREATE TABLE IF NOT EXISTS installations (
+    id INTEGER PRIMARY KEY,
+    product TEXT NOT NULL,
+    name TEXT NOT NULL,
+    release TEXT,
+    location TEXT NOT NULL UNIQUE,
+    fingerprint TEXT,
+    size INTEGER,
+    seconds REAL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS installations_name
+    ON installations (product, name);
+'''
+
+# What takes a registry of the version before to this one
+MIGRATIONS = {
+    2: ('ALTER TABLE builds ADD COLUMN applications TEXT',),
+}
+
+INSTALLATION_COLUMNS = ('product', 'name', 'release', 'location',
+                        'fingerprint', 'size', 'seconds', 'created')
+# applications: what a build was restricted to, NULL for a full build
+BUILD_COLUMNS = INSTALLATION_COLUMNS[:-1] + ('applications', 'created')
+
+KERL_LISTS = ('otp_builds', 'otp_installations')
+
+
+def registry_path(path=None):
+    return path or os.environ.get('BUILD_REGISTRY', REGISTRY_PATH)
+
+
+def connect(path=None):
+    path = registry_path(path)
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    # Transactions are started explicitly, see transaction()
+    connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT,
+                                 isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    if connection.execute('PRAGMA user_version').fetchone()[0] != \
+            SCHEMA_VERSION:
+        # Statement by statement, executescript() would commit first
+        with transaction(connection):
+            # Again under the write lock, another process may be done
+            version = connection.execute(
+                'PRAGMA user_version').fetchone()[0]
+            statements = SCHEMA.split(';') if version == 0 else \
+                [statement for number in range(version + 1,
+                                               SCHEMA_VERSION + 1)
+                 for statement in MIGRATIONS[number]]
+            for statement in statements:
+                if statement.strip():
+                    connection.execute(statement)
+            connection.execute('PRAGMA user_version = {}'.format(
+                SCHEMA_VERSION))
+        # Readers then never wait for a writer
+        connection.execute('PRAGMA journal_mode = WAL')
+    return connection
+
+
+@contextmanager
+def transaction(connection):
+    # IMMEDIATE takes the write lock up front, so two writers wait for each
+    # other instead of one failing when it upgrades a read lock
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        yield connection
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
+
+
+def row_dict(row):
+    return None if row is None else dict(zip(row.keys(), row))
+
+
+def normalize_location(location):
+    return location and os.path.abspath(location)
+
+
+def record_build(connection, product, name, release, location=None,
+                 fingerprint=None, size=None, seconds=None,
+                 applications=None):
+    values = (product, name, release, normalize_location(location),
+              fingerprint, size, seconds, applications or None, time.time())
+    with transaction(connection):
+        connection.execute('INSERT OR REPLACE INTO builds ({}) VALUES '
+                           '({})'.format(', '.join(BUILD_COLUMNS),
+                                         ', '.join('?' * len(values))),
+                           values)
+
+
+def record_installation(connection, product, name, location, release=None,
+                        fingerprint=None, size=None, seconds=None):
+    values = (product, name, release, normalize_location(location),
+              fingerprint, size, seconds, time.time())
+    with transaction(connection):
+        connection.execute('INSERT OR REPLACE INTO installations ({}) '
+                           'VALUES ({})'.format(
+                               ', '.join(INSTALLATION_COLUMNS),
+                               ', '.join('?' * len(values))), values)
+
+
+def find_build(connection, product, name):
+    return row_dict(connection.execute(
+        'SELECT * FROM builds WHERE product = ? AND name = ?',
+        (product, name)).fetchone())
+
+
+def find_builds(connection, product, release=None, fingerprint=None):
+    query, values = 'SELECT * FROM builds WHERE product = ?', [product]
+    if release is not None:
+        query += ' AND release = ?'
+        values.append(release)
+    if fingerprint is not None:
+        query += ' AND fingerprint = ?'
+        values.append(fingerprint)
+    return [row_dict(row) for row in connection.execute(
+        query + ' ORDER BY id', values)]
+
+
+def find_installation(connection, location):
+    return row_dict(connection.execute(
+        'SELECT * FROM installations WHERE location = ?',
+        (normalize_location(location),)).fetchone())
+
+
+def find_installations(connection, product, name):
+    # The installations of a build
+    return [row_dict(row) for row in connection.execute(
+        'SELECT * FROM installations WHERE product = ? AND name = ? '
+        'ORDER BY id', (product, name))]
+
+
+def builds(connection, product=None):
+    if product:
+        return find_builds(connection, product)
+    return [row_dict(row) for row in connection.execute(
+        'SELECT * FROM builds ORDER BY id')]
+
+
+def installations(connection, product=None):
+    query, values = 'SELECT * FROM installations', ()
+    if product:
+        query, values = query + ' WHERE product = ?', (product,)
+    return [row_dict(row) for row in connection.execute(
+        query + ' ORDER BY id', values)]
+
+
+def remove_build(connection, product, name):
+    with transaction(connection):
+        return connection.execute(
+            'DELETE FROM builds WHERE product = ? AND name = ?',
+            (product, name)).rowcount
+
+
+def remove_installation(connection, location):
+    with transaction(connection):
+        return connection.execute(
+            'DELETE FROM installations WHERE location = ?',
+            (normalize_location(location),)).rowcount
+
+
+def import_kerl(connection, base_dir):
+    # Imports kerl's otp_builds ("release,name" lines) and
+    # otp_installations ("name location" lines), once; returns the number
+    # of entries imported
+    imported = 0
+    with transaction(connection):
+        for list_name in KERL_LISTS:
+            filepath = os.path.join(base_dir, list_name)
+            # Another kerl may have imported it while this one waited
+            if not os.path.exists(filepath):
+                continue
+            with open(filepath) as list_file:
+                lines = [line.strip() for line in list_file if line.strip()]
+            for line in lines:
+                if list_name == 'otp_builds':
+                    release, _, name = line.partition(',')
+                    cursor = connection.execute(
+                        'INSERT OR IGNORE INTO builds (product, name, '
+                        'release, created) VALUES (?, ?, ?, ?)',
+                        ('erlang', name, release, time.time()))
+                else:
+                    name, _, location = line.partition(' ')
+                    release = connection.execute(
+                        'SELECT release FROM builds WHERE product = ? AND '
+                        'name = ?', ('erlang', name)).fetchone()
+                    cursor = connection.execute(
+                        'INSERT OR IGNORE INTO installations (product, '
+                        'name, release, location, created) VALUES '
+                        '(?, ?, ?, ?, ?)',
+                        ('erlang', name, release and release[0],
+                         normalize_location(location), time.time()))
+                imported += cursor.rowcount
+            os.replace(filepath, filepath + '.imported')
+    return imported
+
+
+def print_entries(entries, what, output_format):
+    if output_format == 'json':
+        print(json.dumps(entries, indent=2))
+    elif not entries:
+        print('There are no {} available'.format(what))
+    elif output_format == 'kerl':
+        # The lines of kerl's old otp_builds and otp_installations
+        for entry in entries:
+            if what == 'builds':
+                print('{},{}'.format(entry['release'], entry['name']))
+            else:
+                print('{} {}'.format(entry['name'], entry['location']))
+    else:
+        for entry in entries:
+            print('{:8} {:24} {:12} {:>10} {:>8}  {}'.format(
+                entry['product'], entry['name'], entry['release'] or '-',
+                '-' if entry['size'] is None else entry['size'],
+                '-' if entry['seconds'] is None else
+                '{:.0f}s'.format(entry['seconds']),
+                entry['location'] or '-'))
+
+
+def main(args):
+    try:
+        connection = connect(args.registry)
+        if args.command in ('add-build', 'add-installation'):
+            size = tree_size(args.location) if args.measure_size else None
+            if args.command == 'add-build':
+                record_build(connection, args.product, args.name,
+                             args.release, args.location, args.fingerprint,
+                             size, args.seconds, args.applications)
+            else:
+                record_installation(connection, args.product, args.name,
+                                    args.location, args.release,
+                                    args.fingerprint, size, args.seconds)
+        elif args.command == 'build':
+            build = find_build(connection, args.product, args.name)
+            if build is None:
+                exit(1)
+            print(build['fingerprint'] or '' if args.fingerprint
+                  else build['release'])
+        elif args.command == 'installation':
+            installation = find_installation(connection, args.location)
+            if installation is None:
+                exit(1)
+            print(installation['name'])
+        elif args.command == 'remove-build':
+            exit(0 if remove_build(connection, args.product, args.name)
+                 else 1)
+        elif args.command == 'remove-installation':
+            exit(0 if remove_installation(connection, args.location)
+                 else 1)
+        elif args.command == 'list':
+            entries = builds(connection, args.product) \
+                if args.what == 'builds' else \
+                installations(connection, args.product)
+            print_entries(entries, args.what, args.format)
+        elif args.command == 'import-kerl':
+            print('Imported {} entries from {}'.format(
+                import_kerl(connection, args.base_dir), args.base_dir))
+    except (sqlite3.Error, IOError, OSError) as msg:
+        print('Registry {}: {}'.format(registry_path(args.registry), msg),
+              file=sys.stderr)
+        exit(2)
+    exit(0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='registry',
+                                     description='Registry of builds and '
+                                                 'installations')
+    parser.add_argument('--registry', type=str, default=None,
+                        help='(default: $BUILD_REGISTRY or {})'.format(
+                            REGISTRY_PATH))
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    for command in ('add-build', 'add-installation'):
+        add_parser = commands.add_parser(command, help='record a {}'.format(
+            command.split('-')[1]))
+        add_parser.add_argument('product', type=str)
+        add_parser.add_argument('name', type=str)
+        if command == 'add-build':
+            add_parser.add_argument('release', type=str)
+            add_parser.add_argument('--applications', type=str,
+                                    default=None,
+                                    help='the only applications built')
+        else:
+            add_parser.add_argument('--release', type=str, default=None)
+        add_parser.add_argument('location', type=str)
+        add_parser.add_argument('--fingerprint', type=str, default=None)
+        add_parser.add_argument('--seconds', type=float, default=None,
+                                help='how long the build took')
+        add_parser.add_argument('--measure-size', action='store_true',
+                                help='record the size of the location')
+
+    build_parser = commands.add_parser('build', help='print the release of '
+                                                     'a build, exit status 1 '
+                                                     'when there is none')
+    build_parser.add_argument('product', type=str)
+    build_parser.add_argument('name', type=str)
+    build_parser.add_argument('--fingerprint', action='store_true',
+                              help='print its fingerprint instead')
+
+    installation_parser = commands.add_parser('installation',
+                                              help='print the build name '
+                                                   'of an installation, '
+                                                   'exit status 1 when '
+                                                   'there is none')
+    installation_parser.add_argument('location', type=str)
+
+    remove_build_parser = commands.add_parser('remove-build')
+    remove_build_parser.add_argument('product', type=str)
+    remove_build_parser.add_argument('name', type=str)
+
+    remove_installation_parser = commands.add_parser('remove-installation')
+    remove_installation_parser.add_argument('location', type=str)
+
+    list_parser = commands.add_parser('list')
+    list_parser.add_argument('what', choices=('builds', 'installations'))
+    list_parser.add_argument('--product', type=str, default=None)
+    list_parser.add_argument('--format', choices=('table', 'kerl', 'json'),
+                             default='table')
+
+    import_parser = commands.add_parser('import-kerl',
+                                        help='import the otp_builds and '
+                                             'otp_installations of kerl')
+    import_parser.add_argument('base_dir', type=str)
+
+    main(parser.parse_args())
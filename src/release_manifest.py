@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+'''
+The release manifest of py34_install.py: versions, download URLs,
+checksums, configure options and build dependencies of every Python we
+build. Also read by source_mirror.py, which stores the archives it names.
+'''
+import os
+import json
+import collections
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+# In JSON (or TOML, where the interpreter has tomllib)
+RELEASE_MANIFEST = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'python_releases.json')
+
+
+def load_manifest(filepath=None):
+    filepath = filepath or RELEASE_MANIFEST
+    try:
+        if filepath.endswith('.toml'):
+            if tomllib is None:
+                print('Reading {} needs Python 3.11 or later, use a JSON '
+                      'manifest'.format(filepath))
+                exit(1)
+            with open(filepath, 'rb') as manifest_file:
+                manifest = tomllib.load(manifest_file)
+        else:
+            with open(filepath) as manifest_file:
+                manifest = json.load(manifest_file)
+    except (IOError, ValueError) as msg:
+        print('Could not read release manifest {}: {}'.format(filepath, msg))
+        exit(1)
+
+    releases = collections.OrderedDict()
+    sets = manifest.get('dependency_sets', {})
+    for release in manifest.get('releases', []):
+        release = dict(release)
+        if not release.get('version') or not release.get('url') or \
+                not (release.get('sha256') or release.get('md5')):
+            print('Release {} in {} needs a version, a url and a sha256 or '
+                  'md5 sum'.format(release.get('version'), filepath))
+            exit(1)
+        # 'ID/RELEASE' -> a list of packages, or the name of a shared set
+        deps = {}
+        for distro, packages in release.get('deps', {}).items():
+            deps[distro] = tuple(sets.get(packages, ()) if
+                                 isinstance(packages, str) else packages)
+        release['deps'] = deps
+        release.setdefault('configure_options', [])
+        releases[release['version']] = release
+    return releases
+
+
+def release_checksum(release):
+    # (algorithm, hex digest), SHA-256 when the manifest has it
+    if release.get('sha256'):
+        return 'sha256', release['sha256']
+    return 'md5', release['md5']
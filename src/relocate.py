@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+'''
+Relocatable archives of finished installs, shared by py34_install.py and
+kerl: build once, then unpack the same archive under any prefix.
+
+pack scans the install tree for files that mention its prefix and records
+them in a manifest stored with the tree (.relocatable.json). Text files
+(shebangs, activate scripts, sysconfig data, Makefiles, pkg-config files,
+Erlang's bin/erl) are rewritten by unpack for the new prefix; binaries that
+mention it are only listed, CPython and ERTS find their prefix at run time.
+Absolute symlinks into the tree are stored as relative ones.
+
+    relocate.py pack INSTALL_DIRECTORY ARCHIVE   (.tar.zst, .tar.xz, .tar.gz)
+    relocate.py unpack ARCHIVE PREFIX
+    relocate.py show ARCHIVE
+'''
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import tarfile
+import argparse
+import tempfile
+import subprocess
+
+import stream_extract
+
+MANIFEST_NAME = '.relocatable.json'
+MANIFEST_FORMAT = 1
+
+# Multi-threaded compressors by archive suffix, tarfile is the fallback
+COMPRESSORS = (('.tar.zst', ['zstd', '-q', '-T0', '-10', '-c']),
+               ('.tar.xz', ['xz', '-T0', '-6', '-c']),
+               ('.tar.gz', ['pigz', '-6', '-c']))
+
+TARFILE_MODES = (('.tar.xz', 'w|xz'), ('.tar.gz', 'w|gz'), ('.tar', 'w|'))
+
+SNIFF_SIZE = 8192
+
+
+def is_binary(filepath):
+    with open(filepath, 'rb') as sniffed:
+        return b'\0' in sniffed.read(SNIFF_SIZE)
+
+
+def mentions(filepath, needle):
+    # Reads in blocks that overlap by the needle length, so a match across
+    # two blocks is not missed
+    tail = b''
+    with open(filepath, 'rb') as scanned:
+        for data in iter(lambda: scanned.read(2**20), b''):
+            if needle in tail + data:
+                return True
+            tail = data[-len(needle):]
+    return False
+
+
+def scan_tree(root, prefix):
+    # (text files to rewrite, binaries mentioning prefix, absolute symlinks)
+    # with paths relative to root
+    needle = prefix.encode('utf-8')
+    rewrite, binaries, links = [], [], {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames + [d for d in dirnames if
+                                        os.path.islink(os.path.join(dirpath,
+                                                                    d))]):
+            filepath = os.path.join(dirpath, name)
+            relpath = os.path.relpath(filepath, root)
+            if relpath == MANIFEST_NAME:
+                continue
+            if os.path.islink(filepath):
+                target = os.readlink(filepath)
+                if os.path.isabs(target):
+                    links[relpath] = target
+                continue
+            if not os.path.isfile(filepath) or not mentions(filepath,
+                                                            needle):
+                continue
+            if is_binary(filepath):
+                binaries.append(relpath)
+            else:
+                rewrite.append(relpath)
+    return rewrite, binaries, links
+
+
+def relative_link(root, prefix, relpath, target):
+    # An absolute link into the tree as a link relative to where it is
+    if target != prefix and not target.startswith(prefix + '/'):
+        return None
+    inside = os.path.join(root, os.path.relpath(target, prefix))
+    return os.path.relpath(inside, os.path.dirname(os.path.join(root,
+                                                                relpath)))
+
+
+def write_manifest(root, manifest):
+    tmp_filepath = os.path.join(root, MANIFEST_NAME + '.tmp')
+    with open(tmp_filepath, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.replace(tmp_filepath, os.path.join(root, MANIFEST_NAME))
+
+
+def read_manifest(root):
+    with open(os.path.join(root, MANIFEST_NAME)) as manifest_file:
+        return json.load(manifest_file)
+
+
+def open_compressor(archive, output):
+    # (tarfile mode, process or None) writing the compressed tar to output
+    for suffix, args in COMPRESSORS:
+        if archive.endswith(suffix) and shutil.which(args[0]):
+            proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                    stdout=output)
+            return 'w|', proc
+    if archive.endswith(('.tar.zst', '.tzst')):
+        raise IOError('zstd is needed to write {}'.format(archive))
+    for suffix, mode in TARFILE_MODES:
+        if archive.endswith(suffix):
+            return mode, None
+    raise IOError('unknown archive type {}'.format(archive))
+
+
+def pack(source, archive, product=None, version=None, prefix=None):
+    start = time.monotonic()
+    source = os.path.abspath(source)
+    prefix = prefix or source
+    rewrite, binaries, absolute_links = scan_tree(source, prefix)
+
+    links = {}
+    for relpath, target in absolute_links.items():
+        relative = relative_link(source, prefix, relpath, target)
+        if relative is None:
+            raise IOError('{} links to {}, outside of {}'.format(
+                relpath, target, prefix))
+        links[relpath] = relative
+
+    manifest = {'format': MANIFEST_FORMAT,
+                'product': product,
+                'version': version,
+                'prefix': prefix,
+                'created': time.time(),
+                'rewrite': rewrite,
+                'binary_references': binaries}
+    encoded = json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8')
+
+    def relink(member):
+        relpath = os.path.normpath(member.name)
+        if member.issym() and relpath in links:
+            member.linkname = links[relpath]
+        return member
+
+    directory = os.path.dirname(os.path.abspath(archive))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    fd, tmp_filepath = tempfile.mkstemp(prefix='.pack-', dir=directory)
+    proc = None
+    try:
+        with os.fdopen(fd, 'wb') as output:
+            mode, proc = open_compressor(archive, output)
+            stream = proc.stdin if proc else output
+            with tarfile.open(fileobj=stream, mode=mode) as tar:
+                # First, so that show only has to read the start
+                info = tarfile.TarInfo(MANIFEST_NAME)
+                info.size = len(encoded)
+                info.mtime = manifest['created']
+                info.mode = 0o644
+                tar.addfile(info, io.BytesIO(encoded))
+                for name in sorted(os.listdir(source)):
+                    if name != MANIFEST_NAME:
+                        tar.add(os.path.join(source, name), name,
+                                filter=relink)
+            if proc:
+                proc.stdin.close()
+                if proc.wait() != 0:
+                    raise IOError('{} failed with status {}'.format(
+                        proc.args[0], proc.returncode))
+        os.replace(tmp_filepath, archive)
+    except BaseException:
+        if proc and proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        os.unlink(tmp_filepath)
+        raise
+
+    manifest['size'] = os.path.getsize(archive)
+    manifest['seconds'] = round(time.monotonic() - start, 3)
+    return manifest
+
+
+def rewrite_file(filepath, old, new):
+    with open(filepath, 'rb') as original:
+        data = original.read()
+    fixed = data.replace(old.encode('utf-8'), new.encode('utf-8'))
+    if fixed == data:
+        return False
+    tmp_filepath = filepath + '.relocate'
+    with open(tmp_filepath, 'wb') as rewritten:
+        rewritten.write(fixed)
+    shutil.copystat(filepath, tmp_filepath)
+    os.replace(tmp_filepath, filepath)
+    return True
+
+
+def unpack(archive, prefix):
+    # Extracts archive as prefix (replacing it) and rewrites the files that
+    # mention the prefix it was packed from
+    start = time.monotonic()
+    prefix = os.path.abspath(prefix)
+    extracted = stream_extract.extract(archive, prefix)
+    try:
+        manifest = read_manifest(prefix)
+    except (IOError, ValueError):
+        raise stream_extract.ExtractError('{} has no {}'.format(
+            archive, MANIFEST_NAME))
+
+    rewritten = 0
+    if manifest['prefix'] != prefix:
+        for relpath in manifest['rewrite']:
+            filepath = os.path.join(prefix, relpath)
+            if not stream_extract.is_within(prefix,
+                                            os.path.realpath(filepath)):
+                continue
+            if rewrite_file(filepath, manifest['prefix'], prefix):
+                rewritten += 1
+        manifest['packed_prefix'] = manifest['prefix']
+        manifest['prefix'] = prefix
+        write_manifest(prefix, manifest)
+
+    manifest['rewritten'] = rewritten
+    manifest['extract'] = extracted
+    manifest['seconds'] = round(time.monotonic() - start, 3)
+    return manifest
+
+
+def show(archive):
+    extra = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+    tmp_dir = tempfile.mkdtemp(prefix='.show-')
+    try:
+        mode = 'r|*'
+        decompressor = stream_extract.find_decompressor(
+            stream_extract.compression_of(archive))
+        with open(archive, 'rb') as archive_file:
+            proc = None
+            stream = archive_file
+            if decompressor:
+                proc = subprocess.Popen(decompressor, stdin=archive_file,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL)
+                stream, mode = proc.stdout, 'r|'
+            try:
+                with tarfile.open(fileobj=stream, mode=mode) as tar:
+                    member = tar.next()
+                    if member is None or member.name != MANIFEST_NAME:
+                        raise stream_extract.ExtractError(
+                            '{} has no {}'.format(archive, MANIFEST_NAME))
+                    tar.extract(member, tmp_dir, **extra)
+            finally:
+                if proc:
+                    proc.stdout.close()
+                    proc.kill()
+                    proc.wait()
+        return read_manifest(tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def main(args):
+    try:
+        if args.command == 'pack':
+            manifest = pack(args.source, args.archive, args.product,
+                            args.version)
+            print('Packed {} into {} ({} bytes, {} files to rewrite) in '
+                  '{:.1f}s'.format(args.source, args.archive,
+                                   manifest['size'], len(manifest['rewrite']),
+                                   manifest['seconds']))
+        elif args.command == 'unpack':
+            manifest = unpack(args.archive, args.prefix)
+            print('Unpacked {} into {}, {} files rewritten, in {:.1f}s'.format(
+                args.archive, args.prefix, manifest['rewritten'],
+                manifest['seconds']))
+        elif args.command == 'show':
+            print(json.dumps(show(args.archive), indent=2, sort_keys=True))
+    except (stream_extract.ExtractError, IOError, OSError,
+            tarfile.TarError) as msg:
+        print('Could not {} {}: {}'.format(args.command, args.archive, msg),
+              file=sys.stderr)
+        exit(1)
+    exit(0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='relocate',
+                                     description='Relocatable archives of '
+                                                 'finished installs')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    pack_parser = commands.add_parser('pack', help='archive an install tree')
+    pack_parser.add_argument('source', type=str)
+    pack_parser.add_argument('archive', type=str,
+                             help='.tar.zst, .tar.xz or .tar.gz')
+    pack_parser.add_argument('--product', type=str, default=None)
+    pack_parser.add_argument('--version', type=str, default=None)
+
+    unpack_parser = commands.add_parser('unpack', help='install an archive '
+                                                       'under a prefix')
+    unpack_parser.add_argument('archive', type=str)
+    unpack_parser.add_argument('prefix', type=str)
+
+    show_parser = commands.add_parser('show', help='print the manifest')
+    show_parser.add_argument('archive', type=str)
+
+    main(parser.parse_args())
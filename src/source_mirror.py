@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+'''
+Caching HTTP mirror of the upstream source archives for a build farm.
+
+One host runs source_mirror.py serve and all the others download through
+it (py34_install.py --mirror, erlang_install.py --mirror, $KERL_MIRROR): an
+archive is fetched from upstream once, verified against its checksum, kept
+in a store capped in size (least recently used archives are evicted first)
+and served from there to every other host, with byte ranges so that an
+interrupted download resumes.
+
+Upstream URLs map to mirror paths by host: scheme://HOST/PATH is served as
+MIRROR/HOST/PATH, for the hosts given with --upstream. Archives are only
+stored when their sum is known, from the release manifest (--manifest) or
+from an MD5 index next to them upstream (erlang.org's MD5 file); index files
+are kept for --index-max-age seconds, anything else is passed through.
+
+    source_mirror.py serve [--store DIR] [--max-size 20G] [--port 8780]
+                           [--upstream URL ...] [--manifest FILE]
+'''
+import os
+import sys
+import re
+import json
+import time
+import argparse
+import threading
+import http.server
+import socketserver
+import urllib.error
+import urllib.request
+
+import build_cache
+import prefetch
+import release_manifest
+import stream_extract
+
+MIRROR_DIR = os.path.join(os.path.expanduser('~'), '.source-mirror')
+MIRROR_MAX_SIZE = '20G'
+MIRROR_PORT = 8780
+
+UPSTREAMS = ('https://www.python.org', 'http://www.erlang.org')
+
+INDEX_NAMES = ('MD5',)
+INDEX_MAX_AGE = 3600
+
+STATUS_PATH = '/_status'
+
+# A single range of bytes, the only kind downloads resume with
+BYTE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def mirrored_url(mirror_url, url):
+    # scheme://host/path as served by the mirror at mirror_url
+    return '{}/{}'.format(mirror_url.rstrip('/'), url.split('://', 1)[-1])
+
+
+def upstream_hosts(upstreams):
+    # {host: scheme://host} of upstream URLs
+    hosts = {}
+    for upstream in upstreams:
+        scheme, _, rest = upstream.partition('://')
+        host = rest.split('/', 1)[0]
+        hosts[host] = '{}://{}'.format(scheme, host)
+    return hosts
+
+
+def manifest_sums(filepath):
+    # {archive name: (algorithm, digest)} of the releases in a manifest;
+    # upstreams of the release URLs are added to the mirrored hosts
+    sums, upstreams = {}, []
+    for release in release_manifest.load_manifest(filepath).values():
+        sums[release['url'].split('/')[-1]] = \
+            release_manifest.release_checksum(release)
+        upstreams.append(release['url'])
+    return sums, upstreams
+
+
+def new_mirror(store, max_bytes, upstreams, sums=None,
+               index_max_age=INDEX_MAX_AGE):
+    # Shared by all the request threads of the server
+    return {'store': os.path.abspath(store),
+            'max_bytes': max_bytes,
+            'hosts': upstream_hosts(upstreams),
+            'sums': dict(sums or {}),
+            'index_max_age': index_max_age,
+            'stats': {'hits': 0, 'misses': 0, 'passed': 0, 'failed': 0,
+                      'bytes_upstream': 0, 'bytes_served': 0, 'evicted': 0},
+            'lock': threading.Lock(),
+            'path_locks': {}}
+
+
+def path_lock(mirror, path):
+    with mirror['lock']:
+        return mirror['path_locks'].setdefault(path, threading.Lock())
+
+
+def count(mirror, name, value=1):
+    with mirror['lock']:
+        mirror['stats'][name] += value
+
+
+def upstream_url(mirror, path):
+    host, _, rest = path.lstrip('/').partition('/')
+    if host not in mirror['hosts'] or not rest:
+        return None
+    return '{}/{}'.format(mirror['hosts'][host], rest)
+
+
+def local_path(mirror, path):
+    filepath = os.path.normpath(os.path.join(mirror['store'],
+                                             path.lstrip('/')))
+    if not stream_extract.is_within(mirror['store'], filepath):
+        return None
+    return filepath
+
+
+def fetch_index(mirror, path):
+    filepath = local_path(mirror, path)
+    with path_lock(mirror, path):
+        if os.path.exists(filepath) and time.time() - \
+                os.path.getmtime(filepath) < mirror['index_max_age']:
+            return filepath
+        directory = os.path.dirname(filepath)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        received = prefetch.fetch_once(upstream_url(mirror, path), filepath,
+                                       None)
+        count(mirror, 'bytes_upstream', received)
+        return filepath
+
+
+def archive_checksum(mirror, path):
+    # (algorithm, digest) of an archive, from the manifest or from the MD5
+    # index in its upstream directory
+    name = path.split('/')[-1]
+    if name in mirror['sums']:
+        return mirror['sums'][name]
+    for index in INDEX_NAMES:
+        try:
+            index_filepath = fetch_index(mirror, '{}/{}'.format(
+                path.rsplit('/', 1)[0], index))
+        except (prefetch.PrefetchError, IOError, OSError):
+            continue
+        sums = prefetch.read_index(index_filepath)
+        if name in sums:
+            return 'md5', sums[name]
+    return None
+
+
+def store_entries(mirror):
+    # (last use, size, file path) of every stored archive
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(mirror['store']):
+        for name in filenames:
+            if name in INDEX_NAMES or name.endswith('.part'):
+                continue
+            filepath = os.path.join(dirpath, name)
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, filepath))
+    return entries
+
+
+def evict(mirror, keep=None):
+    with mirror['lock']:
+        entries = sorted(store_entries(mirror))
+        total = sum(size for _, size, _ in entries)
+        evicted = []
+        for _, size, filepath in entries:
+            if total <= mirror['max_bytes']:
+                break
+            if filepath == keep:
+                continue
+            try:
+                os.unlink(filepath)
+            except OSError:
+                continue
+            total -= size
+            evicted.append(filepath)
+        mirror['stats']['evicted'] += len(evicted)
+        return evicted
+
+
+def fetch_archive(mirror, path):
+    # Local file path of an archive, fetched and verified on the first
+    # request; concurrent requests for it wait for that one fetch. The file
+    # mtime doubles as its last use time for LRU eviction.
+    filepath = local_path(mirror, path)
+    with path_lock(mirror, path):
+        if os.path.isfile(filepath):
+            os.utime(filepath, None)
+            count(mirror, 'hits')
+            return filepath
+        checksum = archive_checksum(mirror, path)
+        if checksum is None:
+            raise prefetch.PrefetchError('no checksum known for {}'.format(
+                upstream_url(mirror, path)))
+        directory = os.path.dirname(filepath)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        received = prefetch.fetch_once(upstream_url(mirror, path), filepath,
+                                       checksum)
+        count(mirror, 'misses')
+        count(mirror, 'bytes_upstream', received)
+    evict(mirror, keep=filepath)
+    return filepath
+
+
+def mirror_status(mirror):
+    with mirror['lock']:
+        status = dict(mirror['stats'])
+    entries = store_entries(mirror)
+    status['archives'] = len(entries)
+    status['store_bytes'] = sum(size for _, size, _ in entries)
+    status['max_bytes'] = mirror['max_bytes']
+    status['upstreams'] = sorted(mirror['hosts'].values())
+    return status
+
+
+def byte_range(header, size):
+    # (first, last) byte of a Range header, None to send the whole file and
+    # () when the range is past the end of the file
+    match = BYTE_RANGE.match((header or '').strip())
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:
+        # bytes=-N: the last N bytes
+        if not int(last):
+            return ()
+        return max(0, size - int(last)), size - 1
+    last = min(int(last), size - 1) if last else size - 1
+    if int(first) >= size:
+        return ()
+    if int(first) > last:
+        return None
+    return int(first), last
+
+
+class MirrorHandler(http.server.BaseHTTPRequestHandler):
+    mirror = None
+
+    def send_file(self, filepath, content_type='application/octet-stream',
+                  ranges=False):
+        # With ranges, a Range header resumes an interrupted download
+        size = os.path.getsize(filepath)
+        requested = byte_range(self.headers.get('Range'), size) \
+            if ranges else None
+        if requested == ():
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */{}'.format(size))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        first, last = requested or (0, size - 1)
+        length = last - first + 1
+        self.send_response(206 if requested else 200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(length))
+        if ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if requested:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                first, last, size))
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        with open(filepath, 'rb') as data:
+            data.seek(first)
+            left = length
+            while left > 0:
+                block = data.read(min(prefetch.BLOCK_SIZE, left))
+                if not block:
+                    break
+                self.wfile.write(block)
+                left -= len(block)
+        count(self.mirror, 'bytes_served', length - left)
+
+    def pass_through(self, url):
+        with urllib.request.urlopen(url, timeout=prefetch.DOWNLOAD_TIMEOUT) \
+                as response:
+            data = response.read()
+        count(self.mirror, 'passed')
+        count(self.mirror, 'bytes_upstream', len(data))
+        self.send_response(200)
+        self.send_header('Content-Type',
+                         response.getheader('Content-Type') or 'text/html')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path == STATUS_PATH:
+            data = json.dumps(mirror_status(self.mirror), indent=2,
+                              sort_keys=True).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        url = upstream_url(self.mirror, path)
+        if url is None or local_path(self.mirror, path) is None:
+            self.send_error(404, 'Not a mirrored upstream')
+            return
+        try:
+            if path.rsplit('/', 1)[-1] in INDEX_NAMES:
+                self.send_file(fetch_index(self.mirror, path), 'text/plain')
+            elif stream_extract.compression_of(path):
+                self.send_file(fetch_archive(self.mirror, path),
+                               ranges=True)
+            else:
+                self.pass_through(url)
+        except urllib.error.HTTPError as error:
+            count(self.mirror, 'failed')
+            self.send_error(error.code, 'Upstream: {}'.format(error.reason))
+        except (prefetch.PrefetchError, IOError, OSError) as msg:
+            count(self.mirror, 'failed')
+            self.send_error(502, str(msg) or type(msg).__name__)
+
+    do_HEAD = do_GET
+
+
+class MirrorServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_server(mirror, address='', port=MIRROR_PORT):
+    handler = type('Handler', (MirrorHandler,), {'mirror': mirror})
+    return MirrorServer((address, port), handler)
+
+
+def main(args):
+    upstreams = list(args.upstream or UPSTREAMS)
+    sums = {}
+    if args.manifest:
+        sums, manifest_upstreams = manifest_sums(args.manifest)
+        upstreams += manifest_upstreams
+    mirror = new_mirror(args.store, build_cache.parse_size(args.max_size),
+                        upstreams, sums, args.index_max_age)
+    if not os.path.exists(mirror['store']):
+        os.makedirs(mirror['store'])
+
+    server = make_server(mirror, args.address, args.port)
+    print('Mirroring {} into {} (at most {}) on http://{}:{}/'.format(
+        ', '.join(sorted(mirror['hosts'])), mirror['store'], args.max_size,
+        args.address or '0.0.0.0', server.server_address[1]))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    print(json.dumps(mirror_status(mirror), indent=2, sort_keys=True))
+    exit(0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='source-mirror',
+                                     description='Caching mirror of the '
+                                                 'upstream source archives')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    serve_parser = commands.add_parser('serve', help='run the mirror')
+    serve_parser.add_argument('--store', type=str,
+                              default=os.environ.get('SOURCE_MIRROR_DIR',
+                                                     MIRROR_DIR),
+                              help='(default: $SOURCE_MIRROR_DIR or '
+                                   '{})'.format(MIRROR_DIR))
+    serve_parser.add_argument('--max-size', type=str,
+                              default=MIRROR_MAX_SIZE,
+                              help='evict least recently used archives '
+                                   'above this size (default: '
+                                   '{})'.format(MIRROR_MAX_SIZE))
+    serve_parser.add_argument('--address', type=str, default='')
+    serve_parser.add_argument('--port', type=int, default=MIRROR_PORT,
+                              help='(default: {})'.format(MIRROR_PORT))
+    serve_parser.add_argument('--upstream', type=str, action='append',
+                              default=None,
+                              help='scheme://host mirrored, may be repeated '
+                                   '(default: {})'.format(
+                                       ', '.join(UPSTREAMS)))
+    serve_parser.add_argument('--manifest', type=str, default=None,
+                              help='py34_install.py release manifest whose '
+                                   'sums verify the Python archives')
+    serve_parser.add_argument('--index-max-age', type=int,
+                              default=INDEX_MAX_AGE,
+                              help='seconds an MD5 index is served before '
+                                   'it is fetched again (default: '
+                                   '{})'.format(INDEX_MAX_AGE))
+
+    main(parser.parse_args())
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+'''
+Streaming tarball extraction shared by py34_install.py and kerl.
+
+The archive is read from a file or straight from its URL by a feeder
+thread, which also hashes it (and saves a downloaded copy), and is unpacked
+by tarfile as the bytes come in. Decompression runs in pixz, pigz, xz,
+lbzip2 or zstd when one is installed, and in-process otherwise, so download,
+decompression and extraction overlap instead of running one after the
+other.
+
+Members are unpacked into a staging directory next to the destination,
+which only replaces the destination once the whole archive was read and
+its checksum matched. Members that would land outside of it (absolute
+paths, '..', links pointing out) abort the extraction.
+
+    stream_extract.py [--md5 SUM | --sha256 SUM] [--save FILE]
+                      [--strip-components N] SOURCE DESTINATION
+'''
+import os
+import sys
+import time
+import shutil
+import hashlib
+import tarfile
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.request
+
+from build_utils import copy_hashed, format_bytes
+
+BLOCK_SIZE = 2**16
+DOWNLOAD_TIMEOUT = 60
+
+# Multi-threaded (or at least out of process) decompressors, best first
+DECOMPRESSORS = {
+    'xz': (['pixz', '-d'], ['xz', '-dc', '-T0']),
+    'gz': (['pigz', '-dc'],),
+    'bz2': (['lbzip2', '-dc'], ['pbzip2', '-dc']),
+    'zst': (['zstd', '-dc', '-T0'],),
+}
+
+SUFFIXES = (('.tar.xz', 'xz'), ('.txz', 'xz'),
+            ('.tar.gz', 'gz'), ('.tgz', 'gz'),
+            ('.tar.bz2', 'bz2'), ('.tbz2', 'bz2'),
+            ('.tar.zst', 'zst'), ('.tzst', 'zst'))
+
+
+class ExtractError(Exception):
+    pass
+
+
+def is_url(source):
+    return source.split(':', 1)[0] in ('http', 'https', 'ftp')
+
+
+def compression_of(source):
+    name = source.split('?', 1)[0].lower()
+    for suffix, compression in SUFFIXES:
+        if name.endswith(suffix):
+            return compression
+    return None
+
+
+def find_decompressor(compression):
+    for args in DECOMPRESSORS.get(compression, ()):
+        if shutil.which(args[0]):
+            return args
+    return None
+
+
+def is_within(directory, path):
+    return path == directory or path.startswith(directory + os.sep)
+
+
+def check_member(member, staging):
+    # staging is a realpath; every path is resolved through the links
+    # already extracted, so a link cannot be used to escape it later
+    name = member.name
+    if os.path.isabs(name) or '..' in name.split('/'):
+        raise ExtractError('unsafe path {}'.format(name))
+    target = os.path.realpath(os.path.join(staging, name))
+    if not is_within(staging, target):
+        raise ExtractError('{} is outside of the destination'.format(name))
+    if member.issym():
+        link = os.path.realpath(os.path.join(os.path.dirname(target),
+                                             member.linkname))
+        if os.path.isabs(member.linkname) or not is_within(staging, link):
+            raise ExtractError('{} links outside of the destination'.format(
+                name))
+    elif member.islnk():
+        if os.path.isabs(member.linkname) or \
+                '..' in member.linkname.split('/'):
+            raise ExtractError('{} links outside of the destination'.format(
+                name))
+    elif not (member.isfile() or member.isdir()):
+        raise ExtractError('{} is not a file, directory or link'.format(name))
+
+
+def strip_member(member, strip_components):
+    if not strip_components:
+        return member
+    bits = member.name.split('/')[strip_components:]
+    if not bits or not bits[0]:
+        return None
+    member.name = '/'.join(bits)
+    if member.islnk():
+        member.linkname = '/'.join(
+            member.linkname.split('/')[strip_components:])
+    return member
+
+
+def open_source(source):
+    if is_url(source):
+        return urllib.request.urlopen(source, timeout=DOWNLOAD_TIMEOUT)
+    return open(source, 'rb')
+
+
+def feed(source, sink, digest, save_to, state):
+    # Runs in its own thread: copies the archive into sink (a pipe or the
+    # decompressor's stdin), hashing and saving it along the way
+    try:
+        with open_source(source) as stream:
+            save_file = open(save_to, 'wb') if save_to else None
+            outputs = (save_file, sink) if save_file else (sink,)
+            try:
+                state['bytes_in'] = copy_hashed(stream, outputs, digest,
+                                                BLOCK_SIZE)
+            finally:
+                if save_file:
+                    save_file.close()
+    except BaseException as error:
+        state['error'] = error
+    finally:
+        try:
+            sink.close()
+        except OSError:
+            pass
+
+
+def extract(source, destination, strip_components=0, checksum=None,
+            save_to=None, compression=None):
+    # Returns a dict with the byte counts, members and seconds of the
+    # extraction; raises ExtractError (or IOError) when it failed.
+    # checksum is (algorithm, hex digest); save_to keeps a copy of a
+    # downloaded archive, moved into place when the checksum matched.
+    start = time.monotonic()
+    destination = os.path.abspath(destination)
+    parent = os.path.dirname(destination)
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+    if not is_url(source) or not save_to:
+        save_to = None
+    elif not os.path.exists(os.path.dirname(os.path.abspath(save_to))):
+        os.makedirs(os.path.dirname(os.path.abspath(save_to)))
+
+    compression = compression or compression_of(source)
+    algorithm = checksum[0] if checksum else 'md5'
+    digest = hashlib.new(algorithm)
+    state = {'bytes_in': 0, 'error': None}
+    decompressor = find_decompressor(compression)
+    if decompressor is None and compression == 'zst' and \
+            'zst' not in tarfile.TarFile.OPEN_METH:
+        raise ExtractError('zstd is needed to extract {}'.format(source))
+
+    staging = os.path.realpath(tempfile.mkdtemp(prefix='.extract-',
+                                                dir=parent))
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(staging, 0o777 & ~umask)
+    proc = None
+    try:
+        if decompressor:
+            proc = subprocess.Popen(decompressor, stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL)
+            sink, tar_stream, mode = proc.stdin, proc.stdout, 'r|'
+        else:
+            read_fd, write_fd = os.pipe()
+            sink = os.fdopen(write_fd, 'wb')
+            tar_stream = os.fdopen(read_fd, 'rb')
+            mode = 'r|' + (compression or '*')
+
+        part = save_to and save_to + '.part'
+        feeder = threading.Thread(target=feed, args=(source, sink, digest,
+                                                     part, state))
+        feeder.daemon = True
+        feeder.start()
+
+        members = bytes_out = 0
+        # Members are checked by check_member; the 'tar' filter of newer
+        # Pythons additionally drops setuid bits
+        extra = {'filter': 'tar'} if hasattr(tarfile, 'tar_filter') else {}
+        try:
+            with tarfile.open(fileobj=tar_stream, mode=mode) as archive:
+                for member in archive:
+                    member = strip_member(member, strip_components)
+                    if member is None:
+                        continue
+                    check_member(member, staging)
+                    archive.extract(member, staging, **extra)
+                    members += 1
+                    bytes_out += member.size if member.isfile() else 0
+            # Drain what tar does not read (end of archive padding)
+            for _ in iter(lambda: tar_stream.read(BLOCK_SIZE), b''):
+                pass
+        finally:
+            tar_stream.close()
+            feeder.join()
+            if proc:
+                proc.wait()
+
+        if state['error'] is not None:
+            raise state['error']
+        if proc and proc.returncode != 0:
+            raise ExtractError('{} failed with status {}'.format(
+                decompressor[0], proc.returncode))
+        if checksum and digest.hexdigest() != checksum[1]:
+            if part and os.path.exists(part):
+                os.unlink(part)
+            raise ExtractError('{} sum of {} failed'.format(
+                algorithm.upper(), source))
+
+        if os.path.exists(destination):
+            shutil.rmtree(destination)
+        os.rename(staging, destination)
+        if part:
+            os.replace(part, save_to)
+    except tarfile.TarError as msg:
+        if state['error'] is not None:
+            raise state['error']
+        raise ExtractError('{} is not a valid archive: {}'.format(source,
+                                                                  msg))
+    finally:
+        if proc and proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        shutil.rmtree(staging, ignore_errors=True)
+
+    return {'source': source,
+            'destination': destination,
+            'decompressor': decompressor[0] if decompressor else 'tarfile',
+            'members': members,
+            'bytes_in': state['bytes_in'],
+            'bytes_out': bytes_out,
+            'checksum': digest.hexdigest(),
+            'seconds': round(time.monotonic() - start, 3)}
+
+
+def describe(result):
+    seconds = max(result['seconds'], 1e-6)
+    return '{} files, {} -> {} in {:.1f}s ({}/s read, {}/s written, ' \
+        '{})'.format(result['members'], format_bytes(result['bytes_in']),
+                     format_bytes(result['bytes_out']), result['seconds'],
+                     format_bytes(result['bytes_in'] / seconds),
+                     format_bytes(result['bytes_out'] / seconds),
+                     result['decompressor'])
+
+
+def main(args):
+    checksum = None
+    if args.sha256:
+        checksum = ('sha256', args.sha256)
+    elif args.md5:
+        checksum = ('md5', args.md5)
+    try:
+        result = extract(args.source, args.destination,
+                         args.strip_components, checksum, args.save)
+    except (ExtractError, IOError, OSError) as msg:
+        print('Could not extract {}: {}'.format(args.source, msg),
+              file=sys.stderr)
+        exit(1)
+    print('Extracted {}'.format(describe(result)))
+    exit(0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='stream-extract',
+                                     description='Download and extract a '
+                                                 'tarball in one pass')
+    parser.add_argument('source', type=str, help='archive path or URL')
+    parser.add_argument('destination', type=str,
+                        help='directory replaced by the archive contents')
+    parser.add_argument('--strip-components', type=int, default=0,
+                        help='leading path components dropped from names')
+    parser.add_argument('--md5', type=str, default=None,
+                        help='expected MD5 sum of the archive')
+    parser.add_argument('--sha256', type=str, default=None,
+                        help='expected SHA-256 sum of the archive')
+    parser.add_argument('--save', type=str, default=None,
+                        help='keep a copy of a downloaded archive here')
+    main(parser.parse_args())